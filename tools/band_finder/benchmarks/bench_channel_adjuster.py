@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Time ChannelAdjuster construction over realistic overlap sizes.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+import time
+
+import numpy as np
+
+from band_finder.image_matcher import ChannelAdjuster
+
+
+def _loop_curve(src, targ, channel, vmin, vmax):
+    # The original, loop-based mapping, for comparison.
+    samples = dict()
+    src_values = src[:, :, channel].flatten()
+    targ_values = targ[:, :, channel].flatten()
+    for s, t in zip(src_values, targ_values):
+        samples.setdefault(s, []).append(t)
+    value_map = {vmin: vmin, vmax: vmax}
+    for s, tvals in samples.items():
+        value_map[s] = np.mean(tvals)
+    ordered_src = sorted(value_map.keys())
+    return ordered_src, [value_map[s] for s in ordered_src]
+
+
+def _timed(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+def main():
+    """Mainline for standalone execution."""
+    rng = np.random.default_rng(0)
+    # Navcam tiles are 1288 x 968; overlaps are ~16 pixels wide.
+    # Full-res Navcam frames are 5120 x 3840.
+    for rows, cols in [(968, 16), (1288, 16), (3840, 32), (5120, 64)]:
+        shape = (rows, cols, 3)
+        # Lab L values from 8-bit sources take on relatively few values.
+        src = np.round(rng.uniform(0.0, 100.0, shape), 2)
+        targ = src * 0.9 + rng.normal(0.0, 1.0, shape)
+
+        t_loop = _timed(_loop_curve, src, targ, 0, 0.0, 100.0)
+        t_vec = _timed(ChannelAdjuster, src, targ, 0, 0.0, 100.0)
+        print(
+            f"{rows:5d} x {cols:3d}: loop {t_loop * 1000.0:9.2f} ms, "
+            f"numpy {t_vec * 1000.0:8.2f} ms, "
+            f"speedup {t_loop / t_vec:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Compare bayer_to_rgb with the dtype-preserving demosaic functions.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from pathlib import Path
+import time
+
+from skimage import io
+
+from band_finder.bayer_to_rgb import bayer_to_rgb, demosaic, demosaic_all
+
+
+def _timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+def main():
+    """Mainline for standalone execution."""
+    data_dir = Path(__file__).resolve().parent.parent / "tests" / "data"
+    raws = [io.imread(path) for path in sorted(data_dir.rglob("*.png"))]
+    # A panorama's worth of tiles.
+    raws = (raws * 10)[:40]
+    print(f"{len(raws)} readouts of shape {raws[0].shape}")
+
+    t = _timed(lambda: [bayer_to_rgb(raw) for raw in raws])
+    print(f"bayer_to_rgb:            {t:6.3f} s")
+    for algorithm in ["bilinear", "edge_aware", "vng"]:
+        t = _timed(lambda: [demosaic(raw, algorithm) for raw in raws])
+        print(f"demosaic {algorithm:15s} {t:6.3f} s")
+    for workers in [2, 4]:
+        t = _timed(demosaic_all, raws, max_workers=workers)
+        print(f"demosaic_all, {workers} threads: {t:6.3f} s")
+
+
+if __name__ == "__main__":
+    main()
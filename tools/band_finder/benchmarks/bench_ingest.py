@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Time ImageDB ingestion of synthetic RSS feed records.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from pathlib import Path
+import tempfile
+import time
+
+from band_finder.image_db import ImageDB
+
+
+def gen_records(count):
+    """Generate synthetic records shaped like RSS feed "images" entries."""
+    for i in range(count):
+        yield {
+            "imageid": f"NLF_{i:07d}_ECM_N0000000NCAM00000_01_095J",
+            "sol": i // 1000,
+            "credit": "NASA/JPL-Caltech",
+            "caption": "A synthetic image.",
+            "title": f"Mars Perseverance Sol {i // 1000}: Left Navigation",
+            "camera": {
+                "instrument": "NAVCAM_LEFT",
+                "filter_name": "UNK",
+                "camera_model_component_list": "2.0;0.0;(46.1,0.0,0.0)",
+                "camera_model_type": "CAHVORE",
+                "camera_position": "(1.2,0.1,-1.9)",
+            },
+            "sample_type": "Full",
+            "json_link": f"https://example.invalid/{i}.json",
+            "image_files": {"full_res": f"https://example.invalid/{i}.png"},
+            "attitude": "(0.1,0.2,0.3,0.4)",
+            "drive": "1234",
+            "site": "5",
+            "date_taken_utc": "2021-03-01T12:34:56.789",
+            "extended": {
+                "mastAz": "155.5",
+                "mastEl": "-10.2",
+                "sclk": f"{667000000 + i}.5",
+                "scaleFactor": "1",
+                "xyz": "(1.0,2.0,3.0)",
+                "dimension": "(1288,968)",
+                "subframeRect": "(1,1,1288,968)",
+            },
+        }
+
+
+def main():
+    """Mainline for standalone execution."""
+    num_records = 100_000
+    page_size = 1000
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        # Page at a time, as populate_db.py ingests.
+        db = ImageDB(tmp / "paged.db")
+        records = list(gen_records(num_records))
+        t0 = time.perf_counter()
+        for i in range(0, num_records, page_size):
+            db.add_or_update(records[i:i + page_size])
+        dt = time.perf_counter() - t0
+        print(f"add_or_update by page: {num_records / dt:10.0f} records/s")
+
+        db = ImageDB(tmp / "bulk.db")
+        stats = db.bulk_ingest(records)
+        print(f"bulk_ingest:           {stats.rate:10.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Compare grouping candidate panorama tiles into sets in Python with
+grouping them in SQLite.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from pathlib import Path
+import tempfile
+import time
+
+from band_finder.image_db import ImageDB
+from bench_ingest import gen_records
+
+CAMERAS = ["NAVCAM_LEFT", "NAVCAM_RIGHT", "MCZ_LEFT", "MCZ_RIGHT"]
+
+
+def gen_tile_records(count):
+    """Generate raw-readout records in 16-tile sets, across cameras."""
+    for i, rec in enumerate(gen_records(count)):
+        rec["imageid"] = rec["imageid"].replace("NLF_", "NLE_", 1)
+        rec["camera"]["instrument"] = CAMERAS[(i // 16) % len(CAMERAS)]
+        rec["extended"]["sclk"] = f"{667000000 + i // 16}.5"
+        yield rec
+
+
+def python_sets(db, camera):
+    # The original approach: a dict per row, grouped in Python.
+    prev_sclk = None
+    curr_set = []
+    for row in db.pano_tiles_for_camera(camera):
+        record = dict((key, row[key]) for key in row.keys())
+        sclk = record["ext_sclk"]
+        if sclk != prev_sclk:
+            if len(curr_set) > 1:
+                yield curr_set
+            curr_set = []
+            prev_sclk = sclk
+        curr_set.append(record)
+    if len(curr_set) > 1:
+        yield curr_set
+
+
+def main():
+    """Mainline for standalone execution."""
+    num_records = 200_000
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ImageDB(Path(tmp) / "images.db")
+        db.bulk_ingest(gen_tile_records(num_records))
+
+        t0 = time.perf_counter()
+        num_sets = sum(
+            len(list(python_sets(db, camera))) for camera in db.cameras()
+        )
+        print(f"Python, per camera: {time.perf_counter() - t0:6.3f} s")
+
+        t0 = time.perf_counter()
+        sql_sets = sum(
+            len(db.pano_sets_for_camera(camera)) for camera in db.cameras()
+        )
+        print(f"SQL, per camera:    {time.perf_counter() - t0:6.3f} s")
+
+        t0 = time.perf_counter()
+        all_sets = len(db.pano_sets())
+        print(f"SQL, all cameras:   {time.perf_counter() - t0:6.3f} s")
+        assert num_sets == sql_sets == all_sets, (num_sets, sql_sets, all_sets)
+        print(f"{num_sets} sets of {num_records} tiles")
+
+
+if __name__ == "__main__":
+    main()
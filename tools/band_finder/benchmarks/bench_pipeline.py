@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Compare serial tile processing with a Pipeline that overlaps simulated
+downloads with demosaicing and Lab conversion.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+import time
+
+import numpy as np
+
+from band_finder.bayer_to_rgb import demosaic
+from band_finder.lab_strips import rgb_to_lab
+from band_finder.pipeline import Pipeline, Stage
+
+# Simulated per-tile download latency, in seconds.
+LATENCY = 0.05
+
+
+def fetch(raw):
+    time.sleep(LATENCY)
+    return raw
+
+
+def to_lab(raw):
+    return rgb_to_lab(demosaic(raw))
+
+
+def main():
+    """Mainline for standalone execution."""
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 256, size=(968, 1288), dtype=np.uint8)
+    num_tiles = 24
+
+    t0 = time.perf_counter()
+    for _ in range(num_tiles):
+        to_lab(fetch(raw))
+    print(f"Serial:              {time.perf_counter() - t0:6.3f} s")
+
+    for fetch_workers, cpu_workers in [(1, 1), (4, 1), (4, 2), (8, 4)]:
+        pipeline = Pipeline(
+            [
+                Stage("fetch", fetch, fetch_workers),
+                Stage("lab", to_lab, cpu_workers),
+            ]
+        )
+        t0 = time.perf_counter()
+        for _ in pipeline.run(raw for _ in range(num_tiles)):
+            pass
+        dt = time.perf_counter() - t0
+        busy = ", ".join(
+            f"{s.name} {s.seconds:.2f} s" for s in pipeline.stats()
+        )
+        print(
+            f"Pipeline {fetch_workers} fetch, {cpu_workers} cpu: "
+            f"{dt:6.3f} s ({busy})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Measure ImageCache.prefetch throughput against a local, deliberately
+slow stand-in image server.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from band_finder.image_cache import ImageCache
+from band_finder.image_db import ImageDB
+from bench_ingest import gen_records
+
+# Simulated per-request latency, in seconds.
+LATENCY = 0.05
+IMAGE_BYTES = np.random.default_rng(0).bytes(256 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(LATENCY)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(IMAGE_BYTES)))
+        self.end_headers()
+        self.wfile.write(IMAGE_BYTES)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    """Mainline for standalone execution."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    host, port = httpd.server_address
+
+    num_images = 64
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        records = list(gen_records(num_images))
+        for rec in records:
+            rec["image_files"]["full_res"] = (
+                f"http://{host}:{port}/{rec['imageid']}.png"
+            )
+        db = ImageDB(tmp / "images.db")
+        db.add_or_update(records)
+        image_ids = [rec["imageid"] for rec in records]
+
+        for workers in [1, 2, 4, 8, 16]:
+            cache = ImageCache(
+                db, cache_dir=tmp / f"cache_{workers}", max_workers=workers
+            )
+            t0 = time.perf_counter()
+            failures = sum(not r.ok() for r in cache.prefetch(image_ids))
+            dt = time.perf_counter() - t0
+            print(
+                f"{workers:2d} workers: {num_images / dt:7.1f} images/s"
+                f" ({failures} failures)"
+            )
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
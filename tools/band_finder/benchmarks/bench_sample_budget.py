@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Measure ImageMatcher fit time, and accuracy lost, when fitting to a
+limited budget of strided overlap samples.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+import time
+
+import numpy as np
+from skimage import color
+
+from band_finder.image_matcher import ImageMatcher
+
+
+def make_overlap(rng, rows, cols):
+    """Make Lab overlap samples of an 8-bit RGB scene, as seen by two
+    tiles with slightly different tone curves."""
+    rgb = rng.integers(0, 256, (rows, cols, 3), dtype=np.uint8)
+    src = color.rgb2lab(rgb)
+    gamma = (rgb / 255.0) ** 0.9
+    targ = color.rgb2lab(gamma)
+    return src, targ
+
+
+def main():
+    """Mainline for standalone execution."""
+    rng = np.random.default_rng(0)
+    # A full-resolution tile to adjust, to measure what the budget costs.
+    tile = color.rgb2lab(
+        rng.integers(0, 256, (968, 1288, 3), dtype=np.uint8)
+    )
+    for rows, cols in [(968, 16), (3840, 32), (5120, 64)]:
+        src, targ = make_overlap(rng, rows, cols)
+        t0 = time.perf_counter()
+        full = ImageMatcher(src, targ)
+        t_full = time.perf_counter() - t0
+        reference = full.adjusted(tile)
+        print(f"Overlap {rows} x {cols}: full fit {t_full * 1000.0:7.1f} ms")
+
+        for budget in [16384, 4096, 1024]:
+            t0 = time.perf_counter()
+            matcher = ImageMatcher(src, targ, sample_budget=budget)
+            t_fit = time.perf_counter() - t0
+            diff = np.abs(matcher.adjusted(tile) - reference)
+            print(
+                f"    budget {budget:6d}: fit {t_fit * 1000.0:7.1f} ms, "
+                f"L error mean {diff[..., 0].mean():.3f} "
+                f"max {diff[..., 0].max():.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
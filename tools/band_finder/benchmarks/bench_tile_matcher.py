@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compare serial and concurrent TileMatcher compositing of wide panoramas.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+import os
+import time
+
+import numpy as np
+
+from band_finder.tile_matcher import TileMatcher
+
+
+def make_tiles(rows, cols, h=480, w=640, overlap=16, seed=0):
+    """Make overlapping, unevenly-lit Lab-like tiles of a random scene."""
+    rng = np.random.default_rng(seed)
+    tiles = {}
+    for iy in range(rows):
+        for ix in range(cols):
+            tile = np.round(rng.uniform(0.0, 100.0, (h, w, 3)), 1)
+            tiles[(ix * (w - overlap), iy * (h - overlap))] = tile * (
+                rng.uniform(0.8, 1.2)
+            )
+    return tiles
+
+
+def time_composite(tiles, max_workers):
+    matcher = TileMatcher("bench", max_workers=max_workers)
+    for origin, tile in tiles.items():
+        matcher.add(tile, origin)
+    t0 = time.perf_counter()
+    result = matcher.composite()
+    return time.perf_counter() - t0, result
+
+
+def main():
+    """Mainline for standalone execution."""
+    print(f"{os.cpu_count()} CPUs")
+    for rows, cols in [(1, 16), (3, 16), (4, 24)]:
+        tiles = make_tiles(rows, cols)
+        t_serial, expected = time_composite(tiles, None)
+        print(f"{rows} x {cols} tiles: serial {t_serial:6.2f} s")
+        for workers in [2, 4, 8]:
+            t, actual = time_composite(tiles, workers)
+            same = actual.tobytes() == expected.tobytes()
+            print(
+                f"    {workers} workers: {t:6.2f} s, "
+                f"speedup {t_serial / t:4.2f}x, identical: {same}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,12 @@ def main():
     db = ImageDB()
     cache = ImageCache(db)
     query = "SELECT image_id FROM Images where image_id like '__F%'"
-    for row in db.cursor().execute(query):
-        image_id = row[0]
-        print(image_id)
-        cache.get_image(image_id)
+    image_ids = [row[0] for row in db.cursor().execute(query)]
+    for result in cache.prefetch(image_ids):
+        if result.ok():
+            print(result.image_id)
+        else:
+            print(f"{result.image_id}: {result.error}")
 
 
 if __name__ == "__main__":
@@ -4,19 +4,32 @@ Suss out how to identify NAVCAM images that constitute
 a panorama.
 """
 
-from concurrent.futures import ProcessPoolExecutor
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
 from pathlib import Path
 import re
+import time
 import traceback
 
-import numpy as np
-from skimage import io, color
-from skimage.util import img_as_ubyte
+from skimage import io
 
+from band_finder.build_manifest import BuildManifest
 from band_finder.image_db import ImageDB
 from band_finder.image_cache import ImageCache
+from band_finder.job_queue import JobQueue
 from band_finder.tile_matcher import TileMatcher
-from band_finder.bayer_to_rgb import bayer_to_rgb
+from band_finder.bayer_to_rgb import demosaic
+from band_finder.lab_strips import rgb_to_lab, lab_to_rgb_ubyte
+from band_finder.pipeline import Pipeline, Stage
+
+# Change this whenever a change to stitching changes its output, so
+# that existing panoramas are rebuilt.
+ALGORITHM_VERSION = "2"
+
+# The job queue of panoramas to build.
+PANO_QUEUE = "panoramas"
 
 
 class PanoImageInfo:
@@ -39,8 +52,21 @@ class PanoImageSet:
             result.add_record(rec)
         return result
 
+    @classmethod
+    def from_pano_set(cls, pano_set):
+        """Create an instance from an image_db.PanoSet."""
+        result = cls()
+        result._camera = pano_set.camera
+        result._drive = pano_set.drive
+        result._site = pano_set.site
+        result._sclk = pano_set.ext_sclk
+        result._name = f"pano_{result._drive}_{result._site}_{result._sclk}"
+        result._records = pano_set.tiles
+        return result
+
     def __init__(self):
         self._name = "pano_empty"
+        self._camera = None
         self._drive = None
         self._site = None
         self._sclk = None
@@ -54,17 +80,34 @@ class PanoImageSet:
             self._name = f"pano_{drive}_{site}_{sclk}"
         self._records.append(rec)
 
-    def gen_images(self, image_cache):
-        for rec in self._records:
+    def image_ids(self):
+        return [rec["image_id"] for rec in self._records]
+
+    def gen_images(self, image_cache, max_workers=None, window=None):
+        """Generate a PanoImageInfo for each image in self, in order.
+
+        The images are looked up in one batch and fetched concurrently.
+
+        Args:
+            image_cache (ImageCache): the cache to get images from
+            max_workers (int): number of concurrent downloads
+            window (int): most images to load ahead of the caller
+        """
+        image_ids = self.image_ids()
+        images = image_cache.get_images(
+            image_ids, max_workers=max_workers, window=window
+        )
+        for rec, (image_id, image) in zip(self._records, images):
             # Metadata origin is at (1, 1).
-            image_id = rec["image_id"]
-            image = image_cache.get_image(image_id)
             rect = self._get_rect(rec)
             yield PanoImageInfo(image_id, image, rect)
 
     def name(self):
         return self._name
 
+    def camera(self):
+        return self._camera
+
     def rect(self):
         x0 = y0 = xf = yf = 0
         for rec in self._records:
@@ -84,10 +127,37 @@ class PanoImageSet:
 class PanoStitcher:
     """
     PanoStitcher stitches a single PanoImageSet.
+
+    Each set's tiles are looked up in one batch, then fetched and
+    decoded concurrently while a demosaic+Lab stage converts them, so
+    downloads overlap with CPU work.  Bounded queues limit how many
+    tiles are in flight at once.
     """
-    def __init__(self):
-        self._db = ImageDB()
-        self._cache = ImageCache(self._db)
+    def __init__(
+        self,
+        db=None,
+        cache=None,
+        fetch_workers=4,
+        cpu_workers=None,
+        queue_size=4,
+    ):
+        """Initialize a new instance.
+
+        Args:
+            db (ImageDB): image metadata; defaults to a new ImageDB
+            cache (ImageCache): the image cache to use; defaults to a new
+                                one for db
+            fetch_workers (int): number of concurrent downloads and
+                                 decodes
+            cpu_workers (int): number of threads for the demosaic+Lab
+                               stage; defaults to the number of CPUs
+            queue_size (int): capacity of the queue between stages
+        """
+        self._db = db or ImageDB()
+        self._cache = cache or ImageCache(self._db, max_workers=fetch_workers)
+        self._fetch_workers = fetch_workers
+        self._cpu_workers = cpu_workers or os.cpu_count() or 1
+        self._queue_size = queue_size
 
     def build_image(self, image_set):
         """Build a panoramic image from a set of image tiles.
@@ -98,48 +168,48 @@ class PanoStitcher:
         Returns:
             np.array: The panorama image
         """
-        pano_tiles = list(image_set.gen_images(self._cache))
+        pipeline = Pipeline(
+            [
+                Stage("lab", self._to_lab, self._cpu_workers),
+            ],
+            self._queue_size,
+        )
 
         matcher = TileMatcher(image_set.name())
-        # is_bayer = False
-        for rec in pano_tiles:
-            bmsg = "(bayer)" if rec.is_bayer else ""
+        # Grid insertion consumes the pipeline's output.  TileMatcher
+        # is not thread-safe, so it is a single-worker stage.
+        tiles = image_set.gen_images(
+            self._cache, self._fetch_workers, self._queue_size
+        )
+        for rec in pipeline.run(tiles):
+            bmsg = "(bayer)" if rec.is_bayer() else ""
             print(f"Tile {rec.image_id} {rec.rect} {bmsg}")
-            image = bayer_to_rgb(rec.image) if rec.is_bayer() else rec.image
-            # Work in Lab color.
-            image = color.rgb2lab(image)
-            matcher.add(image, origin=rec.rect[:2])
+            matcher.add(rec.image, origin=rec.rect[:2])
+            rec.image = None
 
-        composite = matcher.composite()
-        result = img_as_ubyte(color.lab2rgb(self._rescaled(composite)))
-        return result
+        composite = matcher.composite(release_tiles=True)
+        # Rescale to fit within the Lab colorspace, and convert back.
+        return lab_to_rgb_ubyte(composite)
 
-    def _rescaled(self, image):
-        # Rescale image data as necessary to fit within the Lab
-        # colorspace.
-        result = image.copy()
-        # From one of the scikit-image maintainers (I think):
-        # https://stackoverflow.com/a/28048090
-        # https://github.com/scikit-image/scikit-image/issues/1185
-        for chan, cmin, cmax, stretch in [
-            [0, 0.0, 100.0, True],
-            [1, -127.0, 128.0, False],
-            [2, -128.0, 127.0, False],
-        ]:
-            self._rescale_channel(result, chan, cmin, cmax, stretch)
-        return result
+    def build_image_for_ids(self, image_ids):
+        """Build a panoramic image from tiles identified by image ID.
+
+        Args:
+            image_ids: the IDs of the images to stitch together
 
-    def _rescale_channel(self, image, channel, min_valid, max_valid, stretch):
-        values = image[:, :, channel]
-        max_in = np.max(values)
-        min_in = np.min(values)
+        Returns:
+            np.array: The panorama image
+        """
+        records = self._db.pano_tiles(image_ids)
+        if not records:
+            raise LookupError("None of the images is a known panorama tile")
+        return self.build_image(PanoImageSet.from_records(records))
 
-        if stretch or ((max_in > max_valid) or (min_in < min_valid)):
-            d_in = max_in - min_in
-            d_out = max_valid - min_valid
-            scale = d_out / d_in
-            values = (values - min_in) * scale + min_valid
-            image[:, :, channel] = values
+    def _to_lab(self, rec):
+        image = demosaic(rec.image) if rec.is_bayer() else rec.image
+        # Work in Lab color.
+        rec.image = rgb_to_lab(image)
+        return rec
 
 
 class PanoFinder:
@@ -148,67 +218,167 @@ class PanoFinder:
     def __init__(self, db):
         self._db = db
 
-    def _gen_cam_images(self, which_cam):
-        query = """
-        SELECT
-          site, drive, ext_sclk,
-          ext_sf_left x, ext_sf_top y,
-          ext_sf_width w, ext_sf_height h,
-          image_id
-        FROM Images
-        WHERE cam_instrument = ?
-          AND sample_type = 'Full'
-          AND image_id LIKE '__E%'
-          AND ext_scale_factor = 1.0
-          AND x NOT NULL
-          AND y NOT NULL
-          AND w NOT NULL
-          and h NOT NULL
-        ORDER BY site, drive, ext_sclk, image_id
+    def image_sets(self, which_cam=None):
+        """Find candidate panoramas.  The database does the grouping.
+
+        Args:
+            which_cam (str): the camera; if None, find panoramas for all
+                             cameras in one query
+
+        Returns:
+            list: a PanoImageSet for each candidate
         """
-        for row in self._db.cursor().execute(query, (which_cam,)):
-            result = dict((key, row[key]) for key in row.keys())
-            # result['cam_position'] = to_tuple(row['cam_position'])
-            # result['attitude'] = to_tuple(row['attitude'])
-            # result['date_taken_utc'] = row['date_taken_utc'].isoformat()
-            yield result
-
-    def gen_image_sets(self, which_cam):
-        prev_sclk = None
-        curr_set = []
-        for record in self._gen_cam_images(which_cam):
-            sclk = record["ext_sclk"]
-            if sclk != prev_sclk:
-                if len(curr_set) > 1:
-                    yield curr_set
-                curr_set = []
-                prev_sclk = sclk
-            curr_set.append(record)
-        if len(curr_set) > 1:
-            yield curr_set
-
-
-def stitch_set(args):
+        if which_cam is None:
+            pano_sets = self._db.pano_sets()
+        else:
+            pano_sets = self._db.pano_sets_for_camera(which_cam)
+        return [PanoImageSet.from_pano_set(ps) for ps in pano_sets]
+
+    def queue_image_sets(
+        self, job_queue, which_cam=None, skip=None, reset=False
+    ):
+        """Add image sets to a queue of panoramas to build.
+
+        Args:
+            job_queue (JobQueue): the queue
+            which_cam (str): the camera; if None, all cameras
+            skip: If provided, a callable(name, image_ids) that returns
+                  True for sets that need not be built
+            reset (bool): whether to rebuild sets that were already built
+
+        Returns:
+            int: the number of sets that became pending
+        """
+        jobs = []
+        for image_set in self.image_sets(which_cam):
+            name = f"{image_set.name()}_{image_set.camera()}"
+            image_ids = image_set.image_ids()
+            if skip is None or not skip(name, image_ids):
+                jobs.append((name, {"image_ids": image_ids}))
+        return job_queue.put(jobs, reset=reset)
+
+
+class StitchJob(namedtuple("StitchJob", "name image_ids outdir")):
+    """A panorama to build: its name, the IDs of its tiles, and the
+    directory in which to save it.  Cheap to send to a worker process."""
+
+
+class StitchResult(
+    namedtuple("StitchResult", "name status seconds path error")
+):
+    """The outcome of a StitchJob.
+
+    status is "done", "skipped" (already up to date) or "failed".  path
+    is the saved panorama, or None on failure; error then describes what
+    went wrong.
+    """
+
+    def ok(self):
+        return self.status in ("done", "skipped")
+
+
+class WorkerContext(namedtuple("WorkerContext", "db cache stitcher")):
+    """A worker process's database connection, image cache (with its
+    in-memory LRU) and stitcher, reused for every job it runs."""
+
+
+_worker = None
+
+
+def init_worker(
+    db_path=None, cache_dir=None, memory_limit=None, cpu_workers=1
+):
+    """Set up the stitching context for a worker process.
+
+    Intended as the initializer of a ProcessPoolExecutor.
+
+    Args:
+        db_path (pathlib.Path): the image database; defaults to ImageDB's
+        cache_dir (pathlib.Path): the image cache; defaults to ImageCache's
+        memory_limit (int): bytes of decoded images to keep in memory
+        cpu_workers (int): decode and Lab threads per worker.  The pool
+                           already has a process per CPU, so by default
+                           each worker uses one thread per stage.
+    """
+    global _worker
+    db = ImageDB(db_path)
+    cache = ImageCache(db, cache_dir=cache_dir, memory_limit=memory_limit)
+    stitcher = PanoStitcher(db, cache, cpu_workers=cpu_workers)
+    _worker = WorkerContext(db, cache, stitcher)
+
+
+def _worker_context():
+    if _worker is None:
+        init_worker()
+    return _worker
+
+
+def stitch_set(job):
     """
     Stitch an image set.
     This is intended for use with multiprocessing, or with a
-    concurrent.futures Exector.
+    concurrent.futures Exector whose initializer is init_worker.
 
     Args:
-        args: a tuple of (image set, camera name, output directory)
+        job (StitchJob): the panorama to build
+
+    Returns:
+        StitchResult: the outcome
     """
+    t0 = time.perf_counter()
     try:
-        image_set, cam, outdir = args
-        full_name = f"{image_set.name()}_{cam}"
-
-        print("Building", full_name)
-
-        stitcher = PanoStitcher()
-        pano = stitcher.build_image(image_set)
-        io.imsave(outdir / f"{full_name}.png", pano)
+        print("Building", job.name)
+        stitcher = _worker_context().stitcher
+        pano = stitcher.build_image_for_ids(job.image_ids)
+        path = Path(job.outdir) / f"{job.name}.png"
+        io.imsave(path, pano)
+        return StitchResult(
+            job.name, "done", time.perf_counter() - t0, path, None
+        )
     except Exception as info:
         traceback.print_exc()
         print(f"Failed stitching set: {info}")
+        # Report the error as text; not every exception can be pickled.
+        return StitchResult(
+            job.name, "failed", time.perf_counter() - t0, None, repr(info)
+        )
+
+
+def work_queue(outdir=Path("panoramas"), lease_seconds=600.0):
+    """
+    Claim and build queued panoramas until none is left.
+    This is intended to run in a worker process set up by init_worker,
+    on any host that shares the image database.
+
+    Args:
+        outdir (pathlib.Path): where to save the panoramas
+        lease_seconds (float): how long another worker waits before
+                               taking over a job from a worker that
+                               appears to have died
+
+    Returns:
+        list: a StitchResult for each job this worker ran
+    """
+    context = _worker_context()
+    job_queue = JobQueue(context.db, PANO_QUEUE, lease_seconds)
+    manifest = BuildManifest(context.db, context.cache, ALGORITHM_VERSION)
+    Path(outdir).mkdir(exist_ok=True, parents=True)
+
+    results = []
+    for claimed in job_queue.gen_claimed():
+        image_ids = claimed.payload["image_ids"]
+        with job_queue.heartbeat(claimed):
+            result = stitch_set(StitchJob(claimed.name, image_ids, outdir))
+        if result.ok():
+            manifest.record(result.path, image_ids)
+            job_queue.complete(
+                claimed, {"path": str(result.path), "seconds": result.seconds}
+            )
+        else:
+            job_queue.fail(claimed, result.error)
+        print(f"{result.status:6s} {result.name} ({result.seconds:.1f} s)")
+        results.append(result)
+    return results
 
 
 class CamPanoStitcher:
@@ -220,38 +390,192 @@ class CamPanoStitcher:
     color components or full raster readouts.
     """
 
-    def __init__(self, db, which_cam):
+    def __init__(
+        self, db, which_cam, executor=None, cache=None, force=False
+    ):
+        """Initialize a new instance.
+
+        Args:
+            db (ImageDB): image metadata
+            which_cam (str): the camera whose panoramas to build
+            executor (concurrent.futures.Executor): If provided, runs
+                stitch_set jobs; its workers should be set up by
+                init_worker.  Otherwise each call to gen_results uses a
+                new process pool.
+            cache (ImageCache): the cache the workers use; defaults to
+                                the default ImageCache for db
+            force (bool): If True, rebuild panoramas even if they are
+                          up to date.
+        """
         self._db = db
         self._which_cam = which_cam
         self._finder = PanoFinder(db)
-        self._cache = ImageCache(db)
+        self._executor = executor
+        self._manifest = BuildManifest(
+            db, cache or ImageCache(db), ALGORITHM_VERSION
+        )
+        self._force = force
 
     def _get_pano_image_sets(self):
-        return [
-            PanoImageSet.from_records(recs)
-            for recs in self._finder.gen_image_sets(self._which_cam)
-        ]
+        return self._finder.image_sets(self._which_cam)
 
-    def build_all(self):
-        outdir = Path("panoramas")
+    def gen_results(self, outdir=Path("panoramas")):
+        """Build all of the camera's panoramas that are not up to date.
+
+        Args:
+            outdir (pathlib.Path): where to save the panoramas
+
+        Yields:
+            StitchResult: the outcome of each job -- skipped jobs first,
+            then the others as they complete
+        """
         outdir.mkdir(exist_ok=True, parents=True)
 
         cam = self._which_cam
-        image_sets = self._get_pano_image_sets()
+        jobs = []
+        for image_set in self._get_pano_image_sets():
+            job = StitchJob(
+                f"{image_set.name()}_{cam}", image_set.image_ids(), outdir
+            )
+            path = outdir / f"{job.name}.png"
+            if not self._force and self._manifest.is_current(
+                path, job.image_ids
+            ):
+                yield StitchResult(job.name, "skipped", 0.0, path, None)
+            else:
+                jobs.append(job)
+        print("Number of image sets to build:", len(jobs))
+        if not jobs:
+            return
+
+        executor = self._executor
+        if executor is None:
+            executor = ProcessPoolExecutor(
+                initializer=init_worker, initargs=(self._db.db_path,)
+            )
+        try:
+            futures = {executor.submit(stitch_set, job): job for job in jobs}
+            for future in as_completed(futures):
+                result = future.result()
+                if result.ok():
+                    # The tiles are now cached, so their digests are known.
+                    image_ids = futures[future].image_ids
+                    self._manifest.record(result.path, image_ids)
+                yield result
+        finally:
+            if self._executor is None:
+                executor.shutdown(cancel_futures=True)
+
+    def build_all(self):
+        """Build all of the camera's panoramas.
 
-        args = [(image_set, cam, outdir) for image_set in image_sets]
-        print("Number of image sets:", len(args))
-        with ProcessPoolExecutor() as executor:
-            executor.map(stitch_set, args)
+        Returns:
+            list: a StitchResult for each panorama
+        """
+        results = []
+        for result in self.gen_results():
+            results.append(result)
+            if result.status == "skipped":
+                continue
+            detail = result.path if result.ok() else result.error
+            print(
+                f"{result.status:6s} {result.name} "
+                f"({result.seconds:.1f} s): {detail}"
+            )
         print("Done processing image sets.")
+        return results
+
+
+def run_queue(db, cache, args):
+    """Fill and/or work the panorama job queue, as the command-line
+    arguments direct."""
+    job_queue = JobQueue(db, PANO_QUEUE)
+    if args.enqueue:
+        manifest = BuildManifest(db, cache, ALGORITHM_VERSION)
+        outdir = Path("panoramas")
+
+        def is_current(name, image_ids):
+            path = outdir / f"{name}.png"
+            return manifest.is_current(path, image_ids)
+
+        # One query plans the whole mission.
+        queued = PanoFinder(db).queue_image_sets(
+            job_queue,
+            skip=None if args.force else is_current,
+            reset=args.force,
+        )
+        print(f"Queued {queued} panoramas")
+
+    if args.work:
+        with ProcessPoolExecutor(
+            args.workers,
+            initializer=init_worker,
+            initargs=(db.db_path, None, 256 * 1024 * 1024),
+        ) as executor:
+            futures = [
+                executor.submit(work_queue) for _ in range(args.workers)
+            ]
+            for future in as_completed(futures):
+                future.result()
+    print("Job queue:", job_queue.counts())
 
 
 def main():
     """Mainline for standalone execution."""
+    parser = argparse.ArgumentParser(
+        description="Stitch panoramas from cached images."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild all panoramas, even those that are up to date.",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Add the panoramas to build to the job queue in the database.",
+    )
+    parser.add_argument(
+        "--work",
+        action="store_true",
+        help="Build queued panoramas until the queue is empty.  Run this "
+        "on as many hosts as share the database.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes (default: number of CPUs).",
+    )
+    args = parser.parse_args()
+
     db = ImageDB()
-    for cam in db.cameras():
-        cam_stitcher = CamPanoStitcher(db, cam)
-        cam_stitcher.build_all()
+    cache = ImageCache(db)
+    if args.enqueue or args.work:
+        run_queue(db, cache, args)
+        return
+
+    # One pool for all cameras, so each worker's context stays warm.
+    with ProcessPoolExecutor(
+        args.workers,
+        initializer=init_worker,
+        initargs=(db.db_path, None, 256 * 1024 * 1024),
+    ) as executor:
+        results = []
+        for cam in db.cameras():
+            cam_stitcher = CamPanoStitcher(
+                db, cam, executor, cache=cache, force=args.force
+            )
+            results.extend(cam_stitcher.build_all())
+    failed = [result.name for result in results if not result.ok()]
+    skipped = [result for result in results if result.status == "skipped"]
+    built = len(results) - len(failed) - len(skipped)
+    print(
+        f"Built {built} of {len(results)} panoramas; "
+        f"{len(skipped)} were up to date."
+    )
+    if failed:
+        print("Failed:", ", ".join(failed))
 
 
 if __name__ == "__main__":
@@ -17,13 +17,16 @@ def main():
 
     query = (
         "SELECT image_id FROM Images"
-        " WHERE camera_filter LIKE '%RGB%'"
+        " WHERE cam_filter LIKE '%RGB%'"
         " AND sample_type = 'Full'"
     )
     cursor = db.cursor()
-    for row in cursor.execute(query):
-        print("Caching", row["image_id"])
-        cache.get_image(row["image_id"])
+    image_ids = [row["image_id"] for row in cursor.execute(query)]
+    for result in cache.prefetch(image_ids):
+        if result.ok():
+            print("Cached", result.image_id)
+        else:
+            print(f"Failed to cache {result.image_id}: {result.error}")
 
 
 if __name__ == "__main__":
@@ -3,24 +3,29 @@
 Create or update an image database in the current working dir.
 """
 
-from band_finder.rss_feed import get_rqst_params, get_img_metadata
+import argparse
+import logging
+
+from band_finder.rss_feed import FeedHarvester
 from band_finder.image_db import ImageDB
 
 
 def main():
     """Mainline for standalone execution."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-read the entire feed, not just what's new since last time",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
     db = ImageDB()
 
-    page = 1
-    while True:
-        params = get_rqst_params(page=page, num=1000)
-        json_info = get_img_metadata(params)
-        records = json_info["images"]
-        if not records:
-            break
-        db.add_or_update(records)
-        print(f"Page {page}: added {len(records)} records.")
-        page += 1
+    harvester = FeedHarvester(max_workers=8)
+    total = harvester.sync(db, num=1000, full=args.full)
+    print(f"Added or updated {total} records.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+array_lru keeps recently used numpy arrays in memory, up to a byte limit.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from collections import OrderedDict, namedtuple
+import threading
+
+
+LRUStats = namedtuple("LRUStats", "hits misses evictions entries nbytes")
+
+
+class ArrayLRU:
+    """
+    ArrayLRU is a thread-safe least-recently-used cache of numpy arrays,
+    bounded by the total size of the arrays it holds.
+    """
+
+    def __init__(self, max_bytes):
+        """Initialize a new instance.
+
+        Args:
+            max_bytes (int): The most array data to hold at once
+        """
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._hits = self._misses = self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached array.
+
+        Args:
+            key: The array's key
+
+        Returns:
+            array: the cached array, or None
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, array):
+        """Cache an array, evicting least recently used arrays as needed.
+
+        Arrays larger than the cache's byte limit are not cached.
+
+        Args:
+            key: The array's key
+            array: The array to cache
+        """
+        if array.nbytes > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            self._entries[key] = array
+            self._nbytes += array.nbytes
+            while self._nbytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self._evictions += 1
+
+    def discard(self, key):
+        """Remove an array from the cache, if present."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+
+    def stats(self):
+        """Get usage statistics.
+
+        Returns:
+            LRUStats: (hits, misses, evictions, entries, nbytes)
+        """
+        with self._lock:
+            return LRUStats(
+                self._hits,
+                self._misses,
+                self._evictions,
+                len(self._entries),
+                self._nbytes,
+            )
@@ -4,11 +4,24 @@ bayer_to_rgb de-mosaics full sensor readouts to RGB images.
 Copyright 2021, Mitch Chapman  All rights reserved
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import cv2
+import numpy as np
 from skimage import color
 from skimage.util import img_as_uint, img_as_ubyte
 
 
+# OpenCV demosaicing algorithms, by name.
+# "vng" (variable number of gradients) supports only 8-bit readouts.
+ALGORITHMS = {
+    "bilinear": cv2.COLOR_BAYER_BG2RGB,
+    "vng": cv2.COLOR_BAYER_BG2RGB_VNG,
+    "edge_aware": cv2.COLOR_BAYER_BG2RGB_EA,
+}
+
+
 def bayer_to_rgb(full_sensor_image):
     """
     Demosaic a full readout of a sensor that has a Bayer-pattern
@@ -19,5 +32,54 @@ def bayer_to_rgb(full_sensor_image):
     # https://gist.github.com/bbattista/8358ccafecf927ae1c58c944ab470ffb
 
     bayer = img_as_uint(color.rgb2gray(full_sensor_image))
-    demosaic = cv2.cvtColor(bayer, cv2.COLOR_BAYER_BG2RGB)
-    return img_as_ubyte(demosaic)
+    rgb = cv2.cvtColor(bayer, cv2.COLOR_BAYER_BG2RGB)
+    return img_as_ubyte(rgb)
+
+
+def demosaic(raw_readout, algorithm="bilinear"):
+    """
+    Demosaic a raw Bayer-pattern sensor readout as stored, without
+    converting it to float.
+
+    Stored readouts may be single-channel, or may repeat the readout
+    in each of several channels; only the first channel is used.
+
+    Args:
+        raw_readout (array): uint8 or uint16 image data
+        algorithm (str): one of the keys of ALGORITHMS
+
+    Returns:
+        array: RGB image data, of the same dtype as raw_readout
+    """
+    try:
+        code = ALGORITHMS[algorithm]
+    except KeyError:
+        raise ValueError(f"Unknown demosaicing algorithm {algorithm!r}")
+
+    bayer = raw_readout
+    if bayer.ndim == 3:
+        bayer = bayer[:, :, 0]
+    if bayer.dtype not in (np.uint8, np.uint16):
+        raise ValueError(f"Unsupported readout type {bayer.dtype}")
+    if algorithm == "vng" and bayer.dtype != np.uint8:
+        raise ValueError("vng demosaicing supports only 8-bit readouts")
+    return cv2.cvtColor(np.ascontiguousarray(bayer), code)
+
+
+def demosaic_all(raw_readouts, algorithm="bilinear", max_workers=None):
+    """Demosaic several raw readouts concurrently.
+
+    OpenCV releases the GIL while it works, so a thread pool suffices.
+
+    Args:
+        raw_readouts: iterable of raw readout arrays
+        algorithm (str): one of the keys of ALGORITHMS
+        max_workers (int): thread pool size; defaults to
+                           concurrent.futures' choice
+
+    Returns:
+        list: the RGB images, in the order of raw_readouts
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        func = partial(demosaic, algorithm=algorithm)
+        return list(executor.map(func, raw_readouts))
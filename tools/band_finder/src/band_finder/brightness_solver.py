@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+brightness_solver finds per-tile brightness corrections that make
+overlapping tiles agree, all at once.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+# Per-channel statistics of one tile's side of an overlap.
+OverlapStats = namedtuple("OverlapStats", "mean std")
+
+# An overlap between tiles a and b: their indices, and the statistics
+# of each one's overlapping region.
+OverlapEdge = namedtuple("OverlapEdge", "a b stats_a stats_b")
+
+
+def overlap_stats(sample):
+    """Summarize the overlapping region of a tile.
+
+    Args:
+        sample (array): rows x cols x channels image data
+
+    Returns:
+        OverlapStats: per-channel mean and standard deviation
+    """
+    values = sample.reshape(-1, sample.shape[-1])
+    return OverlapStats(values.mean(axis=0), values.std(axis=0))
+
+
+def solve_gain_offset(num_tiles, edges, reference=0, fit_gain=True):
+    """Find a gain and offset, per tile and channel, that make the
+    tiles' overlapping regions agree as nearly as possible.
+
+    Corrected values are gain * value + offset.  The reference tile is
+    left unchanged.  Tiles that no overlap connects to the reference tile
+    are left nearly unchanged.
+
+    Args:
+        num_tiles (int): number of tiles
+        edges: sequence of OverlapEdge
+        reference (int): index of the tile to hold fixed
+        fit_gain (bool): if False, solve only for offsets
+
+    Returns:
+        tuple: (gains, offsets), each a num_tiles x channels array
+    """
+    num_channels = len(edges[0].stats_a.mean) if edges else 1
+    gains = np.ones((num_tiles, num_channels))
+    offsets = np.zeros((num_tiles, num_channels))
+    if not edges:
+        return gains, offsets
+
+    a = np.array([e.a for e in edges])
+    b = np.array([e.b for e in edges])
+    mean_a = np.array([e.stats_a.mean for e in edges])
+    mean_b = np.array([e.stats_b.mean for e in edges])
+
+    if fit_gain:
+        # Match spreads: log(gain_b) - log(gain_a) = log(std_a / std_b).
+        tiny = 1e-9
+        std_a = np.array([e.stats_a.std for e in edges])
+        std_b = np.array([e.stats_b.std for e in edges])
+        usable = (std_a > tiny) & (std_b > tiny)
+        log_ratio = np.log(np.maximum(std_a, tiny) / np.maximum(std_b, tiny))
+        for channel in range(num_channels):
+            rows = usable[:, channel]
+            log_gains = _solve_differences(
+                num_tiles,
+                a[rows],
+                b[rows],
+                log_ratio[rows, channel],
+                reference,
+            )
+            gains[:, channel] = np.exp(log_gains)
+
+    # Then match levels: offset_b - offset_a = gain_a mean_a - gain_b mean_b
+    for channel in range(num_channels):
+        diffs = (
+            gains[a, channel] * mean_a[:, channel]
+            - gains[b, channel] * mean_b[:, channel]
+        )
+        offsets[:, channel] = _solve_differences(
+            num_tiles, a, b, diffs, reference
+        )
+    return gains, offsets
+
+
+def _solve_differences(num_tiles, a, b, diffs, reference, weight=1e-3):
+    # Least-squares solution of x[b] - x[a] = diffs, with x[reference]
+    # pinned at 0 and every x weakly pulled toward 0 (so that tiles
+    # disconnected from the reference stay put).
+    num_edges = len(diffs)
+    coeffs = np.zeros((num_edges + num_tiles + 1, num_tiles))
+    rhs = np.zeros(num_edges + num_tiles + 1)
+
+    rows = np.arange(num_edges)
+    coeffs[rows, b] += 1.0
+    coeffs[rows, a] -= 1.0
+    rhs[:num_edges] = diffs
+
+    coeffs[num_edges:num_edges + num_tiles] = weight * np.eye(num_tiles)
+    coeffs[-1, reference] = 1.0e3
+
+    solution, *_ = np.linalg.lstsq(coeffs, rhs, rcond=None)
+    return solution
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+build_manifest records what each built output, such as a panorama, was
+built from, so that up-to-date outputs need not be rebuilt.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+import hashlib
+from pathlib import Path
+
+
+def build_key(image_ids, fingerprints, version):
+    """Get a digest of the inputs to a build.
+
+    Args:
+        image_ids: the IDs of the images the output is built from
+        fingerprints (dict): {image_id: fingerprint of the image content}
+        version (str): version of the algorithm that builds the output
+
+    Returns:
+        str: hex digest, which changes if the set of images, any image's
+             content, or the version changes
+    """
+    digest = hashlib.sha256(f"version {version}\n".encode())
+    for image_id in sorted(set(image_ids)):
+        fingerprint = fingerprints.get(image_id) or ""
+        digest.update(f"{image_id} {fingerprint}\n".encode())
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """
+    BuildManifest keys each output file by a digest of its member image
+    IDs, their content and an algorithm version.  An output is current
+    if it exists and its recorded key matches the key of its inputs.
+    """
+
+    def __init__(self, db, cache, version):
+        """Initialize a new instance.
+
+        Args:
+            db (image_db.ImageDB): where build keys are recorded
+            cache (image_cache.ImageCache): holds the input images
+            version (str): version of the algorithm that builds outputs;
+                           changing it makes every output stale
+        """
+        self._db = db
+        self._cache = cache
+        self._version = str(version)
+
+    def key(self, image_ids):
+        """Get the build key for an output built from some images."""
+        image_ids = list(image_ids)
+        fingerprints = self._cache.fingerprints(image_ids)
+        return build_key(image_ids, fingerprints, self._version)
+
+    def is_current(self, output_path, image_ids):
+        """Find whether an output is up to date.
+
+        Args:
+            output_path (pathlib.Path): the output file
+            image_ids: the IDs of the images it would be built from
+
+        Returns:
+            bool: True if output_path exists and was built from the same
+                  inputs
+        """
+        output_path = Path(output_path)
+        if not output_path.exists():
+            return False
+        recorded = self._db.build_key(self._output(output_path))
+        return recorded == self.key(image_ids)
+
+    def record(self, output_path, image_ids):
+        """Record that an output has been built.
+
+        Call this after building, once the input images are cached, so
+        that the key reflects their content.
+
+        Args:
+            output_path (pathlib.Path): the output file
+            image_ids: the IDs of the images it was built from
+        """
+        self._db.record_build(
+            self._output(Path(output_path)), self.key(image_ids)
+        )
+
+    def _output(self, output_path):
+        return str(output_path.resolve())
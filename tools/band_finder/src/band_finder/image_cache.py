@@ -4,18 +4,80 @@ image_cache caches Mars Perseverance images locally.
 Copyright 2021, Mitch Chapman  All rights reserved
 """
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import io
+import itertools
+import logging
+import os
 from pathlib import Path
+import re
+import tempfile
+import threading
 
+import numpy as np
 from skimage import io as ski_io
-import requests
+
+from .array_lru import ArrayLRU
+from .bayer_to_rgb import demosaic
+from .rss_feed import pooled_session
+
+
+def logger():
+    return logging.getLogger(__name__)
+
+
+def _resumes_at(headers, offset):
+    # Does a 206 response's Content-Range run from offset to the end?
+    match = re.fullmatch(
+        r"bytes (\d+)-(\d+)/(\d+|\*)", headers.get("Content-Range", "")
+    )
+    if match is None:
+        return False
+    start, end, total = match.groups()
+    if int(start) != offset:
+        return False
+    return total == "*" or int(end) + 1 == int(total)
+
+
+def _file_sha256(path):
+    # Get the hex SHA-256 digest of a file's content.
+    digest = hashlib.sha256()
+    with path.open("rb") as inf:
+        for chunk in iter(lambda: inf.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PrefetchResult(namedtuple("PrefetchResult", "image_id path error")):
+    """The outcome of prefetching one image.
+
+    path is the cached image file, or None if the image could not be
+    retrieved; in that case error holds the exception.
+    """
+
+    def ok(self):
+        return self.error is None
 
 
 class ImageCache:
     # Image cache directory is relative to current working dir.
     _default_cache_dir = Path("image_cache")
+    _chunk_size = 256 * 1024
+    # Cache hits are recorded in the database in batches of this many.
+    _touch_batch = 64
 
-    def __init__(self, db, cache_dir=None):
+    def __init__(
+        self,
+        db,
+        cache_dir=None,
+        max_workers=8,
+        memory_limit=None,
+        decoded_tier=False,
+        quota_bytes=None,
+        eviction="lru",
+    ):
         """Initialize a new instance.
 
         Args:
@@ -23,37 +85,517 @@ class ImageCache:
             cache_dir (pathlib.Path):  If provided, the directory in which the
                                        image cache resides.  Defaults to
                                        ./image_cache.
+            max_workers (int): Default number of concurrent downloads
+                               for prefetch().
+            memory_limit (int): If provided, keep up to this many bytes of
+                                recently used, decoded images in memory.
+                                Images served from memory are read-only.
+            decoded_tier (bool): If True, also cache decoded images as .npy
+                                 files, and serve them as read-only memory
+                                 maps.  A decoded image is rebuilt when
+                                 its source image file changes.
+            quota_bytes (int): If provided, evict unpinned files whenever
+                               the files in the cache directory exceed
+                               this many bytes.
+            eviction (str): Which files to evict first: "lru" for least
+                            recently used, "size" for largest.
         """
         self._db = db
-        self._cache_dir = cache_dir or self._default_cache_dir
+        self._cache_dir = Path(cache_dir or self._default_cache_dir)
+        self._max_workers = max_workers
+        self._session = pooled_session(max_workers)
+        self._memory = None if memory_limit is None else ArrayLRU(memory_limit)
+        self._decoded_tier = decoded_tier
+        self._quota_bytes = quota_bytes
+        self._eviction = eviction
+        self._quota_lock = threading.Lock()
+        self._touched = set()
+        self._touch_lock = threading.Lock()
+
+        # The database indexes cached files by cache directory.
+        self._cache_key = str(self._cache_dir.resolve())
+        if not db.has_cached_files(self._cache_key):
+            # Perhaps the cache predates the index.
+            self.reindex()
+
+    def reindex(self):
+        """Record in the database any files in the cache directory that
+        it does not already know about, and the content digest of any
+        image that has none."""
+        if not self._cache_dir.is_dir():
+            return
+        images = {path.stem: path for path in self._cache_dir.glob("*.png")}
+        digests = self._db.image_digests(images)
+        paths = list(images.values())
+        paths.extend(self._cache_dir.glob("decoded/*.npy"))
+        rel_paths = {self._rel(path): path for path in paths}
+        known = self._db.cached_paths(self._cache_key, rel_paths)
+        for rel_path, path in rel_paths.items():
+            image_id = path.name.split(".")[0]
+            sha256 = None
+            if path.suffix == ".png" and image_id not in digests:
+                sha256 = _file_sha256(path)
+            if rel_path in known:
+                if sha256 is not None:
+                    self._db.record_image_digest(image_id, sha256)
+            else:
+                st = path.stat()
+                self._db.record_cached_file(
+                    self._cache_key,
+                    rel_path,
+                    image_id,
+                    st.st_size,
+                    sha256=sha256,
+                    last_access=st.st_mtime,
+                )
+
+    def pin(self, image_ids, pinned=True):
+        """Exempt images' cached files from eviction, or stop doing so.
+
+        Args:
+            image_ids: iterable of image IDs
+            pinned (bool): whether the images should be exempt
+        """
+        self._db.pin_cached_images(self._cache_key, image_ids, pinned)
+
+    def flush_touches(self):
+        """Record in the database any cache hits that are not yet recorded.
+
+        Hits update each file's last access time for LRU eviction.  They
+        are written in batches, so that reads don't each cost a write.
+        """
+        with self._touch_lock:
+            touched, self._touched = self._touched, set()
+        if touched:
+            self._db.touch_cached_files(self._cache_key, touched)
+
+    def _touch(self, rel_path):
+        with self._touch_lock:
+            self._touched.add(rel_path)
+            full = len(self._touched) >= self._touch_batch
+        if full:
+            self.flush_touches()
+
+    def disk_usage(self):
+        """Get the total size, in bytes, of the files in the cache."""
+        return self._db.cached_bytes(self._cache_key)
+
+    def fingerprints(self, image_ids):
+        """Identify the content of images.
+
+        Args:
+            image_ids: iterable of image IDs
+
+        Returns:
+            dict: {image_id: fingerprint} for each known image; see
+            ImageDB.content_fingerprints
+        """
+        return self._db.content_fingerprints(image_ids)
 
     def get_image(self, image_id):
+        return self._get_array(image_id, "png", self._decoded_png)
+
+    def get_images(
+        self, image_ids, ordered=True, max_workers=None, window=None
+    ):
+        """Get many images at once.
+
+        One database query finds which images are cached and where to
+        download the rest.  Downloads and decoding then run concurrently
+        on a pool of at most max_workers threads.
+
+        Args:
+            image_ids: iterable of image IDs
+            ordered (bool): if True, generate images in the order of
+                            image_ids; otherwise as soon as each is ready
+            max_workers (int): concurrency; defaults to the value given
+                               to the constructor
+            window (int): most images to load ahead of the caller;
+                          defaults to twice max_workers
+
+        Yields:
+            tuple: (image_id, image); image is None for unknown image IDs
+        """
+        image_ids = list(image_ids)
+        entries = self._db.cache_lookup(self._cache_key, image_ids)
+        max_workers = max_workers or self._max_workers
+        window = max(1, window or 2 * max_workers)
+
+        def load(image_id):
+            url, is_cached = entries.get(image_id, (None, False))
+            path = self._cached_path(image_id)
+            if is_cached:
+                try:
+                    return ski_io.imread(path)
+                except FileNotFoundError:
+                    # Removed behind the index's back.
+                    self._db.forget_cached_file(
+                        self._cache_key, self._rel(path)
+                    )
+            if url is None:
+                return None
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            data = self._download(image_id, url, path)
+            return ski_io.imread(io.BytesIO(data))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = iter(image_ids)
+            futures = {}
+
+            def submit():
+                for image_id in itertools.islice(pending, 1):
+                    future = executor.submit(
+                        self._get_array, image_id, "png", load
+                    )
+                    futures[future] = image_id
+
+            for _ in range(window):
+                submit()
+            while futures:
+                if ordered:
+                    future = next(iter(futures))
+                else:
+                    future = next(as_completed(futures))
+                image_id = futures.pop(future)
+                submit()
+                yield image_id, future.result()
+
+        cached_paths = [
+            self._rel(self._cached_path(image_id))
+            for image_id, (_, is_cached) in entries.items()
+            if is_cached
+        ]
+        self._db.touch_cached_files(self._cache_key, cached_paths)
+
+    def get_demosaiced_image(self, image_id):
+        """Get an image that is a raw Bayer-pattern sensor readout,
+        demosaiced to RGB.
+
+        Args:
+            image_id (str): ID of the raw image
+
+        Returns:
+            array: the RGB image, or None if the image is not available
+        """
+
+        def demosaiced(image_id):
+            raw = self.get_image(image_id)
+            return None if raw is None else demosaic(raw)
+
+        return self._get_array(image_id, "rgb", demosaiced)
+
+    def _get_array(self, image_id, variant, produce):
+        # Get a variant of an image from the fastest tier that has it:
+        # memory, then decoded .npy files, then produce(image_id).
+        key = (image_id, variant)
+        if self._memory is not None:
+            result = self._memory.get(key)
+            if result is not None:
+                return result
+
+        result = None
+        if self._decoded_tier:
+            result = self._load_decoded(image_id, variant)
+        if result is None:
+            result = produce(image_id)
+            if self._decoded_tier and (result is not None):
+                result = self._store_decoded(image_id, variant, result)
+
+        if (self._memory is not None) and (result is not None):
+            # Callers share cached arrays; don't let one alter another's.
+            result.flags.writeable = False
+            self._memory.put(key, result)
+        return result
+
+    def _decoded_png(self, image_id):
         result = self._image_from_cache(image_id)
         if result is None:
             result = self._retrieve_image(image_id)
         return result
 
-    def _retrieve_image(self, image_id):
-        query = "SELECT full_res_url FROM Images WHERE image_id=?"
-        cursor = self._db.cursor()
-        for row in cursor.execute(query, (image_id,)):
-            url = row[0]
-            req = requests.get(url, allow_redirects=True)
-            req.raise_for_status()
+    def _decoded_path(self, image_id, variant):
+        # Decoded files are named for the size and modification time of
+        # their source image file, so they go stale when it changes.
+        try:
+            st = self._cached_path(image_id).stat()
+        except FileNotFoundError:
+            return None
+        name = f"{image_id}.{variant}.{st.st_size}-{st.st_mtime_ns}.npy"
+        return self._cache_dir / "decoded" / name
+
+    def _load_decoded(self, image_id, variant):
+        path = self._decoded_path(image_id, variant)
+        if path is not None:
+            return self._load_indexed(path, np.load, mmap_mode="r")
+        return None
+
+    def _store_decoded(self, image_id, variant, image_data):
+        path = self._decoded_path(image_id, variant)
+        if path is None:
+            return image_data
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as outf:
+            np.save(outf, image_data)
+        os.replace(outf.name, path)
+        self._db.record_cached_file(
+            self._cache_key, self._rel(path), image_id, path.stat().st_size
+        )
+
+        for stale in path.parent.glob(f"{image_id}.{variant}.*.npy"):
+            if stale != path:
+                self._remove(stale)
+        self._enforce_quota(keep=path)
+        return np.load(path, mmap_mode="r")
+
+    def memory_stats(self):
+        """Get in-memory cache statistics.
+
+        Returns:
+            array_lru.LRUStats: usage statistics, or None if self has no
+                                in-memory cache
+        """
+        return None if self._memory is None else self._memory.stats()
+
+    def prefetch(self, image_ids, max_workers=None):
+        """Download images that are not already cached.
+
+        Downloads run concurrently, at most max_workers at a time.  A failed
+        download does not stop the others.
+
+        Args:
+            image_ids: iterable of image IDs
+            max_workers (int): download concurrency; defaults to the
+                               value given to the constructor
+
+        Yields:
+            PrefetchResult: one per distinct image ID; images that are
+            already cached come first, then downloads as they complete
+        """
+        # Duplicate IDs would race to download into the same file.
+        image_ids = list(dict.fromkeys(image_ids))
+        cached = self._db.cached_paths(
+            self._cache_key,
+            [self._rel(self._cached_path(image_id)) for image_id in image_ids],
+        )
+        to_fetch = []
+        for image_id in image_ids:
+            path = self._cached_path(image_id)
+            if self._rel(path) in cached:
+                yield PrefetchResult(image_id, path, None)
+            else:
+                to_fetch.append(image_id)
+        if not to_fetch:
+            return
+
+        urls = self._db.full_res_urls(to_fetch)
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(
+            max_workers=max_workers or self._max_workers
+        ) as executor:
+            futures = {}
+            for image_id in to_fetch:
+                url = urls.get(image_id)
+                if url is None:
+                    error = LookupError(f"No URL for image {image_id}")
+                    yield PrefetchResult(image_id, None, error)
+                    continue
+                path = self._cached_path(image_id)
+                future = executor.submit(self._download, image_id, url, path)
+                futures[future] = (image_id, path)
+
+            for future in as_completed(futures):
+                image_id, path = futures[future]
+                try:
+                    future.result()
+                    yield PrefetchResult(image_id, path, None)
+                except Exception as info:
+                    yield PrefetchResult(image_id, None, info)
 
-            img_data_io = io.BytesIO(req.content)
+    def fetch(self, image_id):
+        """Download an image if it is not already cached.
+
+        Unlike prefetch(), this does its work on the calling thread, so
+        it suits a pipeline stage with its own workers.
+
+        Args:
+            image_id (str): ID of the image
+
+        Returns:
+            pathlib.Path: the cached image file
+
+        Raises:
+            LookupError: if the database has no URL for the image
+        """
+        path = self._cached_path(image_id)
+        rel_path = self._rel(path)
+        if self._db.cached_file(self._cache_key, rel_path) is not None:
+            if path.exists():
+                return path
+            # Removed behind the index's back.
+            self._db.forget_cached_file(self._cache_key, rel_path)
+
+        url = self._db.full_res_urls([image_id]).get(image_id)
+        if url is None:
+            raise LookupError(f"No URL for image {image_id}")
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._download(image_id, url, path)
+        return path
+
+    def _retrieve_image(self, image_id):
+        url = self._db.full_res_urls([image_id]).get(image_id)
+        if url is not None:
             out_path = self._cached_path(image_id)
             self._cache_dir.mkdir(parents=True, exist_ok=True)
-            out_path.write_bytes(img_data_io.read())
-            return ski_io.imread(out_path)
+            data = self._download(image_id, url, out_path)
+            return ski_io.imread(io.BytesIO(data))
+
+    def _download(self, image_id, url, out_path):
+        # Stream url to a partial file, then rename it into place, so
+        # out_path only ever holds a complete image.  If an earlier
+        # download left a partial file, ask for just the rest of it.
+        # Returns the complete file content.
+        part_path = out_path.with_name(out_path.name + ".part")
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self._session.get(
+            url, headers=headers, stream=True, allow_redirects=True
+        ) as req:
+            if req.status_code == 416:
+                # The partial file can't be resumed.  Start over.
+                part_path.unlink()
+                return self._download(image_id, url, out_path)
+            req.raise_for_status()
+
+            resuming = req.status_code == 206
+            if resuming and not _resumes_at(req.headers, offset):
+                # Not the rest of the partial file.  Writing it from
+                # byte 0 would commit a truncated image.
+                if not offset:
+                    raise IOError(f"Unrequested partial content from {url}")
+                logger().debug(f"Can't resume {url}; starting over")
+                req.close()
+                part_path.unlink()
+                return self._download(image_id, url, out_path)
+            if resuming:
+                logger().debug(f"Resuming {url} at byte {offset}")
+                chunks = [part_path.read_bytes()]
+                mode = "ab"
+            else:
+                chunks = []
+                mode = "wb"
+
+            received = 0
+            with part_path.open(mode) as outf:
+                for chunk in req.iter_content(chunk_size=self._chunk_size):
+                    outf.write(chunk)
+                    chunks.append(chunk)
+                    received += len(chunk)
+
+            # Content-Length is meaningless for encoded (e.g. gzipped)
+            # content, which iter_content decodes.
+            expected = req.headers.get("Content-Length")
+            encoded = "Content-Encoding" in req.headers
+            if expected and not encoded and received != int(expected):
+                raise IOError(
+                    f"Incomplete download of {url}: "
+                    f"{received} of {expected} bytes"
+                )
+
+        os.replace(part_path, out_path)
+        data = b"".join(chunks)
+        self._db.record_cached_file(
+            self._cache_key,
+            self._rel(out_path),
+            image_id,
+            len(data),
+            origin=url,
+            sha256=hashlib.sha256(data).hexdigest(),
+        )
+        self._enforce_quota(keep=out_path)
+        return data
 
     def _image_from_cache(self, image_id):
         img_path = self._cached_path(image_id)
-        if img_path.exists():
-            # TODO Figure out the correct mode (RGB, single color)
-            # in which to open the image.
-            return ski_io.imread(img_path)
-        return None
+        # TODO Figure out the correct mode (RGB, single color)
+        # in which to open the image.
+        return self._load_indexed(img_path, ski_io.imread)
+
+    def _load_indexed(self, path, loader, **kwargs):
+        # Load a cached file if the index says it is present.
+        rel_path = self._rel(path)
+        if self._db.cached_file(self._cache_key, rel_path) is None:
+            return None
+        try:
+            result = loader(path, **kwargs)
+        except FileNotFoundError:
+            # Removed behind the index's back.
+            self._db.forget_cached_file(self._cache_key, rel_path)
+            return None
+        self._touch(rel_path)
+        return result
+
+    def _enforce_quota(self, keep=None):
+        # Evict files until the cache is within its quota.  Never evict
+        # keep, the file that was just added, nor any other file for the
+        # same image -- keep may have been derived from it, and evicting
+        # a .png also evicts the files derived from it.
+        if self._quota_bytes is None:
+            return
+        # Evict by up-to-date access times.
+        self.flush_touches()
+        keep_image_id = None
+        if keep is not None:
+            row = self._db.cached_file(self._cache_key, self._rel(keep))
+            keep_image_id = None if row is None else row["image_id"]
+        with self._quota_lock:
+            excess = self.disk_usage() - self._quota_bytes
+            while excess > 0:
+                candidates = [
+                    row
+                    for row in self._db.eviction_candidates(
+                        self._cache_key, self._eviction
+                    )
+                    if row["image_id"] != keep_image_id
+                ]
+                if not candidates:
+                    logger().warning(
+                        f"Image cache exceeds its quota by {excess} bytes, "
+                        "but has nothing left to evict"
+                    )
+                    return
+                for row in candidates:
+                    excess -= self._evict(row)
+                    if excess <= 0:
+                        break
+
+    def _evict(self, row):
+        # Evict a cached file, and any files derived from it.
+        # Returns the number of bytes freed.
+        freed = self._remove(self._cache_dir / row["path"])
+        if row["path"].endswith(".png"):
+            image_id = row["image_id"]
+            for derived in self._db.cached_files_for_image(
+                self._cache_key, image_id
+            ):
+                freed += self._remove(self._cache_dir / derived["path"])
+        logger().debug(f"Evicted {row['path']}")
+        return freed
+
+    def _remove(self, path):
+        # Remove a cached file and its index entry.
+        # Returns the file's indexed size.
+        rel_path = self._rel(path)
+        row = self._db.cached_file(self._cache_key, rel_path)
+        path.unlink(missing_ok=True)
+        self._db.forget_cached_file(self._cache_key, rel_path)
+        return 0 if row is None else row["size"]
+
+    def _rel(self, path):
+        return Path(path).relative_to(self._cache_dir).as_posix()
 
     def _cached_path(self, image_id):
         return self._cache_dir / f"{image_id}.png"
@@ -4,10 +4,16 @@ image_db manages a database of image metadata.
 Copyright 2021, Mitch Chapman  All rights reserved
 """
 
+from collections import namedtuple
+from contextlib import contextmanager
 import datetime
+import json
+from operator import itemgetter
 from pathlib import Path
 import re
 import sqlite3
+import threading
+import time
 
 
 # Consider supporting schema versioning, migrations, etc.
@@ -62,9 +68,196 @@ CREATE TABLE IF NOT EXISTS Images (
     ext_width REAL,
     ext_height REAL
 );
+
+-- Covers the panorama tile query (_pano_tiles_query): equality
+-- filters first, then the sort order, then the remaining columns read.
+-- Its (cam_instrument, sample_type) prefix also serves cameras() and
+-- images_for_camera().
+CREATE INDEX IF NOT EXISTS Images_pano_tiles
+ON Images (
+    cam_instrument, sample_type, ext_scale_factor,
+    site, drive, ext_sclk, image_id,
+    ext_sf_left, ext_sf_top, ext_sf_width, ext_sf_height
+);
+
+-- Files held by an image_cache.ImageCache.  path is relative to
+-- cache_dir.  origin is the URL from which a file was downloaded, or
+-- NULL for files derived from other cached files.
+CREATE TABLE IF NOT EXISTS CachedFiles (
+    cache_dir TEXT NOT NULL,
+    path TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    origin TEXT,
+    sha256 TEXT,
+    PRIMARY KEY (cache_dir, path)
+);
+
+CREATE INDEX IF NOT EXISTS CachedFiles_by_image
+ON CachedFiles (cache_dir, image_id);
+
+-- Eviction order.
+CREATE INDEX IF NOT EXISTS CachedFiles_by_access
+ON CachedFiles (cache_dir, pinned, last_access);
+
+-- The SHA-256 digest of each image's content, as last downloaded.
+-- Unlike CachedFiles rows, digests outlive eviction, so that unchanged
+-- images keep their build_manifest fingerprints.
+CREATE TABLE IF NOT EXISTS ImageDigests (
+    image_id TEXT NOT NULL PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+
+-- Digests recorded before ImageDigests existed.
+INSERT OR IGNORE INTO ImageDigests (image_id, sha256)
+SELECT image_id, sha256 FROM CachedFiles WHERE sha256 IS NOT NULL;
+
+-- The newest image ingested by an incremental feed sync, per query.
+CREATE TABLE IF NOT EXISTS SyncState (
+    feed TEXT NOT NULL PRIMARY KEY,
+    sol INTEGER NOT NULL,
+    ext_sclk REAL,
+    image_id TEXT NOT NULL,
+    synced_utc TIMESTAMP NOT NULL
+);
+
+-- Outputs built from images, such as panoramas, and a digest of the
+-- inputs from which each was last built.  See build_manifest.
+CREATE TABLE IF NOT EXISTS Builds (
+    output TEXT NOT NULL PRIMARY KEY,
+    build_key TEXT NOT NULL,
+    built_utc TIMESTAMP NOT NULL
+);
+
+-- Work queues, e.g. of panoramas to build; see job_queue.JobQueue.
+-- A claimed job belongs to worker until lease_expires (seconds since
+-- the epoch); after that another worker may claim it.
+CREATE TABLE IF NOT EXISTS Jobs (
+    job_id INTEGER PRIMARY KEY,
+    queue TEXT NOT NULL,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending'
+        CHECK (state IN ('pending', 'claimed', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    result TEXT,
+    updated REAL NOT NULL,
+    UNIQUE (queue, name)
+);
+
+CREATE INDEX IF NOT EXISTS Jobs_by_state
+ON Jobs (queue, state, lease_expires);
 """
 
 
+_upsert_query = """
+INSERT OR REPLACE INTO Images
+(
+    image_id, credit, caption, title,
+    cam_instrument, cam_filter, cam_model_component_list,
+    cam_model_type, cam_position,
+    sample_type,
+    full_res_url, json_url,
+    date_taken_utc,
+    attitude, drive, site,
+    ext_mast_azimuth, ext_mast_elevation,
+    ext_sclk,
+    ext_scale_factor,
+    ext_x, ext_y, ext_z,
+    ext_sf_left, ext_sf_top, ext_sf_width, ext_sf_height,
+    ext_width, ext_height
+) VALUES (
+    ?, ?, ?, ?,
+    ?, ?, ?,
+    ?, ?,
+    ?,
+    ?, ?,
+    ?,
+    ?, ?, ?,
+    ?, ?,
+    ?,
+    ?,
+    ?, ?, ?,
+    ?, ?, ?, ?,
+    ?, ?
+)
+""".strip()
+
+# Candidate panorama tiles for a camera: full-size, unscaled raw
+# readouts with known subframe rects.
+_pano_tile_columns = """
+  site, drive, ext_sclk,
+  ext_sf_left x, ext_sf_top y,
+  ext_sf_width w, ext_sf_height h,
+  image_id
+""".strip("\n")
+
+_pano_tile_conditions = """
+  sample_type = 'Full'
+  AND image_id LIKE '__E%'
+  AND ext_scale_factor = 1.0
+  AND ext_sf_left NOT NULL
+  AND ext_sf_top NOT NULL
+  AND ext_sf_width NOT NULL
+  AND ext_sf_height NOT NULL
+""".strip("\n")
+
+_pano_tiles_query = f"""
+SELECT
+{_pano_tile_columns}
+FROM Images
+WHERE cam_instrument = ?
+  AND {_pano_tile_conditions.strip()}
+ORDER BY site, drive, ext_sclk, image_id
+""".strip()
+
+# Candidate panorama sets: candidate tiles grouped by camera and
+# exposure, for sets of more than one tile.  {} is an optional camera
+# condition.  SQLite (before 3.44) can't order an aggregate's inputs,
+# so tiles may come back in any order.
+_pano_sets_query = f"""
+SELECT
+  cam_instrument, site, drive, ext_sclk,
+  json_group_array(json_object(
+    'image_id', image_id,
+    'x', ext_sf_left, 'y', ext_sf_top,
+    'w', ext_sf_width, 'h', ext_sf_height
+  )) AS tiles
+FROM Images
+WHERE {{}}{_pano_tile_conditions.strip()}
+GROUP BY cam_instrument, site, drive, ext_sclk
+HAVING COUNT(*) > 1
+ORDER BY cam_instrument, site, drive, ext_sclk
+""".strip()
+
+# Matches tuple-valued feed fields such as "(1,2,3)".
+_tuple_expr = re.compile(r"^\((.*)\)$")
+
+
+class PanoSet(
+    namedtuple("PanoSet", "camera site drive ext_sclk tiles")
+):
+    """A candidate panorama: tiles from one exposure of one camera.
+
+    tiles is a list of {"image_id", "x", "y", "w", "h"} dicts, ordered by
+    image_id.  Metadata origin is at (1, 1).
+    """
+
+
+class IngestStats(namedtuple("IngestStats", "records seconds")):
+    """The outcome of ImageDB.bulk_ingest."""
+
+    @property
+    def rate(self):
+        """Records per second."""
+        return self.records / self.seconds if self.seconds > 0 else 0.0
+
+
 class ImageDB:
     # Database file is created relative to current working dir.
     _default_db_path = Path("mars_perseverance_image_info.db")
@@ -72,18 +265,27 @@ class ImageDB:
     def __init__(self, db_path=None):
         self._db_path = db_path or self._default_db_path
 
+        # ImageCache may use self from its download threads, so every
+        # method that uses the connection takes self._lock.
         self._conn = sqlite3.connect(
             str(self._db_path),
             isolation_level=None,
             detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
         )
         self._conn.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
         self._init_schema()
 
+    @property
+    def db_path(self):
+        """The path of the database file."""
+        return self._db_path
+
     def _init_schema(self):
-        cursor = self._conn.cursor()
-        cursor.executescript(_schema)
-        self._conn.commit()
+        with self._lock:
+            self._conn.cursor().executescript(_schema)
+            self._conn.commit()
 
     def add_or_update(self, json_records):
         """Add or update all images metadata from json_records.
@@ -92,85 +294,119 @@ class ImageDB:
             json_records: JSON object constructed from RSS feed's "images"
             value.
         """
-        cursor = self._conn.cursor()
-        cursor.execute("BEGIN TRANSACTION")
-        for image_record in json_records:
-            self._add_or_update_one(cursor, image_record)
-        cursor.execute("COMMIT TRANSACTION")
+        params = [self._record_params(record) for record in json_records]
+        with self._transaction() as cursor:
+            cursor.executemany(_upsert_query, params)
 
-    def _add_or_update_one(self, cursor, record):
-        query = """
-        INSERT OR REPLACE INTO Images
-        (
-            image_id, credit, caption, title,
-            cam_instrument, cam_filter, cam_model_component_list,
-            cam_model_type, cam_position,
-            sample_type,
-            full_res_url, json_url,
-            date_taken_utc,
-            attitude, drive, site,
-            ext_mast_azimuth, ext_mast_elevation,
-            ext_sclk,
-            ext_scale_factor,
-            ext_x, ext_y, ext_z,
-            ext_sf_left, ext_sf_top, ext_sf_width, ext_sf_height,
-            ext_width, ext_height
-        ) VALUES (
-            :image_id, :credit, :caption, :title,
-            :cam_instr, :cam_filter, :cam_comp_list,
-            :cam_model_type, :cam_pos,
-            :sample_type,
-            :image_url, :json_url,
-            :date_taken,
-            :attitude, :drive, :site,
-            :ext_mast_az, :ext_mast_el,
-            :ext_sclk,
-            :ext_scale_fact,
-            :ext_x, :ext_y, :ext_z,
-            :ext_sf_l, :ext_sf_t, :ext_sf_w, :ext_sf_h,
-            :ext_w, :ext_h
-        )
+    def bulk_ingest(self, json_records, batch_size=10000):
+        """Add or update a large number of image metadata records.
+
+        Records are written in batches of batch_size, one transaction per
+        batch, with the database tuned for loading (see loading()).
+
+        Args:
+            json_records: iterable of RSS feed "images" records
+            batch_size (int): number of records per transaction
+
+        Returns:
+            IngestStats: how many records were written, and how quickly
+        """
+        t0 = time.perf_counter()
+        count = 0
+        with self.loading():
+            batch = []
+            for record in json_records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    self.add_or_update(batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self.add_or_update(batch)
+                count += len(batch)
+        return IngestStats(count, time.perf_counter() - t0)
+
+    @contextmanager
+    def loading(self, cache_mb=64):
+        """Tune the database for bulk writes for the duration of a context.
+
+        Uses write-ahead logging, syncs to disk only at checkpoints, and
+        enlarges the page cache.  The previous settings are restored on
+        exit.  Other threads can't use self until the context exits.
+
+        Args:
+            cache_mb (int): page cache size, in MiB, while loading
         """
+        with self._lock:
+            cursor = self._conn.cursor()
+            journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            synchronous = cursor.execute("PRAGMA synchronous").fetchone()[0]
+            cache_size = cursor.execute("PRAGMA cache_size").fetchone()[0]
+
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL")
+            # Negative cache sizes are in KiB.
+            cursor.execute(f"PRAGMA cache_size = {-1024 * int(cache_mb)}")
+            try:
+                yield self
+            finally:
+                cursor.execute(f"PRAGMA cache_size = {int(cache_size)}")
+                cursor.execute(f"PRAGMA synchronous = {int(synchronous)}")
+                cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
 
+    @contextmanager
+    def _transaction(self, begin="BEGIN TRANSACTION"):
+        # Run statements in a transaction, rolling back on failure.
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(begin)
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK TRANSACTION")
+                raise
+            cursor.execute("COMMIT TRANSACTION")
+
+    def _record_params(self, record):
+        # Get the _upsert_query parameters for one feed record.
         ext = record["extended"]
+        camera = record["camera"]
         x, y, z = self._opt_float_tuple(ext["xyz"], 3)
         w, h = self._opt_float_tuple(ext["dimension"], 2)
         sf_l, sf_t, sf_w, sf_h = self._opt_int_tuple(ext["subframeRect"], 4)
 
-        values = dict(
-            image_id=record["imageid"],
-            credit=record["credit"],
-            caption=record["caption"],
-            title=record["title"],
-            cam_instr=record["camera"]["instrument"],
-            cam_filter=record["camera"]["filter_name"],
-            cam_comp_list=record["camera"]["camera_model_component_list"],
-            cam_model_type=record["camera"]["camera_model_type"],
-            cam_pos=record["camera"]["camera_position"],
-            sample_type=record["sample_type"],
-            json_url=record["json_link"],
-            image_url=record["image_files"]["full_res"],
-            attitude=record["attitude"],
-            drive=self._opt_int(record["drive"]),
-            site=self._opt_int(record["site"]),
-            date_taken=self._timestamp(record["date_taken_utc"]),
-            ext_mast_az=self._opt_float(ext["mastAz"]),
-            ext_mast_el=self._opt_float(ext["mastEl"]),
-            ext_sclk=self._opt_float(ext["sclk"]),
-            ext_scale_fact=self._opt_float(ext["scaleFactor"]),
-            ext_x=x,
-            ext_y=y,
-            ext_z=z,
-            ext_sf_l=sf_l,
-            ext_sf_t=sf_t,
-            ext_sf_w=sf_w,
-            ext_sf_h=sf_h,
-            ext_w=w,
-            ext_h=h,
+        return (
+            record["imageid"],
+            record["credit"],
+            record["caption"],
+            record["title"],
+            camera["instrument"],
+            camera["filter_name"],
+            camera["camera_model_component_list"],
+            camera["camera_model_type"],
+            camera["camera_position"],
+            record["sample_type"],
+            record["image_files"]["full_res"],
+            record["json_link"],
+            self._timestamp(record["date_taken_utc"]),
+            record["attitude"],
+            self._opt_int(record["drive"]),
+            self._opt_int(record["site"]),
+            self._opt_float(ext["mastAz"]),
+            self._opt_float(ext["mastEl"]),
+            self._opt_float(ext["sclk"]),
+            self._opt_float(ext["scaleFactor"]),
+            x,
+            y,
+            z,
+            sf_l,
+            sf_t,
+            sf_w,
+            sf_h,
+            w,
+            h,
         )
 
-        cursor.execute(query.strip(), values)
-
     def _timestamp(self, timestamp_str):
         try:
             return datetime.datetime.fromisoformat(timestamp_str)
@@ -191,12 +427,11 @@ class ImageDB:
     def _opt_tuple(self, val_str, num_fields, converter):
         if val_str == "UNK":
             return tuple([None] * num_fields)
-        expr = re.compile(r"^\((.*)\)$")
-        if m := expr.match(val_str):
+        if m := _tuple_expr.match(val_str):
             fields = [converter(f) for f in m.group(1).split(",")]
             if len(fields) == num_fields:
                 return tuple(fields)
-        return ValueError(f"Invalid {num_fields}-tuple: '{val_str}'")
+        raise ValueError(f"Invalid {num_fields}-tuple: '{val_str}'")
 
     def _opt_int_tuple(self, val_str, num_fields):
         return self._opt_tuple(val_str, num_fields, int)
@@ -205,11 +440,559 @@ class ImageDB:
         return self._opt_tuple(val_str, num_fields, float)
 
     def cursor(self):
+        """Get a cursor for ad hoc queries.
+
+        ImageDB can't serialize what callers do with the cursor, so use
+        it only on a thread that has no other thread using self.
+        """
         return self._conn.cursor()
 
+    def known_image_ids(self, image_ids):
+        """Find which of a collection of image IDs are already recorded.
+
+        Args:
+            image_ids: iterable of image ID strings
+
+        Returns:
+            set: the subset of image_ids that are in the Images table
+        """
+        query = "SELECT image_id FROM Images WHERE image_id IN ({})"
+        return {row[0] for row in self._select_in(query, image_ids)}
+
+    def full_res_urls(self, image_ids):
+        """Get the full-resolution image URLs for a collection of images.
+
+        Args:
+            image_ids: iterable of image ID strings
+
+        Returns:
+            dict: {image_id: full_res_url} for each known image_id
+        """
+        query = (
+            "SELECT image_id, full_res_url FROM Images"
+            " WHERE image_id IN ({})"
+        )
+        return {row[0]: row[1] for row in self._select_in(query, image_ids)}
+
+    def _select_in(self, query, values, params=()):
+        # Run a query whose "{}" is an IN list for values, after any
+        # other params.  Returns a list of rows.
+        # Stay well under SQLite's limit on host parameters.
+        values = list(values)
+        chunk_size = 500
+        result = []
+        with self._lock:
+            cursor = self._conn.cursor()
+            for i in range(0, len(values), chunk_size):
+                chunk = values[i:i + chunk_size]
+                marks = ",".join("?" * len(chunk))
+                rows = cursor.execute(query.format(marks), (*params, *chunk))
+                result.extend(rows)
+        return result
+
+    def record_cached_file(
+        self,
+        cache_dir,
+        path,
+        image_id,
+        size,
+        origin=None,
+        sha256=None,
+        last_access=None,
+    ):
+        """Record that a file has been added to, or replaced in, a cache.
+
+        Args:
+            cache_dir (str): identifies the cache
+            path (str): the file's path relative to cache_dir
+            image_id (str): the image from which the file derives
+            size (int): file size in bytes
+            origin (str): URL from which the file was downloaded, if any
+            sha256 (str): hex digest of the file content, if known; it
+                          is also recorded as the image's digest
+            last_access (float): time of last access; defaults to now
+        """
+        query = """
+        INSERT INTO CachedFiles
+        (cache_dir, path, image_id, size, last_access, origin, sha256)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (cache_dir, path) DO UPDATE SET
+            image_id = excluded.image_id,
+            size = excluded.size,
+            last_access = excluded.last_access,
+            origin = excluded.origin,
+            sha256 = excluded.sha256
+        """
+        if last_access is None:
+            last_access = time.time()
+        params = (cache_dir, path, image_id, size, last_access, origin, sha256)
+        with self._transaction() as cursor:
+            cursor.execute(query.strip(), params)
+            if sha256 is not None:
+                self.record_image_digest(image_id, sha256)
+
+    def record_image_digest(self, image_id, sha256):
+        """Record the SHA-256 digest of an image's content.
+
+        Args:
+            image_id (str): the image
+            sha256 (str): hex digest of its content
+        """
+        query = "INSERT OR REPLACE INTO ImageDigests VALUES (?, ?)"
+        with self._lock:
+            self._conn.cursor().execute(query, (image_id, sha256))
+
+    def image_digests(self, image_ids):
+        """Get the recorded content digests of images.
+
+        Args:
+            image_ids: iterable of image ID strings
+
+        Returns:
+            dict: {image_id: sha256} for each image with a digest
+        """
+        query = "SELECT * FROM ImageDigests WHERE image_id IN ({})"
+        return {row[0]: row[1] for row in self._select_in(query, image_ids)}
+
+    def cached_file(self, cache_dir, path):
+        """Get the index entry for a cached file.
+
+        Returns:
+            sqlite3.Row: the CachedFiles entry, or None
+        """
+        query = "SELECT * FROM CachedFiles WHERE cache_dir = ? AND path = ?"
+        with self._lock:
+            cursor = self._conn.cursor()
+            return cursor.execute(query, (cache_dir, path)).fetchone()
+
+    def cached_paths(self, cache_dir, paths):
+        """Find which of a collection of paths are recorded in a cache.
+
+        Returns:
+            set: the subset of paths that are in the cache's index
+        """
+        query = (
+            "SELECT path FROM CachedFiles"
+            " WHERE cache_dir = ? AND path IN ({})"
+        )
+        rows = self._select_in(query, paths, (cache_dir,))
+        return {row[0] for row in rows}
+
+    def cache_lookup(self, cache_dir, image_ids, suffix=".png"):
+        """Get the URLs of images, and whether a cache holds them, in one
+        query.
+
+        Args:
+            cache_dir (str): identifies the cache
+            image_ids: iterable of image IDs
+            suffix (str): suffix of the cached files' paths
+
+        Returns:
+            dict: {image_id: (full_res_url, is_cached)} for each known
+            image_id
+        """
+        query = """
+        SELECT i.image_id, i.full_res_url, c.path IS NOT NULL
+        FROM Images i
+        LEFT JOIN CachedFiles c
+          ON c.cache_dir = ? AND c.path = i.image_id || ?
+        WHERE i.image_id IN ({})
+        """
+        rows = self._select_in(query.strip(), image_ids, (cache_dir, suffix))
+        return {row[0]: (row[1], bool(row[2])) for row in rows}
+
+    def content_fingerprints(self, image_ids):
+        """Identify the content of images, in one query.
+
+        An image's fingerprint is the SHA-256 digest of its content if
+        that is known -- even if the image is no longer cached --
+        otherwise its full-resolution URL.
+
+        Args:
+            image_ids: iterable of image IDs
+
+        Returns:
+            dict: {image_id: fingerprint} for each known image_id
+        """
+        query = """
+        SELECT i.image_id, COALESCE(d.sha256, i.full_res_url)
+        FROM Images i
+        LEFT JOIN ImageDigests d ON d.image_id = i.image_id
+        WHERE i.image_id IN ({})
+        """
+        rows = self._select_in(query.strip(), image_ids)
+        return {row[0]: row[1] for row in rows}
+
+    def touch_cached_files(self, cache_dir, paths):
+        """Record an access to each of a collection of cached files."""
+        query = (
+            "UPDATE CachedFiles SET last_access = ?"
+            " WHERE cache_dir = ? AND path = ?"
+        )
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.executemany(
+                query, ((now, cache_dir, path) for path in paths)
+            )
+
+    def has_cached_files(self, cache_dir):
+        """Find whether any files are recorded for a cache."""
+        query = "SELECT 1 FROM CachedFiles WHERE cache_dir = ? LIMIT 1"
+        with self._lock:
+            cursor = self._conn.cursor()
+            return cursor.execute(query, (cache_dir,)).fetchone() is not None
+
+    def touch_cached_file(self, cache_dir, path):
+        """Record an access to a cached file."""
+        query = (
+            "UPDATE CachedFiles SET last_access = ?"
+            " WHERE cache_dir = ? AND path = ?"
+        )
+        with self._lock:
+            self._conn.cursor().execute(query, (time.time(), cache_dir, path))
+
+    def forget_cached_file(self, cache_dir, path):
+        """Remove a cached file's index entry."""
+        query = "DELETE FROM CachedFiles WHERE cache_dir = ? AND path = ?"
+        with self._lock:
+            self._conn.cursor().execute(query, (cache_dir, path))
+
+    def cached_files_for_image(self, cache_dir, image_id):
+        """Get the index entries of all of a cache's files for an image.
+
+        Returns:
+            list: CachedFiles rows
+        """
+        query = (
+            "SELECT * FROM CachedFiles WHERE cache_dir = ? AND image_id = ?"
+        )
+        with self._lock:
+            cursor = self._conn.cursor()
+            return cursor.execute(query, (cache_dir, image_id)).fetchall()
+
+    def cached_bytes(self, cache_dir):
+        """Get the total size of the files recorded for a cache."""
+        query = "SELECT TOTAL(size) FROM CachedFiles WHERE cache_dir = ?"
+        with self._lock:
+            cursor = self._conn.cursor()
+            return int(cursor.execute(query, (cache_dir,)).fetchone()[0])
+
+    def eviction_candidates(self, cache_dir, policy="lru", limit=100):
+        """Get unpinned cached files in the order they should be evicted.
+
+        Args:
+            cache_dir (str): identifies the cache
+            policy (str): "lru" for least recently used first, "size" for
+                          largest first (least recently used among
+                          equals)
+            limit (int): the most entries to return
+
+        Returns:
+            list: CachedFiles rows
+        """
+        order = {
+            "lru": "last_access",
+            "size": "size DESC, last_access",
+        }[policy]
+        query = (
+            "SELECT * FROM CachedFiles WHERE cache_dir = ? AND pinned = 0"
+            f" ORDER BY {order} LIMIT ?"
+        )
+        with self._lock:
+            cursor = self._conn.cursor()
+            return cursor.execute(query, (cache_dir, limit)).fetchall()
+
+    def pin_cached_images(self, cache_dir, image_ids, pinned=True):
+        """Set whether images' cached files are exempt from eviction."""
+        query = (
+            "UPDATE CachedFiles SET pinned = ?"
+            " WHERE cache_dir = ? AND image_id = ?"
+        )
+        params = (
+            (int(pinned), cache_dir, image_id) for image_id in image_ids
+        )
+        with self._transaction() as cursor:
+            cursor.executemany(query, params)
+
+    def sync_state(self, feed):
+        """Get the high-water mark of the last sync of a feed query.
+
+        Args:
+            feed (str): identifies the feed query
+
+        Returns:
+            sqlite3.Row: (feed, sol, ext_sclk, image_id, synced_utc), or None
+        """
+        query = "SELECT * FROM SyncState WHERE feed = ?"
+        with self._lock:
+            return self._conn.cursor().execute(query, (feed,)).fetchone()
+
+    def sync_mark(self, json_records):
+        """Get the high-water mark for a batch of feed records.
+
+        Args:
+            json_records: RSS feed "images" records
+
+        Returns:
+            tuple: (sol, sclk, image_id) of the newest record, or None
+        """
+        return max(
+            (
+                (
+                    int(record["sol"]),
+                    self._opt_float(record["extended"]["sclk"]) or 0.0,
+                    record["imageid"],
+                )
+                for record in json_records
+            ),
+            default=None,
+        )
+
+    def advance_sync_state(self, feed, mark):
+        """Record a feed query's high-water mark, unless the recorded mark
+        is already newer.
+
+        Args:
+            feed (str): identifies the feed query
+            mark (tuple): (sol, sclk, image_id), as from sync_mark
+        """
+        if mark is None:
+            return
+
+        query = """
+        INSERT OR REPLACE INTO SyncState
+        (feed, sol, ext_sclk, image_id, synced_utc)
+        VALUES (?, ?, ?, ?, ?)
+        """
+        sol, sclk, image_id = mark
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            state = self.sync_state(feed)
+            if state is not None:
+                recorded = (
+                    state["sol"],
+                    state["ext_sclk"] or 0.0,
+                    state["image_id"],
+                )
+                if recorded >= tuple(mark):
+                    return
+            self._conn.cursor().execute(
+                query.strip(), (feed, sol, sclk, image_id, now)
+            )
+
+    def build_key(self, output):
+        """Get the build key with which an output was last built.
+
+        Args:
+            output (str): identifies the output, e.g. by its path
+
+        Returns:
+            str: the build key, or None if the output has not been built
+        """
+        query = "SELECT build_key FROM Builds WHERE output = ?"
+        with self._lock:
+            row = self._conn.cursor().execute(query, (output,)).fetchone()
+        return None if row is None else row[0]
+
+    def record_build(self, output, build_key):
+        """Record that an output has been built.
+
+        Args:
+            output (str): identifies the output
+            build_key (str): digest of the inputs it was built from
+        """
+        query = """
+        INSERT OR REPLACE INTO Builds (output, build_key, built_utc)
+        VALUES (?, ?, ?)
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        params = (output, build_key, now)
+        with self._lock:
+            self._conn.cursor().execute(query.strip(), params)
+
+    def enqueue_jobs(self, queue, jobs, reset=False):
+        """Add jobs to a queue.
+
+        A job whose name is already queued is left alone, unless its
+        payload has changed, or reset is True.  Then it becomes pending
+        again -- unless a worker has claimed it.
+
+        Args:
+            queue (str): identifies the queue
+            jobs: iterable of (name, payload) string pairs
+            reset (bool): whether to re-run finished jobs regardless
+
+        Returns:
+            int: the number of jobs that became pending
+        """
+        query = """
+        INSERT INTO Jobs (queue, name, payload, updated)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (queue, name) DO UPDATE SET
+            payload = excluded.payload,
+            state = 'pending',
+            attempts = 0,
+            worker = NULL,
+            lease_expires = NULL,
+            error = NULL,
+            result = NULL,
+            updated = excluded.updated
+        WHERE Jobs.state != 'claimed'
+          AND (? OR Jobs.payload != excluded.payload)
+        """
+        now = time.time()
+        params = [
+            (queue, name, payload, now, bool(reset)) for name, payload in jobs
+        ]
+        with self._transaction() as cursor:
+            before = self._conn.total_changes
+            cursor.executemany(query.strip(), params)
+            return self._conn.total_changes - before
+
+    def claim_job(self, queue, worker, lease_seconds, max_attempts):
+        """Atomically claim the oldest claimable job in a queue.
+
+        A job is claimable if it is pending, or if its claimant's lease
+        has expired.  Expired jobs that have used up their attempts are
+        marked failed instead.
+
+        Args:
+            queue (str): identifies the queue
+            worker (str): identifies the claimant
+            lease_seconds (float): how long the claim lasts unless renewed
+            max_attempts (int): how many times a job may be claimed
+
+        Returns:
+            sqlite3.Row: (job_id, name, payload, attempts), or None if
+            there is nothing to claim
+        """
+        expire_query = """
+        UPDATE Jobs SET state = 'failed', worker = NULL,
+            error = 'Lease expired', updated = ?
+        WHERE queue = ? AND state = 'claimed' AND lease_expires < ?
+          AND attempts >= ?
+        """
+        claim_query = """
+        UPDATE Jobs SET state = 'claimed', worker = ?,
+            attempts = attempts + 1, lease_expires = ?, updated = ?
+        WHERE job_id = (
+            SELECT job_id FROM Jobs
+            WHERE queue = ? AND attempts < ? AND (
+                state = 'pending'
+                OR (state = 'claimed' AND lease_expires < ?)
+            )
+            ORDER BY job_id
+            LIMIT 1
+        )
+        RETURNING job_id, name, payload, attempts
+        """
+        now = time.time()
+        # Take the write lock up front, so that two workers cannot both
+        # see the same job as claimable.
+        with self._transaction("BEGIN IMMEDIATE TRANSACTION") as cursor:
+            cursor.execute(
+                expire_query.strip(), (now, queue, now, max_attempts)
+            )
+            params = (
+                worker,
+                now + lease_seconds,
+                now,
+                queue,
+                max_attempts,
+                now,
+            )
+            rows = cursor.execute(claim_query.strip(), params).fetchall()
+        return rows[0] if rows else None
+
+    def renew_job_lease(self, job_id, worker, lease_seconds):
+        """Extend a worker's claim on a job.
+
+        Returns:
+            bool: False if the worker no longer holds the job
+        """
+        query = """
+        UPDATE Jobs SET lease_expires = ?, updated = ?
+        WHERE job_id = ? AND worker = ? AND state = 'claimed'
+        """
+        now = time.time()
+        params = (now + lease_seconds, now, job_id, worker)
+        with self._lock:
+            cursor = self._conn.cursor().execute(query.strip(), params)
+            return cursor.rowcount == 1
+
+    def finish_job(
+        self, job_id, worker, state, result=None, error=None, max_attempts=1
+    ):
+        """Record the outcome of a claimed job.
+
+        Args:
+            job_id (int): the job
+            worker (str): the worker that claimed it
+            state (str): "done" or "failed"
+            result (str): the job's result, if any
+            error (str): why the job failed, if it did
+            max_attempts (int): a failed job that has been attempted fewer
+                                times than this becomes pending again
+
+        Returns:
+            bool: False if the worker no longer held the job
+        """
+        query = """
+        UPDATE Jobs SET
+            state = CASE
+                WHEN ? = 'failed' AND attempts < ? THEN 'pending'
+                ELSE ?
+            END,
+            worker = NULL, lease_expires = NULL,
+            result = ?, error = ?, updated = ?
+        WHERE job_id = ? AND worker = ? AND state = 'claimed'
+        """
+        params = (
+            state,
+            max_attempts,
+            state,
+            result,
+            error,
+            time.time(),
+            job_id,
+            worker,
+        )
+        with self._lock:
+            cursor = self._conn.cursor().execute(query.strip(), params)
+            return cursor.rowcount == 1
+
+    def job_counts(self, queue):
+        """Get the number of jobs in each state.
+
+        Returns:
+            dict: {state: count}, for states that have any jobs
+        """
+        query = (
+            "SELECT state, COUNT(*) FROM Jobs WHERE queue = ? GROUP BY state"
+        )
+        with self._lock:
+            rows = self._conn.cursor().execute(query, (queue,))
+            return {row[0]: row[1] for row in rows}
+
+    def explain(self, query, params=()):
+        """Get SQLite's query plan for a query.
+
+        Args:
+            query (str): an SQL query
+            params: the query's parameters
+
+        Returns:
+            list: the "detail" text of each step of the plan
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
+            rows = cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+            return [row["detail"] for row in rows]
+
     def cameras(self):
         query = "SELECT DISTINCT cam_instrument FROM Images"
-        return [row[0] for row in self._conn.cursor().execute(query)]
+        with self._lock:
+            return [row[0] for row in self._conn.cursor().execute(query)]
 
     def images_for_camera(self, camera, thumbnails=False):
         # Props to SQLAlchemy et al for their way of building queries
@@ -220,4 +1003,79 @@ class ImageDB:
         where_clause = " AND ".join(clauses)
         query = "SELECT * FROM Images WHERE " + where_clause
         sample_type = "Thumbnail" if thumbnails else "Full"
-        return self._conn.cursor().execute(query, (camera, sample_type))
+        with self._lock:
+            cursor = self._conn.cursor()
+            return cursor.execute(query, (camera, sample_type)).fetchall()
+
+    def pano_tiles_for_camera(self, camera):
+        """Get the candidate panorama tiles for a camera.
+
+        Args:
+            camera (str): camera instrument name
+
+        Returns:
+            list: rows of (site, drive, ext_sclk, x, y, w, h, image_id),
+            ordered by site, drive, ext_sclk and image_id
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
+            return cursor.execute(_pano_tiles_query, (camera,)).fetchall()
+
+    def pano_sets_for_camera(self, camera):
+        """Get the candidate panorama sets for a camera.
+
+        Tiles are grouped in the database, so each set costs one row.
+
+        Args:
+            camera (str): camera instrument name
+
+        Returns:
+            list: a PanoSet for each exposure with more than one tile,
+            ordered by site, drive and ext_sclk
+        """
+        query = _pano_sets_query.format("cam_instrument = ?\n  AND ")
+        return self._pano_sets(query, (camera,))
+
+    def pano_sets(self):
+        """Get the candidate panorama sets for all cameras, in one query.
+
+        Returns:
+            list: a PanoSet for each set, ordered by camera, then as for
+            pano_sets_for_camera
+        """
+        return self._pano_sets(_pano_sets_query.format(""))
+
+    def _pano_sets(self, query, params=()):
+        with self._lock:
+            rows = self._conn.cursor().execute(query, params).fetchall()
+        by_image_id = itemgetter("image_id")
+        return [
+            PanoSet(
+                row[0],
+                row[1],
+                row[2],
+                row[3],
+                sorted(json.loads(row[4]), key=by_image_id),
+            )
+            for row in rows
+        ]
+
+    def pano_tiles(self, image_ids):
+        """Get panorama tile records by image ID.
+
+        Args:
+            image_ids: iterable of image ID strings
+
+        Returns:
+            list: rows like those of pano_tiles_for_camera, in the order
+            of image_ids; unknown image IDs are omitted
+        """
+        image_ids = list(image_ids)
+        query = (
+            f"SELECT {_pano_tile_columns} FROM Images"
+            " WHERE image_id IN ({})"
+        )
+        rows = {
+            row["image_id"]: row for row in self._select_in(query, image_ids)
+        }
+        return [rows[image_id] for image_id in image_ids if image_id in rows]
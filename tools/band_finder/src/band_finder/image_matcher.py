@@ -4,39 +4,127 @@ image_matcher adjusts image contrast based on two image samples.
 Copyright 2021, Mitch Chapman  All rights reserved
 """
 
+import math
+
 import numpy as np
 
 
+def subsample(sample, budget):
+    """Get an evenly strided view of an image sample with at most budget
+    pixels.
+
+    Striding is applied along the sample's longer axis first, so narrow
+    overlap strips keep their full width where possible.
+
+    Args:
+        sample (array): rows x cols x channels image data
+        budget (int): the most pixels to keep, or None for all
+
+    Returns:
+        array: a view of sample
+    """
+    rows, cols = sample.shape[:2]
+    if budget is None or rows * cols <= budget:
+        return sample
+
+    budget = max(1, int(budget))
+    long_len, short_len = max(rows, cols), min(rows, cols)
+    # ceil(n / ceil(n / k)) <= k, so each axis keeps at most k pixels.
+    lines = budget // short_len
+    if lines > 0:
+        long_step = math.ceil(long_len / lines)
+        short_step = 1
+    else:
+        long_step = long_len
+        short_step = math.ceil(short_len / budget)
+
+    if rows >= cols:
+        return sample[::long_step, ::short_step]
+    return sample[::short_step, ::long_step]
+
+
 class ChannelAdjuster:
-    def __init__(self, src_sample, target_sample, channel, vmin, vmax):
+    def __init__(
+        self, src_sample, target_sample, channel, vmin, vmax, quantum=None
+    ):
         src = src_sample.astype(np.float64)
         targ = target_sample.astype(np.float64)
 
-        src_values = src[:, :, channel].flatten()
-        targ_values = targ[:, :, channel].flatten()
+        src_values = src[:, :, channel].ravel()
+        targ_values = targ[:, :, channel].ravel()
 
-        samples = dict()
-        for s, t in zip(src_values, targ_values):
-            samples.setdefault(s, []).append(t)
-
-        # Default the left and right edges to the channel extreme values.
-        value_map = {
-            vmin: vmin,
-            vmax: vmax
-        }
-        for s, tvals in samples.items():
-            value_map[s] = np.mean(tvals)
-
-        ordered_src = sorted(value_map.keys())
-        ordered_targ = [value_map[src] for src in ordered_src]
+        ordered_src, ordered_targ = self._mean_targets(
+            src_values, targ_values, vmin, vmax
+        )
 
         self._osrc = ordered_src
         self._otarg = ordered_targ
         self._channel = channel
 
+        self._vmin = vmin
+        self._quantum = quantum
+        self._lut = None
+        if quantum is not None:
+            # Precompute the mapping at every quantized value in
+            # vmin..vmax, so adjust() is a gather instead of an interp.
+            # The range need not be a whole number of quanta, so vmax
+            # always gets its own final entry.
+            num_steps = int(np.floor((vmax - vmin) / quantum)) + 1
+            grid = vmin + quantum * np.arange(num_steps, dtype=np.float64)
+            if grid[-1] < vmax:
+                grid = np.append(grid, vmax)
+            self._lut = np.interp(grid, self._osrc, self._otarg)
+
+    @staticmethod
+    def _mean_targets(src_values, targ_values, vmin, vmax):
+        # Map each distinct source value to the mean of the target values
+        # observed with it.  Group in numpy rather than in a Python loop --
+        # overlap strips can hold millions of samples.
+        usrc, inverse, counts = np.unique(
+            src_values, return_inverse=True, return_counts=True
+        )
+        sums = np.bincount(inverse.ravel(), weights=targ_values)
+        means = sums / counts
+
+        # Default the left and right edges to the channel extreme values,
+        # unless the samples already say something about them.
+        extremes = np.array(
+            [v for v in sorted({vmin, vmax}) if v not in usrc],
+            dtype=np.float64,
+        )
+        ordered_src = np.concatenate([usrc, extremes])
+        ordered_targ = np.concatenate([means, extremes])
+        order = np.argsort(ordered_src, kind="stable")
+        return ordered_src[order], ordered_targ[order]
+
+    def max_error(self):
+        """Get the worst-case difference between quantized and exact results.
+
+        In quantized mode each value is snapped to the nearest multiple of
+        the quantum (offset by vmin) before lookup.  Within vmin..vmax the
+        result therefore differs from np.interp by at most half a quantum
+        times the steepest slope of the mapping.  Values that already lie
+        on the quantization grid are mapped exactly.
+
+        Returns:
+            float: the error bound; 0.0 when not in quantized mode
+        """
+        if self._quantum is None:
+            return 0.0
+        dsrc = np.diff(self._osrc)
+        dtarg = np.abs(np.diff(self._otarg))
+        slopes = dtarg[dsrc > 0] / dsrc[dsrc > 0]
+        max_slope = np.max(slopes) if slopes.size else 0.0
+        return 0.5 * self._quantum * max_slope
+
     def adjust(self, image_data):
         values = image_data[:, :, self._channel]
-        new_values = np.interp(values, self._osrc, self._otarg)
+        if self._lut is None:
+            new_values = np.interp(values, self._osrc, self._otarg)
+        else:
+            indices = np.rint((values - self._vmin) / self._quantum)
+            np.clip(indices, 0, len(self._lut) - 1, out=indices)
+            new_values = self._lut[indices.astype(np.intp)]
         image_data[:, :, self._channel] = new_values
 
 
@@ -50,7 +138,9 @@ class ImageMatcher:
     It does this poorly, by considering image color components separately.
     """
 
-    def __init__(self, src_sample, target_sample):
+    def __init__(
+        self, src_sample, target_sample, quantum=None, sample_budget=None
+    ):
         """Create an instance.
         src_sample and target_sample are numpy image_data.
         Both show the same scene, but with potentially different colors -
@@ -61,9 +151,15 @@ class ImageMatcher:
             target_sample (array): A numpy image, depicting
                                    the same scene as src_sample but with
                                    possibly different color ranges
+            quantum (float): If provided, map channel values through
+                             lookup tables with this step size instead of
+                             interpolating each pixel.  See max_error().
+            sample_budget (int): If provided, fit the mapping to at most
+                                 this many evenly strided sample pixels.
+                                 Both samples must have the same shape.
         """
-        src = src_sample.astype(np.float64)
-        targ = target_sample.astype(np.float64)
+        src = subsample(src_sample, sample_budget).astype(np.float64)
+        targ = subsample(target_sample, sample_budget).astype(np.float64)
 
         # Assume Lab channels.
         # TODO let caller specify this, perhaps via a class method.
@@ -74,10 +170,28 @@ class ImageMatcher:
             [2, -128.0, 127.0]
         ]
         self._adjusters = [
-            ChannelAdjuster(src, targ, channel, vmin, vmax)
+            ChannelAdjuster(src, targ, channel, vmin, vmax, quantum)
             for channel, vmin, vmax in chan_info
         ]
 
+    def max_error(self):
+        """Get the worst-case per-channel deviation of quantized mode
+        from exact interpolation, for values within each channel's range.
+
+        Returns:
+            float: the largest ChannelAdjuster.max_error() of self's channels
+        """
+        return max(adjuster.max_error() for adjuster in self._adjusters)
+
+    def adjust(self, image):
+        """Adjust an image in place to match self's target_sample.
+
+        Args:
+            image (array): numpy float image array; modified in situ
+        """
+        for adjuster in self._adjusters:
+            adjuster.adjust(image)
+
     def adjusted(self, src_image):
         """Get a copy of a source image, adjusted to
         match self's target_sample.
@@ -88,9 +202,9 @@ class ImageMatcher:
             image (array): numpy image array
 
         Returns:
-            array: the adjusted image array
+            array: the adjusted image array, as floating point -- integer
+                   images are promoted, so adjusted values aren't truncated
         """
-        result = src_image.copy()
-        for adjuster in self._adjusters:
-            adjuster.adjust(result)
+        result = src_image.astype(np.result_type(np.float32, src_image))
+        self.adjust(result)
         return result
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+job_queue is a resumable work queue kept in the image database, so that
+any number of worker processes can share it.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import json
+import logging
+import os
+import socket
+import threading
+
+
+def logger():
+    return logging.getLogger(__name__)
+
+
+class Job(namedtuple("Job", "job_id name payload attempts")):
+    """A claimed job.  payload is the JSON-decoded value that was queued;
+    attempts counts this claim."""
+
+
+class JobQueue:
+    """
+    JobQueue hands out jobs from a table in an image_db.ImageDB.
+
+    A worker claims a job atomically, and holds it for a lease period,
+    which it renews while it works.  If the worker dies, its lease
+    expires and another worker may claim the job.  Jobs are retried up
+    to max_attempts times.
+
+    Workers on other hosts can share the queue if they share the
+    database file -- provided the filesystem supports SQLite's locking,
+    and the hosts' clocks roughly agree.
+    """
+
+    def __init__(
+        self,
+        db,
+        queue="default",
+        lease_seconds=300.0,
+        max_attempts=3,
+        worker_id=None,
+    ):
+        """Initialize a new instance.
+
+        Args:
+            db (image_db.ImageDB): the database holding the queue
+            queue (str): which queue to use
+            lease_seconds (float): how long a claim lasts unless renewed
+            max_attempts (int): how many times a job may be claimed
+            worker_id (str): identifies this worker in the database;
+                             defaults to hostname:pid
+        """
+        self._db = db
+        self._queue = queue
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+
+    def put(self, jobs, reset=False):
+        """Queue jobs.
+
+        Re-queueing a job under the same name replaces it if its payload
+        has changed; see ImageDB.enqueue_jobs.
+
+        Args:
+            jobs: iterable of (name, payload) pairs; payloads must be
+                  JSON-serializable
+            reset (bool): whether to re-run finished jobs regardless
+
+        Returns:
+            int: the number of jobs that became pending
+        """
+        encoded = (
+            (name, json.dumps(payload, sort_keys=True))
+            for name, payload in jobs
+        )
+        return self._db.enqueue_jobs(self._queue, encoded, reset)
+
+    def claim(self):
+        """Claim the next job.
+
+        Returns:
+            Job: the claimed job, or None if no job is claimable
+        """
+        row = self._db.claim_job(
+            self._queue,
+            self._worker_id,
+            self._lease_seconds,
+            self._max_attempts,
+        )
+        if row is None:
+            return None
+        payload = json.loads(row["payload"])
+        return Job(row["job_id"], row["name"], payload, row["attempts"])
+
+    def renew(self, job):
+        """Extend self's lease on a job.
+
+        Returns:
+            bool: False if self no longer holds the job
+        """
+        return self._db.renew_job_lease(
+            job.job_id, self._worker_id, self._lease_seconds
+        )
+
+    def complete(self, job, result=None):
+        """Record that a job succeeded.
+
+        Args:
+            job (Job): the job
+            result: JSON-serializable result, if any
+
+        Returns:
+            bool: False if self no longer held the job
+        """
+        return self._db.finish_job(
+            job.job_id,
+            self._worker_id,
+            "done",
+            result=json.dumps(result),
+        )
+
+    def fail(self, job, error):
+        """Record that a job failed.  It is retried if it has attempts
+        left.
+
+        Args:
+            job (Job): the job
+            error (str): what went wrong
+
+        Returns:
+            bool: False if self no longer held the job
+        """
+        return self._db.finish_job(
+            job.job_id,
+            self._worker_id,
+            "failed",
+            error=str(error),
+            max_attempts=self._max_attempts,
+        )
+
+    def counts(self):
+        """Get the number of jobs in each state.
+
+        Returns:
+            dict: {state: count}, for states that have any jobs
+        """
+        return self._db.job_counts(self._queue)
+
+    @contextmanager
+    def heartbeat(self, job, interval=None):
+        """Renew self's lease on a job periodically, for the duration of
+        a context.
+
+        Args:
+            job (Job): the job
+            interval (float): seconds between renewals; defaults to a
+                              third of the lease period
+        """
+        if interval is None:
+            interval = self._lease_seconds / 3
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                if not self.renew(job):
+                    logger().warning(f"Lost the lease on job {job.name}")
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield job
+        finally:
+            stop.set()
+            thread.join()
+
+    def gen_claimed(self):
+        """Claim jobs one at a time until none is claimable.
+
+        Yields:
+            Job: each claimed job.  The caller must complete or fail it
+            before asking for the next.
+        """
+        while True:
+            job = self.claim()
+            if job is None:
+                return
+            yield job
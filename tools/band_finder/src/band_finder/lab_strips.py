@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+lab_strips converts images between RGB and L*a*b* a strip of rows at a
+time, so that working memory depends on strip size, not image size.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+import numpy as np
+from skimage import color
+from skimage.util import img_as_float32, img_as_ubyte
+
+
+# (channel, min valid value, max valid value, always stretch to fit)
+LAB_RANGES = [
+    [0, 0.0, 100.0, True],
+    [1, -127.0, 128.0, False],
+    [2, -128.0, 127.0, False],
+]
+
+
+def _strips(num_rows, strip_rows):
+    for y0 in range(0, num_rows, strip_rows):
+        yield slice(y0, min(y0 + strip_rows, num_rows))
+
+
+def rgb_to_lab(image, strip_rows=256, out=None):
+    """Convert an RGB image to float32 L*a*b*.
+
+    Args:
+        image (array): rows x cols x 3 RGB image, of any skimage dtype
+        strip_rows (int): number of rows to convert at a time
+        out (array): If provided, a float32 rows x cols x 3 array to hold
+                     the result
+
+    Returns:
+        array: the L*a*b* image
+    """
+    if out is None:
+        out = np.empty(image.shape[:2] + (3,), dtype=np.float32)
+    for rows in _strips(image.shape[0], strip_rows):
+        out[rows] = color.rgb2lab(img_as_float32(image[rows]))
+    return out
+
+
+def lab_rescale_coefficients(lab_image, strip_rows=256):
+    """Get the per-channel scale and offset that fit an L*a*b* image
+    within the valid L*a*b* ranges.
+
+    L* is always stretched to fill 0..100.  a* and b* are rescaled only
+    if they exceed their valid ranges.
+
+    Args:
+        lab_image (array): rows x cols x 3 L*a*b* image
+        strip_rows (int): number of rows to examine at a time
+
+    Returns:
+        tuple: (scale, offset) arrays of length 3; rescaled values are
+               value * scale + offset
+    """
+    # From one of the scikit-image maintainers (I think):
+    # https://stackoverflow.com/a/28048090
+    # https://github.com/scikit-image/scikit-image/issues/1185
+    min_in = np.full(3, np.inf)
+    max_in = np.full(3, -np.inf)
+    for rows in _strips(lab_image.shape[0], strip_rows):
+        strip = lab_image[rows]
+        min_in = np.minimum(min_in, strip.min(axis=(0, 1)))
+        max_in = np.maximum(max_in, strip.max(axis=(0, 1)))
+
+    scale = np.ones(3)
+    offset = np.zeros(3)
+    for chan, min_valid, max_valid, stretch in LAB_RANGES:
+        lo, hi = min_in[chan], max_in[chan]
+        out_of_range = (hi > max_valid) or (lo < min_valid)
+        if (stretch or out_of_range) and hi > lo:
+            scale[chan] = (max_valid - min_valid) / (hi - lo)
+            offset[chan] = min_valid - lo * scale[chan]
+    return scale, offset
+
+
+def lab_to_rgb_ubyte(lab_image, strip_rows=256, rescale=True, out=None):
+    """Convert an L*a*b* image to 8-bit RGB, first rescaling it, if
+    requested, to fit within the valid L*a*b* ranges.
+
+    Each strip is rescaled in a reused float32 buffer, then converted.
+    lab_image is not modified.  It may be a memory-mapped array.
+    Compared to rescaling and converting the whole image in float64,
+    results differ by at most 1 in any channel value.
+
+    Args:
+        lab_image (array): rows x cols x 3 L*a*b* image
+        strip_rows (int): number of rows to convert at a time
+        rescale (bool): whether to rescale; see lab_rescale_coefficients
+        out (array): If provided, a uint8 rows x cols x 3 array to hold
+                     the result
+
+    Returns:
+        array: the RGB image
+    """
+    num_rows = lab_image.shape[0]
+    if out is None:
+        out = np.empty(lab_image.shape[:2] + (3,), dtype=np.uint8)
+    if rescale:
+        scale, offset = lab_rescale_coefficients(lab_image, strip_rows)
+    else:
+        scale, offset = np.ones(3), np.zeros(3)
+    scale = scale.astype(np.float32)
+    offset = offset.astype(np.float32)
+
+    buffer_shape = (min(strip_rows, num_rows),) + lab_image.shape[1:]
+    buffer = np.empty(buffer_shape, dtype=np.float32)
+    for rows in _strips(num_rows, strip_rows):
+        strip = buffer[:rows.stop - rows.start]
+        np.multiply(lab_image[rows], scale, out=strip, casting="unsafe")
+        strip += offset
+        out[rows] = img_as_ubyte(color.lab2rgb(strip))
+    return out
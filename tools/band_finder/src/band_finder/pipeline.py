@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+pipeline runs items through a sequence of concurrent stages, connected
+by bounded queues.
+Copyright 2021, Mitch Chapman  All rights reserved
+"""
+
+from collections import namedtuple
+import logging
+import queue
+import threading
+import time
+
+
+def logger():
+    return logging.getLogger(__name__)
+
+
+class Stage(namedtuple("Stage", "name func workers")):
+    """One step of a Pipeline.
+
+    func is applied to each item, on one of workers threads; its result
+    is passed to the next stage.
+    """
+
+    def __new__(cls, name, func, workers=1):
+        if workers < 1:
+            raise ValueError(f"Stage {name!r} needs at least one worker")
+        return super().__new__(cls, name, func, workers)
+
+
+StageStats = namedtuple("StageStats", "name items seconds")
+
+# Marks the end of a queue's input.
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Pipeline overlaps I/O-bound and CPU-bound work on a stream of items.
+
+    Each stage has its own worker threads.  Stages are connected by
+    queues holding at most queue_size items, so a fast stage waits for
+    a slow successor rather than piling up results in memory.
+    """
+
+    # How often, in seconds, blocked threads check for cancellation.
+    _poll_interval = 0.1
+
+    def __init__(self, stages, queue_size=4):
+        """Initialize a new instance.
+
+        Args:
+            stages: sequence of Stage, in processing order
+            queue_size (int): capacity of each queue between stages
+        """
+        self._stages = list(stages)
+        if not self._stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self._queue_size = queue_size
+        self._stats_lock = threading.Lock()
+        self._items = [0] * len(self._stages)
+        self._seconds = [0.0] * len(self._stages)
+
+    def run(self, items):
+        """Run items through all stages.
+
+        If any stage raises an exception, the pipeline stops and the
+        exception is re-raised here.
+
+        Args:
+            items: iterable of inputs to the first stage
+
+        Yields:
+            The results of the last stage, in order of completion
+        """
+        num_stages = len(self._stages)
+        queues = [queue.Queue(self._queue_size) for _ in range(num_stages)]
+        output = queue.Queue(self._queue_size)
+        queues.append(output)
+        stop = threading.Event()
+        errors = []
+
+        def fail(info):
+            errors.append(info)
+            stop.set()
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=self._poll_interval)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=self._poll_interval)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def feed():
+            try:
+                for item in items:
+                    if not put(queues[0], item):
+                        return
+            except Exception as info:
+                fail(info)
+                return
+            for _ in range(self._stages[0].workers):
+                put(queues[0], _DONE)
+
+        remaining = [stage.workers for stage in self._stages]
+        remaining_lock = threading.Lock()
+
+        def work(i):
+            stage = self._stages[i]
+            inq, outq = queues[i], queues[i + 1]
+            while True:
+                item = get(inq)
+                if item is _DONE:
+                    break
+                t0 = time.perf_counter()
+                try:
+                    result = stage.func(item)
+                except Exception as info:
+                    logger().debug(f"Stage {stage.name} failed: {info}")
+                    fail(info)
+                    return
+                dt = time.perf_counter() - t0
+                with self._stats_lock:
+                    self._items[i] += 1
+                    self._seconds[i] += dt
+                if not put(outq, result):
+                    return
+
+            # The last worker out tells the next stage there's no more.
+            with remaining_lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                successors = (
+                    self._stages[i + 1].workers if i + 1 < num_stages else 1
+                )
+                for _ in range(successors):
+                    put(outq, _DONE)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(self._stages):
+            threads.extend(
+                threading.Thread(
+                    target=work,
+                    args=(i,),
+                    name=f"{stage.name}-{j}",
+                    daemon=True,
+                )
+                for j in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = get(output)
+                if result is _DONE:
+                    break
+                yield result
+            if errors:
+                raise errors[0]
+        finally:
+            # Also reached if the caller abandons the results early.
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def stats(self):
+        """Get the work done so far by each stage.
+
+        Returns:
+            list: a StageStats for each stage -- the number of items it
+                  has processed, and the total time its workers spent
+                  processing them
+        """
+        with self._stats_lock:
+            return [
+                StageStats(stage.name, items, seconds)
+                for stage, items, seconds in zip(
+                    self._stages, self._items, self._seconds
+                )
+            ]
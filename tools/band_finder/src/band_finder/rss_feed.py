@@ -11,7 +11,19 @@ https://colab.research.google.com/drive/1SqTzhMo5NeVNZ6YTwsSpsssLH3vp5vX_?usp=sh
 Copyright 2021, Mitch Chapman  All rights reserved
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import math
+
 import requests
+from requests.adapters import HTTPAdapter
+
+
+def logger():
+    return logging.getLogger(__name__)
+
+
+RSS_API_URL = "https://mars.nasa.gov/rss/api/"
 
 # This is almost verbatim from fetch_m20_raw.py.
 INSTRUMENTS = {
@@ -66,12 +78,19 @@ def get_rqst_params(cameras=None, minsol=None, maxsol=None, num=10, page=1):
     return result
 
 
-def get_img_metadata(search_params):
-    req = requests.get(
-        "https://mars.nasa.gov/rss/api/",
-        params=search_params,
-        allow_redirects=True,
-    )
+def pooled_session(pool_size):
+    """Get a requests session that keeps up to pool_size connections
+    open per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_img_metadata(search_params, session=None, url=RSS_API_URL):
+    getter = session or requests
+    req = getter.get(url, params=search_params, allow_redirects=True)
 
     if req.status_code != 200:
         raise SystemExit(
@@ -80,3 +99,207 @@ def get_img_metadata(search_params):
         )
 
     return req.json()
+
+
+class FeedHarvester:
+    """
+    FeedHarvester retrieves all pages of an RSS feed query concurrently,
+    over a pooled session.
+    """
+
+    def __init__(self, max_workers=8, session=None, url=RSS_API_URL):
+        """Initialize a new instance.
+
+        Args:
+            max_workers (int): Maximum number of concurrent page requests
+            session (requests.Session): If provided, the session to use.
+                                        Defaults to a new pooled session.
+            url (str): The RSS API URL
+        """
+        self._max_workers = max_workers
+        self._session = session or pooled_session(max_workers)
+        self._url = url
+
+    def get_page(
+        self, page, num=1000, cameras=None, minsol=None, maxsol=None
+    ):
+        """Get one page of the feed.
+
+        Args:
+            page (int): 1-based page number
+
+        Returns:
+            dict: the page's JSON content
+        """
+        params = get_rqst_params(
+            cameras=cameras, minsol=minsol, maxsol=maxsol, num=num, page=page
+        )
+        return get_img_metadata(params, session=self._session, url=self._url)
+
+    def num_pages(self, num=1000, first_page=None, **query):
+        """Find the number of non-empty pages for a query.
+
+        The feed reports its total_results; if it doesn't, fall back to an
+        exponential, then binary, search for the last non-empty page.
+
+        Args:
+            num (int): records per page
+            first_page (dict): page 1's JSON content, if already retrieved
+            query: keyword args for get_rqst_params (cameras, minsol, maxsol)
+
+        Returns:
+            int: the number of pages
+        """
+        if first_page is None:
+            first_page = self.get_page(1, num, **query)
+        total = first_page.get("total_results")
+        if total is not None:
+            return math.ceil(int(total) / num)
+
+        if not first_page["images"]:
+            return 0
+
+        def is_empty(page):
+            return not self.get_page(page, num, **query)["images"]
+
+        # Gallop to find a page past the end...
+        known_full = 1
+        probe = 2
+        while not is_empty(probe):
+            known_full = probe
+            probe *= 2
+        # ...then bisect between the last full page and that one.
+        known_empty = probe
+        while known_empty - known_full > 1:
+            mid = (known_full + known_empty) // 2
+            if is_empty(mid):
+                known_empty = mid
+            else:
+                known_full = mid
+        return known_full
+
+    def gen_pages(self, num=1000, **query):
+        """Generate the records from every page of a query.
+
+        Pages are requested concurrently, at most max_workers at a time,
+        and are generated in the order in which they arrive.
+
+        Args:
+            num (int): records per page
+            query: keyword args for get_rqst_params (cameras, minsol, maxsol)
+
+        Yields:
+            tuple: (page number, list of image records)
+        """
+        first_page = self.get_page(1, num, **query)
+        if not first_page["images"]:
+            return
+        yield 1, first_page["images"]
+
+        last_page = self.num_pages(num, first_page=first_page, **query)
+        remaining = iter(range(2, last_page + 1))
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            pending = {}
+
+            def submit_next():
+                page = next(remaining, None)
+                if page is not None:
+                    future = executor.submit(self.get_page, page, num, **query)
+                    pending[future] = page
+
+            for _ in range(self._max_workers):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = pending.pop(future)
+                    submit_next()
+                    yield page, future.result()["images"]
+
+    def harvest(self, db, num=1000, on_page=None, **query):
+        """Add every record from a query to an image database.
+
+        Args:
+            db (image_db.ImageDB): the database to update
+            num (int): records per page
+            on_page: optional callable(records), called with the records
+                     of each non-empty page once they have been added
+            query: keyword args for get_rqst_params (cameras, minsol, maxsol)
+
+        Returns:
+            int: the number of records added or updated
+        """
+        total = 0
+        for page, records in self.gen_pages(num, **query):
+            if records:
+                db.add_or_update(records)
+                total += len(records)
+                if on_page is not None:
+                    on_page(records)
+            logger().info(f"Page {page}: added {len(records)} records.")
+        return total
+
+    def sync(self, db, num=1000, cameras=None, full=False):
+        """Bring an image database up to date with the feed.
+
+        The first sync of a query harvests every page.  Later syncs use the
+        recorded high-water mark: they request only sols at or after the
+        newest sol already ingested, and stop paging at the first page
+        whose records are all already known.
+
+        Args:
+            db (image_db.ImageDB): the database to update
+            num (int): records per page
+            cameras: optional list of camera or instrument names
+            full (bool): if True, ignore the high-water mark and harvest
+                         every page
+
+        Returns:
+            int: the number of records added or updated
+        """
+        feed = "raw_images"
+        search = get_search_param(cameras)
+        if search is not None:
+            feed = f"{feed}:{search}"
+
+        state = None if full else db.sync_state(feed)
+        if state is None:
+            return self._full_sync(db, feed, num, cameras)
+        return self._incremental_sync(db, feed, num, cameras, state["sol"])
+
+    def _full_sync(self, db, feed, num, cameras):
+        marks = []
+
+        def mark(records):
+            marks.append(db.sync_mark(records))
+
+        total = self.harvest(db, num, on_page=mark, cameras=cameras)
+        # Record the mark only once every page has been ingested, so an
+        # interrupted harvest is not mistaken for a complete one.
+        db.advance_sync_state(feed, max(marks, default=None))
+        return total
+
+    def _incremental_sync(self, db, feed, num, cameras, minsol):
+        total = 0
+        marks = []
+        page = 1
+        while True:
+            records = self.get_page(
+                page, num, cameras=cameras, minsol=minsol
+            )["images"]
+            if not records:
+                break
+            image_ids = [rec["imageid"] for rec in records]
+            if len(db.known_image_ids(image_ids)) == len(set(image_ids)):
+                logger().info(f"Page {page}: all records already known.")
+                break
+
+            db.add_or_update(records)
+            total += len(records)
+            marks.append(db.sync_mark(records))
+            logger().info(f"Page {page}: added {len(records)} records.")
+            if len(records) < num:
+                break
+            page += 1
+        db.advance_sync_state(feed, max(marks, default=None))
+        return total
@@ -21,8 +21,156 @@ class Edge(Enum):
     BOTTOM = "bottom"
 
 
+class TileBuffer:
+    """
+    TileBuffer holds image tiles in one contiguous buffer, keyed by
+    (for example) origin.  Tiles are copied in as they are added, so
+    callers need not keep their own copies.  The buffer grows as needed.
+    """
+
+    def __init__(self, capacity=0, dtype=None, memmap_path=None):
+        """Initialize a new instance.
+
+        Args:
+            capacity (int): number of elements to allocate up front, if
+                            the tiles' geometry is known
+            dtype: element type; defaults to the narrowest floating-point
+                   type that can hold the tiles' values
+            memmap_path (pathlib.Path): If provided, the buffer is a
+                                        memory-mapped file at this path.
+                                        Its dtype is fixed by the first
+                                        tile.
+        """
+        self._capacity = capacity
+        self._dtype = dtype
+        self._memmap_path = memmap_path
+        self._buffer = None
+        self._used = 0
+        self._layout = {}  # {key: (offset, shape)}
+
+    @property
+    def array(self):
+        """The buffer holding the tiles, or None if self is empty."""
+        return self._buffer
+
+    def keys(self):
+        return self._layout.keys()
+
+    def __contains__(self, key):
+        return key in self._layout
+
+    def layout(self):
+        """Get the location of each tile in self's buffer.
+
+        Returns:
+            dict: {key: (element offset, tile shape)}
+        """
+        return dict(self._layout)
+
+    def add(self, key, tile):
+        """Copy a tile into self.
+
+        Args:
+            key: identifies the tile
+            tile (array): the tile's image data
+
+        Returns:
+            array: the tile's view in self's buffer.  It is valid until
+                   the next call to add().
+        """
+        if key in self._layout:
+            raise ValueError(f"Duplicate tile {key}")
+        dtype = self._dtype
+        if dtype is None:
+            dtype = np.result_type(np.float32, tile)
+        needed = self._used + tile.size
+        if self._buffer is None:
+            self._allocate(max(needed, self._capacity), dtype)
+        elif needed > self._buffer.size:
+            self._allocate(max(needed, 2 * self._buffer.size), dtype)
+        elif self._memmap_path is None and not np.can_cast(
+            dtype, self._buffer.dtype, "safe"
+        ):
+            self._allocate(self._buffer.size, dtype)
+
+        self._layout[key] = (self._used, tile.shape)
+        self._used = needed
+        view = self.view(key)
+        view[...] = tile
+        return view
+
+    def view(self, key):
+        """Get a tile, without copying it.  Changes to the tile change
+        self."""
+        offset, shape = self._layout[key]
+        size = int(np.prod(shape))
+        return self._buffer[offset:offset + size].reshape(shape)
+
+    def release(self, key):
+        """Forget a tile.  Once every tile is released, self lets go of
+        its buffer."""
+        self._layout.pop(key, None)
+        if not self._layout:
+            self._buffer = None
+            self._used = 0
+
+    def copy(self):
+        """Get an independent, in-memory copy of self."""
+        result = TileBuffer(dtype=self._dtype)
+        if self._buffer is not None:
+            result._buffer = self._buffer[:self._used].copy()
+        result._used = self._used
+        result._layout = dict(self._layout)
+        return result
+
+    def _allocate(self, capacity, dtype):
+        # Move self's tiles into a new buffer of capacity elements.
+        old = self._buffer
+        if self._memmap_path is None:
+            if old is not None:
+                dtype = np.result_type(dtype, old.dtype)
+            buffer = np.empty(capacity, dtype=dtype)
+            if old is not None:
+                buffer[:self._used] = old[:self._used]
+        elif old is None:
+            buffer = np.memmap(
+                self._memmap_path,
+                dtype=dtype,
+                mode="w+",
+                shape=(max(capacity, 1),),
+            )
+        else:
+            # Extend the file in place.
+            dtype = old.dtype
+            old.flush()
+            self._buffer = old = None
+            with open(self._memmap_path, "r+b") as outf:
+                outf.truncate(capacity * dtype.itemsize)
+            buffer = np.memmap(
+                self._memmap_path, dtype=dtype, mode="r+", shape=(capacity,)
+            )
+        self._buffer = buffer
+
+
 class TileImageGrid:
-    def __init__(self, tiles_by_origin):
+    def __init__(
+        self, tiles_by_origin, contiguous=False, memmap_path=None, dtype=None
+    ):
+        """Initialize a new instance.
+
+        Args:
+            tiles_by_origin (dict): {(x, y): tile image array}
+            contiguous (bool): If True, copy all tiles into one buffer.
+                               Tiles and edges are then views into that
+                               buffer, and multiply() and set_tile() update
+                               it in place.
+            memmap_path (pathlib.Path): If provided, the contiguous buffer
+                                        is a memory-mapped file at this
+                                        path.  Implies contiguous.
+            dtype: element type of the contiguous buffer; defaults to the
+                   narrowest floating-point type that can hold all of the
+                   tiles' values, since tiles are adjusted in place
+        """
         origins = np.array(list(tiles_by_origin.keys()))
         self._xvals = list(sorted(set(origins[:, 0])))
         self._yvals = list(sorted(set(origins[:, 1])))
@@ -37,9 +185,99 @@ class TileImageGrid:
                 logging.debug(f"Add tig entry {(iy, ix)} ({(yval, xval)})")
                 grid[iy, ix] = tiles_by_origin.get((xval, yval))
 
+        self._store = None
+        if contiguous or (memmap_path is not None):
+            self._pack(memmap_path, dtype)
+
+    @classmethod
+    def from_tile_buffer(cls, tile_buffer):
+        """Create an instance whose tiles are those of a TileBuffer keyed
+        by (x, y) origin.  The instance adjusts them in place.
+
+        Args:
+            tile_buffer (TileBuffer): the tiles
+
+        Returns:
+            TileImageGrid: the new, contiguous instance
+        """
+        tiles = {key: tile_buffer.view(key) for key in tile_buffer.keys()}
+        result = cls(tiles)
+        result._store = tile_buffer
+        return result
+
+    def _pack(self, memmap_path, dtype):
+        # Move all tiles into a single buffer.
+        tiles = [tile for tile in self._grid.flat if tile is not None]
+        if dtype is None:
+            dtype = np.result_type(np.float32, *tiles)
+        store = TileBuffer(
+            sum(tile.size for tile in tiles), dtype, memmap_path
+        )
+        for (iy, ix), tile in np.ndenumerate(self._grid):
+            if tile is not None:
+                store.add(self._origin(ix, iy), tile)
+        for (iy, ix), tile in np.ndenumerate(self._grid):
+            if tile is not None:
+                self._grid[iy, ix] = store.view(self._origin(ix, iy))
+        self._store = store
+
+    def _origin(self, xgrid, ygrid):
+        return (self._xvals[xgrid], self._yvals[ygrid])
+
+    @property
+    def _buffer(self):
+        return None if self._store is None else self._store.array
+
+    def is_contiguous(self):
+        """Find whether self's tiles live in a single buffer."""
+        return self._store is not None
+
+    def layout(self):
+        """Get the location of each tile in self's contiguous buffer.
+
+        Returns:
+            dict: {(xgrid, ygrid): (element offset, tile shape)}; empty if
+                  self is not contiguous
+        """
+        if self._store is None:
+            return {}
+        return {
+            (self._xvals.index(x), self._yvals.index(y)): v
+            for (x, y), v in self._store.layout().items()
+        }
+
     def as_array(self):
         return self._grid
 
+    def canvas_shape(self):
+        """Get the shape of an image that would hold all of self's tiles.
+
+        Returns:
+            tuple: (height, width, channels) of the composite image
+        """
+        width = height = 0
+        channels = None
+        for (iy, ix), tile in np.ndenumerate(self._grid):
+            if tile is not None:
+                tile_h, tile_w = tile.shape[:2]
+                width = max(width, int(self._xvals[ix]) + tile_w)
+                height = max(height, int(self._yvals[iy]) + tile_h)
+                channels = tile.shape[-1]
+        return (height, width, channels)
+
+    def release_tile(self, xgrid, ygrid):
+        """Forget a tile, so its memory can be reclaimed.  The tile is
+        treated as missing from then on.
+
+        Args:
+            xgrid (int): x index of tile
+            ygrid (int): y index of tile
+        """
+        self._grid[ygrid, xgrid] = None
+        if self._store is not None:
+            # Once the last tile goes, so does the shared buffer.
+            self._store.release(self._origin(xgrid, ygrid))
+
     def shape(self):
         return self._grid.shape
 
@@ -148,7 +386,10 @@ class TileImageGrid:
         """
         tile = self._grid[ygrid, xgrid]
         if tile is not None:
-            self._grid[ygrid, xgrid] = tile * value
+            if self.is_contiguous():
+                tile *= value
+            else:
+                self._grid[ygrid, xgrid] = tile * value
 
     def tile_with_origin(self, xgrid, ygrid):
         """Get a tile, with its composite-image coordinates.
@@ -182,6 +423,18 @@ class TileImageGrid:
         """
         return self._grid[ygrid, xgrid].copy()
 
+    def tile_view(self, xgrid, ygrid):
+        """Get the specified tile, without copying it.
+
+        Args:
+            xgrid (int): x index of tile
+            ygrid (int): y index of tile
+
+        Returns:
+            the requested tile, or None.  Changes to the tile change self.
+        """
+        return self._grid[ygrid, xgrid]
+
     def set_tile(self, xgrid, ygrid, new_tile_data):
         """Replace a tile
 
@@ -199,4 +452,7 @@ class TileImageGrid:
             )
         if new_tile_data.shape == tuple():
             raise ValueError(f"Invalid tile {new_tile_data}.")
-        self._grid[ygrid, xgrid] = new_tile_data
+        if self.is_contiguous() and curr_val.shape == new_tile_data.shape:
+            curr_val[...] = new_tile_data
+        else:
+            self._grid[ygrid, xgrid] = new_tile_data
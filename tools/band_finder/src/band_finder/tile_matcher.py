@@ -5,12 +5,14 @@ Copyright 2021, Mitch Chapman  All rights reserved
 """
 # ^^^ /minimizes/tries to minimize/  :)
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
 
 import numpy as np
 
-from .tile_image_grid import TileImageGrid, Edge
+from .tile_image_grid import TileBuffer, TileImageGrid, Edge
 from .image_matcher import ImageMatcher
+from .brightness_solver import OverlapEdge, overlap_stats, solve_gain_offset
 
 
 def logger():
@@ -22,9 +24,49 @@ class TileMatcher:
     TileMatcher minimizes variations in brightness among image tiles.
     """
 
-    def __init__(self, name="unnamed"):
+    def __init__(
+        self,
+        name="unnamed",
+        max_workers=None,
+        mode="sequential",
+        sample_budget=None,
+        contiguous=False,
+        capacity=0,
+    ):
+        """Initialize a new instance.
+
+        Args:
+            name (str): name of the composite image
+            max_workers (int): If greater than 1, match independent tiles
+                               (or, in "global" mode, compute overlap
+                               statistics) concurrently on this many
+                               threads.  The result is the same either way.
+            mode (str): "sequential" matches each tile's value curves to
+                        its left (or upper) neighbour in turn.  "global"
+                        solves for a per-channel gain and offset for every
+                        tile at once, from statistics of all overlaps.
+            sample_budget (int): If provided, fit each sequential-mode
+                                 mapping to at most this many strided
+                                 overlap pixels.  Full-resolution tiles
+                                 are still adjusted.
+            contiguous (bool): If True, copy tiles into one contiguous
+                               buffer as they are added, and adjust them
+                               there in place.  Callers need not keep
+                               their own copies of the tiles.
+            capacity (int): In contiguous mode, the number of elements
+                            to allocate up front, if the tiles' geometry
+                            is known.  Otherwise the buffer grows as
+                            tiles are added.
+        """
+        if mode not in ("sequential", "global"):
+            raise ValueError(f"Unknown matching mode {mode!r}")
         self._name = name
+        self._mode = mode
+        self._max_workers = max_workers
+        self._sample_budget = sample_budget
         self._tiles_by_origin = {}  # {(left, top): tile}
+        self._capacity = capacity
+        self._tile_buffer = TileBuffer(capacity) if contiguous else None
         self._diag_plot = None
 
     def add(self, tile_image, origin):
@@ -37,24 +79,50 @@ class TileMatcher:
         Raises:
             ValueError: if a tile has already been added for the given origin
         """
-        if origin in self._tiles_by_origin:
+        if origin in self._tiles_by_origin or (
+            self._tile_buffer is not None and origin in self._tile_buffer
+        ):
             raise ValueError(f"Duplicate tile origin {origin}")
 
         logger().debug(
             f"Adding shape {tile_image.shape}, type {tile_image.dtype}"
         )
 
-        self._tiles_by_origin[origin] = tile_image
+        if self._tile_buffer is not None:
+            self._tile_buffer.add(origin, tile_image)
+        else:
+            self._tiles_by_origin[origin] = tile_image
 
-    def composite(self):
+    def composite(self, canvas_path=None, release_tiles=False):
         """Get a consistent-brightness composite image from self's tiles.
 
+        Args:
+            canvas_path (pathlib.Path): If provided, build the composite in
+                                        a memory-mapped .npy file at this
+                                        path, rather than in memory.
+            release_tiles (bool): If True, let go of each tile once it has
+                                  been placed in the composite, so its
+                                  memory can be reclaimed.  self is then
+                                  empty.
+
         Returns:
             array: The composite image array -- note that the representation
                    is not guaranteed.
         """
 
-        grid = TileImageGrid(self._tiles_by_origin)
+        if self._tile_buffer is None:
+            grid = TileImageGrid(self._tiles_by_origin)
+        elif release_tiles:
+            # Adjust self's tiles where they lie.
+            grid = TileImageGrid.from_tile_buffer(self._tile_buffer)
+        else:
+            # Leave self's tiles as they were added.
+            grid = TileImageGrid.from_tile_buffer(self._tile_buffer.copy())
+        if release_tiles:
+            # The grid now holds the only references self had.
+            self._tiles_by_origin = {}
+            if self._tile_buffer is not None:
+                self._tile_buffer = TileBuffer(self._capacity)
         rows, cols = grid.shape()
         logger().debug(f"Created grid with shape {grid.shape()}")
 
@@ -63,19 +131,62 @@ class TileMatcher:
         # Strategy: march across the tiles, adjusting each to match
         # its "predecessors".  Apply adjustments, then renormalize the
         # component brightnesses across the whole image.
-        self._match_all_tiles(grid)
-        image_data = self._composited_tiles(grid)
+        corrections = None
+        if self._mode == "global":
+            corrections = self._global_corrections(grid)
+        else:
+            self._match_all_tiles(grid)
+        image_data = self._composited_tiles(
+            grid, corrections, canvas_path, release_tiles
+        )
 
         # self._diag_plot.finish()
 
         return image_data
 
     def _match_all_tiles(self, grid):
+        if (self._max_workers or 1) > 1:
+            self._match_all_tiles_concurrently(grid)
+            return
+
         h, w = grid.shape()
         for ygrid in range(h):
             for xgrid in range(w):
                 self._match_tile_to_predecessors(grid, xgrid, ygrid)
 
+    def _match_all_tiles_concurrently(self, grid):
+        # Each tile is matched to a single predecessor: the tile to its
+        # left, or in column 0 the tile above.  Schedule each tile as soon
+        # as its predecessor is done.  Once column 0 is under way, each
+        # row proceeds independently of the others.
+        h, w = grid.shape()
+        if h == 0 or w == 0:
+            return
+
+        def successors(xgrid, ygrid):
+            if xgrid + 1 < w:
+                yield (xgrid + 1, ygrid)
+            if xgrid == 0 and ygrid + 1 < h:
+                yield (0, ygrid + 1)
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+
+            def submit(xgrid, ygrid):
+                future = executor.submit(
+                    self._match_tile_to_predecessors, grid, xgrid, ygrid
+                )
+                pending[future] = (xgrid, ygrid)
+
+            pending = {}
+            submit(0, 0)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    xgrid, ygrid = pending.pop(future)
+                    future.result()
+                    for successor in successors(xgrid, ygrid):
+                        submit(*successor)
+
     def _match_tile_to_predecessors(self, grid, xgrid, ygrid):
         # Match the brightness of a tile to all adjacent tiles above or to
         # its left.
@@ -121,39 +232,93 @@ class TileMatcher:
     def _match_along(self, grid, xgrid, ygrid, edge, target_edge):
         # Tiles, therefore edges, may be missing.
         if (edge is not None) and (target_edge is not None):
+            matcher = ImageMatcher(
+                edge, target_edge, sample_budget=self._sample_budget
+            )
+            if grid.is_contiguous():
+                # Adjust the tile where it lies; there's nothing to return.
+                # (The matcher has already copied what it needs from edge.)
+                matcher.adjust(grid.tile_view(xgrid, ygrid))
+                return None
+
             # This may overwrite an existing subplot...
             curr_tile = grid.tile(xgrid, ygrid)
             # self._diag_plot.plot(xgrid, ygrid, curr_tile, edge, target_edge)
-            matcher = ImageMatcher(edge, target_edge)
             return matcher.adjusted(curr_tile)
 
-    def _composited_tiles(self, grid):
+    def _global_corrections(self, grid):
+        # Get {(xgrid, ygrid): (gains, offsets)} for all present tiles.
+        h, w = grid.shape()
+        indices = {}
+        for ygrid in range(h):
+            for xgrid in range(w):
+                if not grid.tile_is_missing(xgrid, ygrid):
+                    indices[(xgrid, ygrid)] = len(indices)
+        if not indices:
+            return {}
+
+        pairs = []
+        for (xgrid, ygrid) in indices:
+            if (xgrid - 1, ygrid) in indices:
+                pairs.append(((xgrid - 1, ygrid), Edge.RIGHT, Edge.LEFT))
+            if (xgrid, ygrid - 1) in indices:
+                pairs.append(((xgrid, ygrid - 1), Edge.BOTTOM, Edge.TOP))
+
+        def edge_for(pair):
+            (xa, ya), edge_a, edge_b = pair
+            xb, yb = (xa + 1, ya) if edge_a == Edge.RIGHT else (xa, ya + 1)
+            sample_a = grid.edge(xa, ya, edge_a)
+            sample_b = grid.edge(xb, yb, edge_b)
+            if sample_a is None or sample_b is None:
+                return None
+            if sample_a.size == 0 or sample_b.size == 0:
+                return None
+            return OverlapEdge(
+                indices[(xa, ya)],
+                indices[(xb, yb)],
+                overlap_stats(sample_a),
+                overlap_stats(sample_b),
+            )
+
+        with ThreadPoolExecutor(max_workers=self._max_workers or 1) as ex:
+            edges = [e for e in ex.map(edge_for, pairs) if e is not None]
+
+        gains, offsets = solve_gain_offset(len(indices), edges)
+        return {
+            pos: (gains[i], offsets[i]) for pos, i in indices.items()
+        }
+
+    def _composited_tiles(
+        self, grid, corrections=None, canvas_path=None, release_tiles=False
+    ):
         logger = logging.getLogger(__name__)
 
-        width = height = 0
-        pixel_shape = None
-        records = []
+        result_shape = grid.canvas_shape()
+        logger.debug(f"Result shape: {result_shape}")
+        if canvas_path is None:
+            result = np.zeros(result_shape, dtype=np.float32)
+        else:
+            result = np.lib.format.open_memmap(
+                canvas_path, mode="w+", dtype=np.float32, shape=result_shape
+            )
 
         hgrid, wgrid = grid.shape()
-
         for ygrid in range(hgrid):
             for xgrid in range(wgrid):
                 rec = grid.tile_with_origin(xgrid, ygrid)
-                if rec is not None:
-                    records.append(rec)
-                    (tile, (x, y, w, h)) = rec
-                    tile_x_max = x + w
-                    tile_y_max = y + h
-                    width = max(width, tile_x_max)
-                    height = max(height, tile_y_max)
-                    pixel_shape = tile.shape[-1]
-                else:
+                if rec is None:
                     logger.warning(f"Blank tile at {(xgrid, ygrid)}")
+                    continue
 
-        result_shape = (height, width, pixel_shape)
-        logger.debug(f"Result shape: {result_shape}")
-        result = np.zeros(result_shape, dtype=np.float32)
-        for tile, rect in records:
-            x, y, w, h = rect
-            result[y:y + h, x:x + w] = tile
+                tile, (x, y, w, h) = rec
+                region = result[y:y + h, x:x + w]
+                if corrections is None:
+                    region[...] = tile
+                else:
+                    gains, offsets = corrections[(xgrid, ygrid)]
+                    np.multiply(tile, gains, out=region, casting="unsafe")
+                    region += offsets.astype(np.float32)
+                if release_tiles:
+                    del tile, rec
+                    grid.release_tile(xgrid, ygrid)
         return result
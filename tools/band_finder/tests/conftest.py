@@ -0,0 +1,14 @@
+"""
+Shared fixtures.
+"""
+
+import pytest
+
+from helpers import StandInServer
+
+
+@pytest.fixture
+def stand_in_server():
+    server = StandInServer()
+    yield server
+    server.shutdown()
@@ -0,0 +1,216 @@
+"""
+Test helpers: synthetic RSS feed records, panorama tiles and a local
+stand-in HTTP server.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from PIL import Image
+
+
+def make_feed_record(
+    image_id, sol=100, sclk=700000000.0, instrument="NAVCAM_LEFT", **kwargs
+):
+    """Make a synthetic record shaped like an RSS feed "images" entry."""
+    rect = kwargs.get("rect", (1, 1, 1288, 968))
+    return {
+        "imageid": image_id,
+        "sol": sol,
+        "credit": "NASA/JPL-Caltech",
+        "caption": "A synthetic image.",
+        "title": f"Sol {sol}: {instrument}",
+        "camera": {
+            "instrument": instrument,
+            "filter_name": "UNK",
+            "camera_model_component_list": "UNK",
+            "camera_model_type": "UNK",
+            "camera_position": "UNK",
+        },
+        "sample_type": kwargs.get("sample_type", "Full"),
+        "json_link": f"https://example.invalid/{image_id}.json",
+        "image_files": {
+            "full_res": kwargs.get(
+                "url", f"https://example.invalid/{image_id}.png"
+            ),
+        },
+        "attitude": "(0.1,0.2,0.3,0.4)",
+        "drive": str(kwargs.get("drive", 10)),
+        "site": str(kwargs.get("site", 2)),
+        "date_taken_utc": "2021-03-01T12:34:56.789",
+        "extended": {
+            "mastAz": "UNK",
+            "mastEl": "UNK",
+            "sclk": str(sclk),
+            "scaleFactor": str(kwargs.get("scale_factor", 1)),
+            "xyz": "(1.0,2.0,3.0)",
+            "dimension": "(1288,968)",
+            "subframeRect": "({},{},{},{})".format(*rect),
+        },
+    }
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.server.requests.append(
+            (parts.path, query, self.headers.get("Range"))
+        )
+        status, headers, body = self.server.respond(
+            parts.path, query, self.headers
+        )
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if len(body) < int(headers.get("Content-Length", len(body))):
+            # Simulate a dropped connection.
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer:
+    """A local HTTP server whose responses come from a callable.
+
+    requests records (path, query, Range header) for each request.
+
+    Set `respond` to a callable(path, query, headers) that returns
+    (status, headers_dict, body_bytes).
+    """
+
+    def __init__(self):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.requests = []
+        self._httpd.respond = self._not_found
+        host, port = self._httpd.server_address
+        self.url = f"http://{host}:{port}"
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    @staticmethod
+    def _not_found(path, query, headers):
+        return 404, {}, b""
+
+    @property
+    def requests(self):
+        return self._httpd.requests
+
+    @property
+    def respond(self):
+        return self._httpd.respond
+
+    @respond.setter
+    def respond(self, func):
+        self._httpd.respond = func
+
+    def shutdown(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class StandInFeed:
+    """Serve feed records the way the RSS API does: sol desc, paged."""
+
+    def __init__(self, records, total_results=True):
+        self.records = records
+        self.total_results = total_results
+
+    def __call__(self, path, query, headers):
+        num = int(query.get("num", 10))
+        page = int(query.get("page", 0))
+        records = self.records
+        if "condition_2" in query:
+            minsol = int(query["condition_2"].split(":")[0])
+            records = [r for r in records if r["sol"] >= minsol]
+        records = sorted(records, key=lambda r: r["sol"], reverse=True)
+        result = {"images": records[page * num:(page + 1) * num]}
+        if self.total_results:
+            result["total_results"] = len(records)
+        body = json.dumps(result).encode("utf8")
+        return 200, {"Content-Type": "application/json"}, body
+
+
+def png_bytes(image_data):
+    """Encode a numpy image as PNG."""
+    buf = io.BytesIO()
+    Image.fromarray(image_data).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def make_png(seed, shape=(24, 32, 3)):
+    """Make a random uint8 image and its PNG encoding."""
+    rng = np.random.default_rng(seed)
+    image_data = rng.integers(0, 256, shape, dtype=np.uint8)
+    return image_data, png_bytes(image_data)
+
+
+def add_tiles(matcher, rows, cols, missing=(), dtype=None):
+    """Add overlapping Lab-ish tiles with differing brightness to a
+    TileMatcher."""
+    rng = np.random.default_rng(rows * 100 + cols)
+    h, w, overlap = 24, 32, 8
+    scene = rng.uniform(0.0, 100.0, (rows * h, cols * w, 3))
+    for iy in range(rows):
+        for ix in range(cols):
+            if (ix, iy) in missing:
+                continue
+            x = ix * (w - overlap)
+            y = iy * (h - overlap)
+            tile = scene[y:y + h, x:x + w] * rng.uniform(0.7, 1.3)
+            if dtype is not None:
+                tile = tile.astype(dtype)
+            matcher.add(tile, origin=(x, y))
+
+
+class StandInImages:
+    """Serve image files from a {path: bytes} dict, optionally slowly.
+
+    Honors single "bytes=N-" Range requests.  Paths listed in
+    truncate_at stop sending after that many bytes of the file.
+    """
+
+    def __init__(self, files, delay=0.0):
+        self.files = files
+        self.delay = delay
+        self.truncate_at = {}
+
+    def __call__(self, path, query, headers):
+        if self.delay:
+            time.sleep(self.delay)
+        body = self.files.get(path)
+        if body is None:
+            return 404, {}, b""
+
+        status = 200
+        start = 0
+        resp_headers = {"Content-Type": "image/png"}
+        range_hdr = headers.get("Range")
+        if range_hdr:
+            start = int(range_hdr.split("=")[1].rstrip("-"))
+            if start >= len(body):
+                return 416, {}, b""
+            status = 206
+            resp_headers["Content-Range"] = (
+                f"bytes {start}-{len(body) - 1}/{len(body)}"
+            )
+
+        content = body[start:]
+        resp_headers["Content-Length"] = str(len(content))
+        stop = self.truncate_at.get(path)
+        if stop is not None:
+            content = body[start:stop]
+        return status, resp_headers, content
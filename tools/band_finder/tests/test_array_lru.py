@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from band_finder.array_lru import ArrayLRU
+
+
+def _array(nbytes):
+    return np.zeros(nbytes, dtype=np.uint8)
+
+
+def test_evicts_by_bytes():
+    lru = ArrayLRU(100)
+    lru.put("a", _array(40))
+    lru.put("b", _array(40))
+    assert lru.get("a") is not None  # "b" is now least recently used
+    lru.put("c", _array(40))
+
+    assert lru.get("b") is None
+    assert lru.get("a") is not None
+    assert lru.get("c") is not None
+
+    stats = lru.stats()
+    assert (stats.hits, stats.misses, stats.evictions) == (3, 1, 1)
+    assert (stats.entries, stats.nbytes) == (2, 80)
+
+
+def test_oversized_and_replaced():
+    lru = ArrayLRU(100)
+    lru.put("big", _array(101))
+    assert lru.get("big") is None
+
+    lru.put("a", _array(60))
+    lru.put("a", _array(30))
+    assert lru.stats().nbytes == 30
+    lru.discard("a")
+    assert lru.stats().nbytes == 0
+
+
+def test_concurrent_use():
+    lru = ArrayLRU(1000)
+
+    def work(i):
+        key = i % 37
+        if lru.get(key) is None:
+            lru.put(key, _array(10 + key))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(work, range(5000)))
+
+    stats = lru.stats()
+    assert stats.hits + stats.misses == 5000
+    assert stats.nbytes <= 1000
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from skimage import io
+
+from band_finder.bayer_to_rgb import bayer_to_rgb, demosaic, demosaic_all
+
+
+@pytest.mark.parametrize("tile_set", [0, 1])
+def test_demosaic_matches_bayer_to_rgb(tile_set):
+    here = Path(__file__).resolve().parent
+    raw = io.imread(here / "data" / "tiles" / str(tile_set) / "left_tile.png")
+
+    expected = bayer_to_rgb(raw)
+    actual = demosaic(raw)
+    assert actual.dtype == raw.dtype
+    diff = np.abs(actual.astype(int) - expected.astype(int))
+    assert diff.max() <= 1
+
+
+@pytest.mark.parametrize("algorithm", ["bilinear", "vng", "edge_aware"])
+def test_demosaic_algorithms(algorithm):
+    rng = np.random.default_rng(5)
+    raws = [rng.integers(0, 256, (32, 48), dtype=np.uint8) for _ in range(5)]
+    results = demosaic_all(raws, algorithm=algorithm, max_workers=3)
+    for raw, rgb in zip(raws, results):
+        assert rgb.shape == raw.shape + (3,)
+        assert np.array_equal(rgb, demosaic(raw, algorithm))
+
+    wide = raws[0].astype(np.uint16) * 257
+    if algorithm == "vng":
+        with pytest.raises(ValueError):
+            demosaic(wide, algorithm)
+    else:
+        assert demosaic(wide, algorithm).dtype == np.uint16
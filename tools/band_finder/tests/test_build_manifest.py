@@ -0,0 +1,93 @@
+from band_finder.build_manifest import BuildManifest, build_key
+from band_finder.image_cache import ImageCache
+from band_finder.image_db import ImageDB
+
+from helpers import StandInImages, make_feed_record, make_png
+
+
+def _setup(server, tmp_path, num_images):
+    files = {}
+    records = []
+    for i in range(num_images):
+        image_id = f"NLE_{i:04d}"
+        _, files[f"/{image_id}.png"] = make_png(i)
+        url = f"{server.url}/{image_id}.png"
+        records.append(make_feed_record(image_id, url=url))
+    server.respond = StandInImages(files)
+
+    db = ImageDB(tmp_path / "images.db")
+    db.add_or_update(records)
+    cache = ImageCache(db, cache_dir=tmp_path / "image_cache")
+    return db, cache, files
+
+
+def test_build_key():
+    ids = ["b", "a"]
+    prints = {"a": "1", "b": "2"}
+    key = build_key(ids, prints, "1")
+    # Order of the image IDs does not matter.
+    assert build_key(["a", "b"], prints, "1") == key
+    assert build_key(["a", "b", "c"], prints, "1") != key
+    assert build_key(ids, {"a": "1", "b": "3"}, "1") != key
+    assert build_key(ids, prints, "2") != key
+
+
+def test_manifest(stand_in_server, tmp_path):
+    db, cache, files = _setup(stand_in_server, tmp_path, 3)
+    manifest = BuildManifest(db, cache, version=1)
+    output = tmp_path / "pano.png"
+    ids = ["NLE_0000", "NLE_0001"]
+
+    # Not built yet.
+    assert not manifest.is_current(output, ids)
+    for image_id in ids:
+        cache.fetch(image_id)
+    output.write_bytes(b"pano")
+    manifest.record(output, ids)
+    assert manifest.is_current(output, ids)
+
+    # Another run, with a fresh connection, sees the same state.
+    db = ImageDB(tmp_path / "images.db")
+    cache = ImageCache(db, cache_dir=tmp_path / "image_cache")
+    assert BuildManifest(db, cache, version=1).is_current(output, ids)
+    assert not BuildManifest(db, cache, version=2).is_current(output, ids)
+
+    # The set gained a tile.
+    assert not manifest.is_current(output, ids + ["NLE_0002"])
+
+    # A tile's content changed.
+    files["/NLE_0001.png"] = make_png(99)[1]
+    (tmp_path / "image_cache" / "NLE_0001.png").unlink()
+    db.forget_cached_file(cache._cache_key, "NLE_0001.png")
+    cache.fetch("NLE_0001")
+    assert not manifest.is_current(output, ids)
+
+    # The output was removed.
+    manifest.record(output, ids)
+    assert manifest.is_current(output, ids)
+    output.unlink()
+    assert not manifest.is_current(output, ids)
+
+
+def test_reindexed_cache_keeps_build_current(stand_in_server, tmp_path):
+    # The images were cached before the cache had an index.
+    cache_dir = tmp_path / "image_cache"
+    cache_dir.mkdir()
+    for i in range(2):
+        (cache_dir / f"NLE_{i:04d}.png").write_bytes(make_png(i)[1])
+    db, cache, files = _setup(stand_in_server, tmp_path, 2)
+    ids = list(cache.fingerprints(["NLE_0000", "NLE_0001"]))
+    manifest = BuildManifest(db, cache, version=1)
+    output = tmp_path / "pano.png"
+    output.write_bytes(b"pano")
+    manifest.record(output, ids)
+    assert not stand_in_server.requests
+
+    # Evicting and downloading again doesn't change the content's
+    # fingerprint.
+    (cache_dir / "NLE_0001.png").unlink()
+    db.forget_cached_file(cache._cache_key, "NLE_0001.png")
+    assert manifest.is_current(output, ids)
+    cache.fetch("NLE_0001")
+    assert stand_in_server.requests
+    assert manifest.is_current(output, ids)
@@ -0,0 +1,308 @@
+from pathlib import Path
+import time
+
+import numpy as np
+import pytest
+
+from band_finder.bayer_to_rgb import demosaic
+from band_finder.image_cache import ImageCache
+from band_finder.image_db import ImageDB
+
+from helpers import StandInImages, make_feed_record, make_png
+
+
+def _setup(server, tmp_path, num_images):
+    files = {}
+    expected = {}
+    records = []
+    for i in range(num_images):
+        image_id = f"NLF_{i:04d}"
+        expected[image_id], files[f"/{image_id}.png"] = make_png(i)
+        url = f"{server.url}/{image_id}.png"
+        records.append(make_feed_record(image_id, url=url))
+    server.respond = StandInImages(files)
+
+    db = ImageDB(tmp_path / "images.db")
+    db.add_or_update(records)
+    cache = ImageCache(db, cache_dir=tmp_path / "image_cache")
+    return cache, files, expected
+
+
+def test_get_image(stand_in_server, tmp_path):
+    cache, _, expected = _setup(stand_in_server, tmp_path, 1)
+    image = cache.get_image("NLF_0000")
+    assert np.array_equal(image, expected["NLF_0000"])
+    # Served from the cache the second time.
+    num_requests = len(stand_in_server.requests)
+    image = cache.get_image("NLF_0000")
+    assert np.array_equal(image, expected["NLF_0000"])
+    assert len(stand_in_server.requests) == num_requests
+
+
+def test_prefetch(stand_in_server, tmp_path):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 12)
+    cache.get_image("NLF_0003")
+    del files["/NLF_0005.png"]
+    stand_in_server.requests.clear()
+
+    image_ids = list(expected) + ["NO_SUCH_IMAGE"]
+    results = list(cache.prefetch(image_ids + ["NLF_0001"], 4))
+    assert len(results) == len(image_ids)
+    results = {r.image_id: r for r in results}
+
+    assert set(results) == set(image_ids)
+    failed = {image_id for image_id, r in results.items() if not r.ok()}
+    assert failed == {"NLF_0005", "NO_SUCH_IMAGE"}
+    assert isinstance(results["NO_SUCH_IMAGE"].error, LookupError)
+
+    # Already-cached images are not downloaded again.
+    requested = {path for path, _, _ in stand_in_server.requests}
+    assert "/NLF_0003.png" not in requested
+    assert len(requested) == 11
+
+    for image_id, result in results.items():
+        if result.ok():
+            assert result.path.exists()
+            assert np.array_equal(
+                cache.get_image(image_id), expected[image_id]
+            )
+
+
+def test_interrupted_download_resumes(stand_in_server, tmp_path):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 1)
+    body = files["/NLF_0000.png"]
+    stand_in_server.respond.truncate_at["/NLF_0000.png"] = len(body) // 2
+    # Whitebox: small chunks, so that some arrive before the disconnect.
+    cache._chunk_size = 64
+
+    with pytest.raises(Exception):
+        cache.get_image("NLF_0000")
+    # Nothing truncated is left where it would be mistaken for an image.
+    cache_dir = tmp_path / "image_cache"
+    assert not (cache_dir / "NLF_0000.png").exists()
+    part_size = (cache_dir / "NLF_0000.png.part").stat().st_size
+    assert 0 < part_size <= len(body) // 2
+
+    stand_in_server.respond.truncate_at.clear()
+    stand_in_server.requests.clear()
+    image = cache.get_image("NLF_0000")
+    assert np.array_equal(image, expected["NLF_0000"])
+    assert (cache_dir / "NLF_0000.png").read_bytes() == body
+    assert not (cache_dir / "NLF_0000.png.part").exists()
+    range_hdr = stand_in_server.requests[0][2]
+    assert range_hdr == f"bytes={part_size}-"
+
+
+def test_mismatched_resume_starts_over(stand_in_server, tmp_path):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 1)
+    body = files["/NLF_0000.png"]
+    cache_dir = tmp_path / "image_cache"
+    cache_dir.mkdir()
+    (cache_dir / "NLF_0000.png.part").write_bytes(body[:100])
+
+    serve = stand_in_server.respond
+
+    def respond(path, query, headers):
+        if "Range" not in headers:
+            return serve(path, query, headers)
+        # Partial content, but not from the requested offset.
+        content = body[50:]
+        resp_headers = {
+            "Content-Range": f"bytes 50-{len(body) - 1}/{len(body)}",
+            "Content-Length": str(len(content)),
+        }
+        return 206, resp_headers, content
+
+    stand_in_server.respond = respond
+    image = cache.get_image("NLF_0000")
+    assert np.array_equal(image, expected["NLF_0000"])
+    assert (cache_dir / "NLF_0000.png").read_bytes() == body
+    assert not (cache_dir / "NLF_0000.png.part").exists()
+    assert [hdr for _, _, hdr in stand_in_server.requests] == [
+        "bytes=100-",
+        None,
+    ]
+
+
+def test_memory_cache(stand_in_server, tmp_path):
+    cache, _, expected = _setup(stand_in_server, tmp_path, 3)
+    cache = ImageCache(
+        cache._db, cache_dir=tmp_path / "image_cache", memory_limit=10**6
+    )
+    first = cache.get_image("NLF_0001")
+    assert not first.flags.writeable
+
+    # Served from memory, without touching the disk cache.
+    (tmp_path / "image_cache" / "NLF_0001.png").unlink()
+    assert cache.get_image("NLF_0001") is first
+
+    stats = cache.memory_stats()
+    assert (stats.hits, stats.misses) == (1, 1)
+    assert stats.nbytes == expected["NLF_0001"].nbytes
+
+
+def test_decoded_tier(stand_in_server, tmp_path):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 2)
+    cache_dir = tmp_path / "image_cache"
+    cache = ImageCache(cache._db, cache_dir=cache_dir, decoded_tier=True)
+
+    image = cache.get_image("NLF_0000")
+    assert isinstance(image, np.memmap)
+    assert np.array_equal(image, expected["NLF_0000"])
+    decoded = list((cache_dir / "decoded").glob("NLF_0000.png.*.npy"))
+    assert len(decoded) == 1
+
+    # Another instance reuses the decoded file.
+    other = ImageCache(cache._db, cache_dir=cache_dir, decoded_tier=True)
+    again = other.get_image("NLF_0000")
+    assert isinstance(again, np.memmap)
+    assert again.filename == image.filename
+
+    # Replacing the source image invalidates the decoded file.
+    replacement, png = make_png(99)
+    (cache_dir / "NLF_0000.png").write_bytes(png)
+    image = other.get_image("NLF_0000")
+    assert np.array_equal(image, replacement)
+    decoded = list((cache_dir / "decoded").glob("NLF_0000.png.*.npy"))
+    assert decoded == [Path(image.filename)]
+
+
+def test_demosaiced_tier(stand_in_server, tmp_path):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 1)
+    cache_dir = tmp_path / "image_cache"
+    cache = ImageCache(cache._db, cache_dir=cache_dir, decoded_tier=True)
+
+    rgb = cache.get_demosaiced_image("NLF_0000")
+    assert isinstance(rgb, np.memmap)
+    assert np.array_equal(rgb, demosaic(expected["NLF_0000"]))
+    assert list((cache_dir / "decoded").glob("NLF_0000.rgb.*.npy"))
+
+
+def test_quota_eviction(stand_in_server, tmp_path):
+    cache, files, _ = _setup(stand_in_server, tmp_path, 8)
+    cache_dir = tmp_path / "image_cache"
+    sizes = {path[1:-4]: len(body) for path, body in files.items()}
+    quota = sizes["NLF_0000"] + sizes["NLF_0001"] + sizes["NLF_0002"]
+    cache = ImageCache(cache._db, cache_dir=cache_dir, quota_bytes=quota)
+
+    cache.get_image("NLF_0000")
+    cache.pin(["NLF_0000"])
+    for result in cache.prefetch(list(sizes)[1:], max_workers=1):
+        assert result.ok()
+
+    assert cache.disk_usage() <= quota
+    on_disk = sorted(path.stem for path in cache_dir.glob("*.png"))
+    assert "NLF_0000" in on_disk
+    assert sum(sizes[image_id] for image_id in on_disk) == cache.disk_usage()
+    # The most recent download is never the one evicted.
+    assert len(on_disk) >= 2
+
+
+def test_cache_hits_batched(stand_in_server, tmp_path):
+    cache, _, expected = _setup(stand_in_server, tmp_path, 3)
+    for image_id in expected:
+        cache.get_image(image_id)
+
+    def last_access():
+        query = "SELECT path, last_access FROM CachedFiles"
+        return dict(cache._db.cursor().execute(query).fetchall())
+
+    before = last_access()
+    statements = []
+    cache._db._conn.set_trace_callback(statements.append)
+    for _ in range(10):
+        for image_id in expected:
+            cache.get_image(image_id)
+    cache._db._conn.set_trace_callback(None)
+    # Hits don't write until a batch fills or is flushed.
+    assert not [sql for sql in statements if sql.startswith("UPDATE")]
+
+    cache.flush_touches()
+    after = last_access()
+    assert all(after[path] > before[path] for path in before)
+
+
+@pytest.mark.parametrize("eviction", ["lru", "size"])
+def test_quota_with_decoded_tier(stand_in_server, tmp_path, eviction):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 2)
+    cache_dir = tmp_path / "image_cache"
+    quota = len(files["/NLF_0001.png"]) + 10
+    cache = ImageCache(
+        cache._db,
+        cache_dir=cache_dir,
+        decoded_tier=True,
+        quota_bytes=quota,
+        eviction=eviction,
+    )
+
+    for image_id in ["NLF_0000", "NLF_0001"]:
+        # The decoded file alone exceeds the quota.  Neither it nor the
+        # image it was decoded from may be evicted to make room.
+        image = cache.get_image(image_id)
+        assert np.array_equal(image, expected[image_id])
+        assert (cache_dir / f"{image_id}.png").exists()
+        assert list((cache_dir / "decoded").glob(f"{image_id}.*.npy"))
+
+    # Making room for the second image evicted the first.
+    assert not (cache_dir / "NLF_0000.png").exists()
+    assert not list((cache_dir / "decoded").glob("NLF_0000.*.npy"))
+
+
+def test_reindex_existing_cache(stand_in_server, tmp_path):
+    cache_dir = tmp_path / "image_cache"
+    cache_dir.mkdir()
+    image_data, png = make_png(5)
+    (cache_dir / "NLF_0000.png").write_bytes(png)
+
+    cache, _, _ = _setup(stand_in_server, tmp_path, 1)
+    assert cache.disk_usage() == len(png)
+    assert np.array_equal(cache.get_image("NLF_0000"), image_data)
+    assert not stand_in_server.requests
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_get_images(stand_in_server, tmp_path, ordered):
+    cache, _, expected = _setup(stand_in_server, tmp_path, 40)
+    for image_id in list(expected)[:10]:
+        cache.get_image(image_id)
+    image_ids = list(expected) + ["NO_SUCH_IMAGE"]
+
+    statements = []
+    cache._db._conn.set_trace_callback(statements.append)
+    results = list(cache.get_images(image_ids, ordered=ordered))
+    cache._db._conn.set_trace_callback(None)
+
+    if ordered:
+        assert [image_id for image_id, _ in results] == image_ids
+    results = dict(results)
+    assert results.pop("NO_SUCH_IMAGE") is None
+    for image_id, image in results.items():
+        assert np.array_equal(image, expected[image_id])
+
+    # One lookup for all 40 tiles.
+    selects = [s for s in statements if s.lstrip().startswith("SELECT")]
+    assert len(selects) == 1
+
+
+def test_get_images_window(stand_in_server, tmp_path):
+    cache, _, expected = _setup(stand_in_server, tmp_path, 20)
+    images = cache.get_images(expected, max_workers=2, window=3)
+    next(images)
+    time.sleep(0.2)
+    # The first image, plus at most a window's worth loaded ahead.
+    assert len(stand_in_server.requests) <= 4
+    assert len(list(images)) == 19
+
+
+def test_fetch(stand_in_server, tmp_path):
+    cache, files, expected = _setup(stand_in_server, tmp_path, 2)
+    path = cache.fetch("NLF_0001")
+    assert path.read_bytes() == files["/NLF_0001.png"]
+
+    # Already cached: no request.
+    stand_in_server.requests.clear()
+    assert cache.fetch("NLF_0001") == path
+    assert not stand_in_server.requests
+
+    with pytest.raises(LookupError):
+        cache.fetch("NO_SUCH_IMAGE")
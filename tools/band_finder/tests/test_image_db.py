@@ -0,0 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from band_finder import image_db
+from band_finder.image_db import ImageDB
+
+from helpers import make_feed_record
+
+
+def _db(tmp_path):
+    return ImageDB(tmp_path / "images.db")
+
+
+def test_known_image_ids(tmp_path):
+    db = _db(tmp_path)
+    db.add_or_update([make_feed_record(f"ID_{i}") for i in range(5)])
+    assert db.known_image_ids(["ID_1", "ID_4", "ID_9"]) == {"ID_1", "ID_4"}
+
+
+def test_concurrent_writers(tmp_path):
+    # Threads share one connection; their transactions must not overlap.
+    db = _db(tmp_path)
+
+    def write(worker):
+        for batch in range(20):
+            records = [
+                make_feed_record(f"ID_{worker}_{batch}_{i}") for i in range(5)
+            ]
+            db.add_or_update(records)
+            db.record_cached_file("cache", f"{worker}_{batch}", "ID", 1)
+            db.known_image_ids(record["imageid"] for record in records)
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(write, range(4)))
+    assert len(db.cameras()) == 1
+    assert len(db.images_for_camera("NAVCAM_LEFT")) == 400
+    assert db.cached_bytes("cache") == 80
+
+
+def test_cache_updates_are_one_transaction(tmp_path):
+    db = _db(tmp_path)
+    paths = [f"{i}.png" for i in range(1200)]
+    for path in paths:
+        db.record_cached_file("cache", path, path[:-4], 1, last_access=0.0)
+
+    statements = []
+    db._conn.set_trace_callback(statements.append)
+    db.touch_cached_files("cache", paths)
+    db.pin_cached_images("cache", [path[:-4] for path in paths])
+    db._conn.set_trace_callback(None)
+    assert statements.count("BEGIN TRANSACTION") == 2
+    assert statements.count("COMMIT TRANSACTION") == 2
+
+    query = "SELECT MIN(last_access), MIN(pinned) FROM CachedFiles"
+    last_access, pinned = db.cursor().execute(query).fetchone()
+    assert last_access > 0.0
+    assert pinned == 1
+
+
+def test_sync_state_only_advances(tmp_path):
+    db = _db(tmp_path)
+    assert db.sync_state("raw_images") is None
+
+    newer = [make_feed_record("B", sol=12, sclk=2.0)]
+    older = [make_feed_record("A", sol=12, sclk=1.0)]
+    db.advance_sync_state("raw_images", db.sync_mark(newer))
+    db.advance_sync_state("raw_images", db.sync_mark(older))
+
+    state = db.sync_state("raw_images")
+    assert (state["sol"], state["ext_sclk"], state["image_id"]) == (
+        12,
+        2.0,
+        "B",
+    )
+
+
+def test_bulk_ingest(tmp_path):
+    db = _db(tmp_path)
+    records = [make_feed_record(f"ID_{i}", sclk=float(i)) for i in range(250)]
+    stats = db.bulk_ingest(iter(records), batch_size=100)
+    assert stats.records == 250
+    assert stats.rate > 0
+
+    row = db.cursor().execute(
+        "SELECT * FROM Images WHERE image_id = 'ID_7'"
+    ).fetchone()
+    assert row["ext_sclk"] == 7.0
+    assert (row["ext_sf_width"], row["ext_sf_height"]) == (1288, 968)
+    assert row["ext_mast_azimuth"] is None
+
+    # Loading settings are restored afterwards.
+    mode = db.cursor().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "delete"
+
+
+def _plan(db, query, params=()):
+    return "\n".join(db.explain(query, params))
+
+
+def test_camera_queries_use_index(tmp_path):
+    db = _db(tmp_path)
+    plan = _plan(db, "SELECT DISTINCT cam_instrument FROM Images")
+    assert "COVERING INDEX Images_pano_tiles" in plan
+
+    query = (
+        "SELECT * FROM Images WHERE cam_instrument = ? AND sample_type = ?"
+    )
+    plan = _plan(db, query, ("NAVCAM_LEFT", "Full"))
+    assert "USING INDEX Images_pano_tiles" in plan
+    assert "SCAN" not in plan
+
+
+def test_pano_tiles_query_is_covered(tmp_path):
+    db = _db(tmp_path)
+    plan = _plan(db, image_db._pano_tiles_query, ("NAVCAM_LEFT",))
+    assert "USING COVERING INDEX Images_pano_tiles" in plan
+    # The index also provides the sort order.
+    assert "TEMP B-TREE" not in plan
+
+    db.add_or_update(
+        [
+            make_feed_record("NLE_2", sclk=2.0),
+            make_feed_record("NLE_1", sclk=2.0),
+            make_feed_record("NLF_3", sclk=2.0),
+            make_feed_record("NLE_4", sclk=1.0, scale_factor=2),
+        ]
+    )
+    rows = db.pano_tiles_for_camera("NAVCAM_LEFT")
+    assert [row["image_id"] for row in rows] == ["NLE_1", "NLE_2"]
+
+
+def test_pano_tiles_by_id(tmp_path):
+    db = _db(tmp_path)
+    db.add_or_update(
+        [
+            make_feed_record("NLE_1", sclk=2.0, rect=(1, 1, 64, 48)),
+            make_feed_record("NLE_2", sclk=2.0, rect=(65, 1, 64, 48)),
+        ]
+    )
+    rows = db.pano_tiles(["NLE_2", "NO_SUCH_IMAGE", "NLE_1"])
+    assert [row["image_id"] for row in rows] == ["NLE_2", "NLE_1"]
+    assert tuple(rows[0][key] for key in "xywh") == (65, 1, 64, 48)
+
+
+def test_pano_sets(tmp_path):
+    db = _db(tmp_path)
+    db.add_or_update(
+        [
+            make_feed_record("NLE_2", sclk=2.0, rect=(65, 1, 64, 48)),
+            make_feed_record("NLE_1", sclk=2.0, rect=(1, 1, 64, 48)),
+            make_feed_record("NLF_3", sclk=2.0),
+            # A set of one tile is not a panorama.
+            make_feed_record("NLE_4", sclk=3.0),
+            make_feed_record("NRE_5", sclk=2.0, instrument="NAVCAM_RIGHT"),
+            make_feed_record("NRE_6", sclk=2.0, instrument="NAVCAM_RIGHT"),
+            make_feed_record("NRE_7", sclk=2.0, instrument="NAVCAM_RIGHT"),
+        ]
+    )
+    plan = _plan(
+        db,
+        image_db._pano_sets_query.format("cam_instrument = ? AND "),
+        ("NAVCAM_LEFT",),
+    )
+    assert "USING COVERING INDEX Images_pano_tiles" in plan
+    plan = _plan(db, image_db._pano_sets_query.format(""))
+    assert "USING COVERING INDEX Images_pano_tiles" in plan
+
+    (left,) = db.pano_sets_for_camera("NAVCAM_LEFT")
+    assert (left.camera, left.site, left.drive, left.ext_sclk) == (
+        "NAVCAM_LEFT",
+        2,
+        10,
+        2.0,
+    )
+    assert left.tiles == [
+        {"image_id": "NLE_1", "x": 1, "y": 1, "w": 64, "h": 48},
+        {"image_id": "NLE_2", "x": 65, "y": 1, "w": 64, "h": 48},
+    ]
+
+    sets = db.pano_sets()
+    assert [s.camera for s in sets] == ["NAVCAM_LEFT", "NAVCAM_RIGHT"]
+    assert sets[0] == left
+    assert [t["image_id"] for t in sets[1].tiles] == [
+        "NRE_5",
+        "NRE_6",
+        "NRE_7",
+    ]
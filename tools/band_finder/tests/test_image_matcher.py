@@ -9,7 +9,7 @@ from skimage import io, color
 from skimage.util import img_as_uint, img_as_ubyte
 
 from band_finder.bayer_to_rgb import bayer_to_rgb
-from band_finder.image_matcher import ImageMatcher
+from band_finder.image_matcher import ChannelAdjuster, ImageMatcher, subsample
 
 
 def test_const_diff():
@@ -99,3 +99,130 @@ def test_sample_images_interactive(tile_set):
     _show(left_crop)
     _show(right_crop)
     _show(result_data)
+
+
+def _reference_curve(src_sample, target_sample, channel, vmin, vmax):
+    # The original, loop-based ChannelAdjuster mapping.
+    src_values = src_sample[:, :, channel].astype(np.float64).flatten()
+    targ_values = target_sample[:, :, channel].astype(np.float64).flatten()
+
+    samples = dict()
+    for s, t in zip(src_values, targ_values):
+        samples.setdefault(s, []).append(t)
+
+    value_map = {vmin: vmin, vmax: vmax}
+    for s, tvals in samples.items():
+        value_map[s] = np.mean(tvals)
+
+    ordered_src = sorted(value_map.keys())
+    ordered_targ = [value_map[src] for src in ordered_src]
+    return ordered_src, ordered_targ
+
+
+@pytest.mark.parametrize("quantized", [False, True])
+def test_channel_adjuster_matches_reference(quantized):
+    rng = np.random.default_rng(1234)
+    shape = (200, 16, 3)
+    src = rng.uniform(0.0, 100.0, shape)
+    if quantized:
+        # Few distinct values, including the channel extremes.
+        src = np.round(src / 5.0) * 5.0
+    targ = src * 0.8 + rng.normal(0.0, 2.0, shape)
+
+    for channel in range(3):
+        adjuster = ChannelAdjuster(src, targ, channel, 0.0, 100.0)
+        exp_src, exp_targ = _reference_curve(src, targ, channel, 0.0, 100.0)
+        assert np.array_equal(adjuster._osrc, exp_src)
+        assert np.allclose(adjuster._otarg, exp_targ, rtol=0, atol=1e-9)
+
+
+def test_quantized_matches_interp_within_bound():
+    rng = np.random.default_rng(42)
+    shape = (64, 16, 3)
+    src = rng.uniform(0.0, 100.0, shape)
+    src[:, :, 1:] -= 50.0
+    targ = src * 1.1 + 3.0
+
+    exact = ImageMatcher(src, targ)
+    quantized = ImageMatcher(src, targ, quantum=0.25)
+
+    image = rng.uniform(0.0, 100.0, (32, 32, 3))
+    image[:, :, 1:] -= 50.0
+    expected = exact.adjusted(image)
+
+    actual = image.copy()
+    quantized.adjust(actual)
+
+    bound = quantized.max_error()
+    assert 0.0 < bound
+    assert exact.max_error() == 0.0
+    assert np.max(np.abs(actual - expected)) <= bound + 1e-9
+
+
+def test_quantized_exact_on_grid():
+    rng = np.random.default_rng(7)
+    shape = (64, 16, 3)
+    src = np.round(rng.uniform(0.0, 100.0, shape))
+    src[:, :, 1:] -= 50.0
+    targ = src * 0.9
+
+    exact = ImageMatcher(src, targ)
+    quantized = ImageMatcher(src, targ, quantum=1.0)
+    assert np.allclose(quantized.adjusted(src), exact.adjusted(src))
+
+
+def test_quantized_partial_last_step():
+    # 0..101 is not a whole number of 3-unit steps; values near vmax must
+    # still be mapped within the error bound.
+    rng = np.random.default_rng(3)
+    src = rng.uniform(0.0, 101.0, (64, 16, 1))
+    adjuster = ChannelAdjuster(src, src, 0, 0.0, 101.0, quantum=3.0)
+    assert adjuster.max_error() == pytest.approx(1.5)
+
+    image = np.linspace(0.0, 101.0, 1011).reshape(1, -1, 1)
+    actual = image.copy()
+    adjuster.adjust(actual)
+    assert actual[0, -1, 0] == pytest.approx(101.0)
+    assert np.max(np.abs(actual - image)) <= adjuster.max_error() + 1e-9
+
+
+@pytest.mark.parametrize(
+    "shape, budget, expected",
+    [
+        ((968, 16), None, (968, 16)),
+        ((968, 16), 20000, (968, 16)),
+        ((968, 16), 1000, (61, 16)),
+        ((16, 1288), 2000, (16, 118)),
+        ((968, 16), 10, (1, 8)),
+    ],
+)
+def test_subsample(shape, budget, expected):
+    sample = np.zeros(shape + (3,))
+    result = subsample(sample, budget)
+    assert result.shape[:2] == expected
+    assert result.base is sample or result is sample
+    assert result.shape[0] * result.shape[1] <= (budget or sample.size)
+
+
+def test_subsample_within_budget():
+    for rows in range(1, 30):
+        for cols in range(1, 30):
+            sample = np.zeros((rows, cols, 3))
+            for budget in range(1, rows * cols + 1):
+                result = subsample(sample, budget)
+                assert result.shape[0] * result.shape[1] <= budget
+    assert subsample(np.zeros((5, 4, 3)), 10).shape[:2] == (2, 4)
+
+
+def test_sample_budget_fit():
+    rng = np.random.default_rng(11)
+    src = np.round(rng.uniform(0.0, 100.0, (968, 16, 3)), 1)
+    targ = src * 0.9 + 2.0
+
+    full = ImageMatcher(src, targ)
+    sampled = ImageMatcher(src, targ, sample_budget=2048)
+
+    image = rng.uniform(0.0, 100.0, (64, 64, 3))
+    diff = np.abs(full.adjusted(image) - sampled.adjusted(image))
+    # The mapping is linear, so a sparse fit should lose little.
+    assert np.max(diff[:, :, 0]) < 1.0
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from band_finder.image_db import ImageDB
+from band_finder.job_queue import JobQueue
+
+
+def _queue(tmp_path, worker_id, **kwargs):
+    # Each worker has its own connection, as separate processes would.
+    db = ImageDB(tmp_path / "images.db")
+    return JobQueue(db, "panos", worker_id=worker_id, **kwargs)
+
+
+def test_put_and_claim(tmp_path):
+    queue = _queue(tmp_path, "w1")
+    assert queue.put([("a", {"ids": [1, 2]}), ("b", {"ids": [3]})]) == 2
+    # Re-queueing unchanged jobs does nothing.
+    assert queue.put([("a", {"ids": [1, 2]})]) == 0
+
+    job = queue.claim()
+    assert (job.name, job.payload, job.attempts) == ("a", {"ids": [1, 2]}, 1)
+    assert queue.complete(job, {"path": "a.png"})
+    job = queue.claim()
+    assert job.name == "b"
+    assert queue.fail(job, "broken")
+    # Failed jobs are retried.
+    assert queue.claim().name == "b"
+    assert queue.claim() is None
+    assert queue.counts() == {"done": 1, "claimed": 1}
+
+    # A finished job is re-run if its payload changes, or on request.
+    assert queue.put([("a", {"ids": [1, 2, 4]})]) == 1
+    assert queue.put([("a", {"ids": [1, 2, 4]})], reset=True) == 1
+    assert queue.counts() == {"pending": 1, "claimed": 1}
+
+
+def test_claims_are_exclusive(tmp_path):
+    jobs = [(f"job_{i}", {"i": i}) for i in range(40)]
+    _queue(tmp_path, "filler").put(jobs)
+
+    def work(worker_id):
+        queue = _queue(tmp_path, worker_id)
+        claimed = []
+        for job in queue.gen_claimed():
+            claimed.append(job.name)
+            queue.complete(job)
+        return claimed
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(work, ["w1", "w2", "w3", "w4"]))
+    claimed = [name for names in results for name in names]
+    assert sorted(claimed) == sorted(name for name, _ in jobs)
+    assert _queue(tmp_path, "w1").counts() == {"done": 40}
+
+
+def test_expired_lease(tmp_path):
+    crashed = _queue(tmp_path, "crashed", lease_seconds=0.05, max_attempts=2)
+    crashed.put([("a", {})])
+    job = crashed.claim()
+
+    other = _queue(tmp_path, "other", lease_seconds=0.05, max_attempts=2)
+    assert other.claim() is None
+    time.sleep(0.1)
+    again = other.claim()
+    assert (again.job_id, again.attempts) == (job.job_id, 2)
+    # The crashed worker no longer holds the job.
+    assert not crashed.complete(job)
+
+    # Once out of attempts, an expired job fails.
+    time.sleep(0.1)
+    assert other.claim() is None
+    assert other.counts() == {"failed": 1}
+
+
+def test_heartbeat(tmp_path):
+    queue = _queue(tmp_path, "w1", lease_seconds=0.1)
+    queue.put([("a", {})])
+    other = _queue(tmp_path, "w2", lease_seconds=0.1)
+
+    job = queue.claim()
+    with queue.heartbeat(job, interval=0.02):
+        time.sleep(0.3)
+        assert other.claim() is None
+    assert queue.complete(job)
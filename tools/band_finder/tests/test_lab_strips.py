@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from skimage import color
+from skimage.util import img_as_ubyte
+
+from band_finder.lab_strips import rgb_to_lab, lab_to_rgb_ubyte
+
+
+def _reference_lab_to_rgb(lab):
+    # Whole-image float64 rescale and conversion, as PanoStitcher used
+    # to do it.
+    result = lab.astype(np.float64)
+    for chan, cmin, cmax, stretch in [
+        [0, 0.0, 100.0, True],
+        [1, -127.0, 128.0, False],
+        [2, -128.0, 127.0, False],
+    ]:
+        values = result[:, :, chan]
+        max_in = np.max(values)
+        min_in = np.min(values)
+        if stretch or ((max_in > cmax) or (min_in < cmin)):
+            scale = (cmax - cmin) / (max_in - min_in)
+            result[:, :, chan] = (values - min_in) * scale + cmin
+    return img_as_ubyte(color.lab2rgb(result))
+
+
+@pytest.fixture
+def rgb_image():
+    rng = np.random.default_rng(8)
+    return rng.integers(0, 256, (53, 41, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("strip_rows", [1, 7, 256])
+def test_rgb_to_lab(rgb_image, strip_rows):
+    expected = color.rgb2lab(rgb_image)
+    actual = rgb_to_lab(rgb_image, strip_rows=strip_rows)
+    assert actual.dtype == np.float32
+    assert np.allclose(actual, expected, atol=1e-3)
+
+
+@pytest.mark.parametrize("strip_rows", [1, 7, 256])
+def test_lab_to_rgb_ubyte(rgb_image, strip_rows):
+    lab = color.rgb2lab(rgb_image)
+    # Push a* out of range, as tile matching can.
+    lab[:, :, 1] *= 1.5
+    lab[:, :, 0] = lab[:, :, 0] * 0.8 + 5.0
+    before = lab.copy()
+
+    expected = _reference_lab_to_rgb(lab)
+    actual = lab_to_rgb_ubyte(lab.astype(np.float32), strip_rows=strip_rows)
+    assert actual.dtype == np.uint8
+    diff = np.abs(actual.astype(int) - expected.astype(int))
+    assert diff.max() <= 1
+    assert np.array_equal(lab, before)
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from band_finder.pipeline import Pipeline, Stage
+
+
+def test_stages_in_order():
+    pipeline = Pipeline(
+        [
+            Stage("double", lambda x: 2 * x, workers=3),
+            Stage("increment", lambda x: x + 1, workers=2),
+        ]
+    )
+    results = list(pipeline.run(range(100)))
+    assert sorted(results) == [2 * x + 1 for x in range(100)]
+
+    stats = pipeline.stats()
+    assert [s.name for s in stats] == ["double", "increment"]
+    assert [s.items for s in stats] == [100, 100]
+
+
+def test_empty_input():
+    pipeline = Pipeline([Stage("identity", lambda x: x)])
+    assert list(pipeline.run([])) == []
+
+
+def test_backpressure():
+    # A slow last stage holds back the fast first stage.
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, maximum
+
+    def start(x):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        return x
+
+    def finish(x):
+        time.sleep(0.002)
+        with lock:
+            in_flight[0] -= 1
+        return x
+
+    queue_size = 2
+    pipeline = Pipeline(
+        [Stage("start", start, workers=4), Stage("finish", finish)],
+        queue_size=queue_size,
+    )
+    assert len(list(pipeline.run(range(50)))) == 50
+    # Queued between the stages, plus one held by each worker.
+    assert in_flight[1] <= queue_size + 4 + 1
+
+
+def test_stage_failure():
+    def fail_on_7(x):
+        if x == 7:
+            raise RuntimeError("seven")
+        return x
+
+    pipeline = Pipeline(
+        [Stage("identity", lambda x: x, workers=2), Stage("fail", fail_on_7)]
+    )
+    with pytest.raises(RuntimeError, match="seven"):
+        list(pipeline.run(range(1000)))
+
+
+def test_abandoned_run():
+    pipeline = Pipeline([Stage("identity", lambda x: x, workers=2)])
+    results = pipeline.run(range(1000))
+    assert next(results) is not None
+    # Closing the generator stops the workers.
+    results.close()
+    assert pipeline.stats()[0].items < 1000
+
+
+def test_no_stages():
+    with pytest.raises(ValueError):
+        Pipeline([])
+    with pytest.raises(ValueError):
+        Stage("idle", lambda x: x, workers=0)
@@ -0,0 +1,79 @@
+import pytest
+
+from band_finder.image_db import ImageDB
+from band_finder.rss_feed import FeedHarvester
+
+from helpers import StandInFeed, make_feed_record
+
+
+def _feed_records(count):
+    return [
+        make_feed_record(f"NLF_{i:04d}", sol=i // 10, sclk=1000.0 + i)
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("total_results", [True, False])
+def test_num_pages(stand_in_server, total_results):
+    stand_in_server.respond = StandInFeed(_feed_records(95), total_results)
+    harvester = FeedHarvester(url=stand_in_server.url + "/rss/api/")
+    assert harvester.num_pages(num=10) == 10
+
+    # Without total_results, finding the last page must not require
+    # probing every page.
+    if not total_results:
+        probed = {int(q["page"]) for _, q, _ in stand_in_server.requests}
+        assert len(probed) < 10
+
+
+@pytest.mark.parametrize("total_results", [True, False])
+def test_harvest(stand_in_server, tmp_path, total_results):
+    records = _feed_records(237)
+    stand_in_server.respond = StandInFeed(records, total_results)
+    harvester = FeedHarvester(
+        max_workers=4, url=stand_in_server.url + "/rss/api/"
+    )
+    db = ImageDB(tmp_path / "images.db")
+
+    assert harvester.harvest(db, num=20) == len(records)
+
+    count = db.cursor().execute("SELECT COUNT(*) FROM Images").fetchone()[0]
+    assert count == len(records)
+
+
+def test_harvest_empty_feed(stand_in_server, tmp_path):
+    stand_in_server.respond = StandInFeed([])
+    harvester = FeedHarvester(url=stand_in_server.url + "/rss/api/")
+    db = ImageDB(tmp_path / "images.db")
+    assert harvester.harvest(db, num=20) == 0
+
+
+def test_incremental_sync(stand_in_server, tmp_path):
+    records = _feed_records(200)
+    feed = StandInFeed(records)
+    stand_in_server.respond = feed
+    harvester = FeedHarvester(url=stand_in_server.url + "/rss/api/")
+    db = ImageDB(tmp_path / "images.db")
+
+    assert harvester.sync(db, num=20) == len(records)
+    state = db.sync_state("raw_images")
+    assert (state["sol"], state["image_id"]) == (19, "NLF_0199")
+
+    # Nothing new: only sols from the high-water mark on are requested,
+    # and paging stops at the first fully-known page.
+    stand_in_server.requests.clear()
+    assert harvester.sync(db, num=20) == 0
+    assert len(stand_in_server.requests) == 1
+    assert stand_in_server.requests[0][1]["condition_2"] == "19:sol:gte"
+
+    # New images arrive.
+    feed.records = records + [
+        make_feed_record(f"NLF_{i:04d}", sol=i // 10, sclk=1000.0 + i)
+        for i in range(200, 230)
+    ]
+    stand_in_server.requests.clear()
+    assert harvester.sync(db, num=20) > 0
+    assert len(stand_in_server.requests) <= 3
+    assert db.sync_state("raw_images")["image_id"] == "NLF_0229"
+    count = db.cursor().execute("SELECT COUNT(*) FROM Images").fetchone()[0]
+    assert count == 230
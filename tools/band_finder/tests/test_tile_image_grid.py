@@ -1,4 +1,4 @@
-from band_finder.tile_image_grid import TileImageGrid, Edge
+from band_finder.tile_image_grid import TileBuffer, TileImageGrid, Edge
 import numpy as np
 
 import pytest
@@ -103,3 +103,54 @@ overlap_edge_values_test_data = [
 def test_overlap_edge_values(x, y, edge, expected, overlapping_grid):
     actual = overlapping_grid.edge(x, y, edge)
     assert actual.tolist() == expected
+
+
+@pytest.mark.parametrize("use_memmap", [False, True])
+def test_contiguous_storage(use_memmap, tmp_path):
+    tbo = {
+        (0, 0): np.full((4, 6, 3), 1.0),
+        (4, 0): np.full((4, 6, 3), 2.0),
+        (0, 3): np.full((4, 6, 3), 3.0),
+    }
+    memmap_path = tmp_path / "tiles.dat" if use_memmap else None
+    grid = TileImageGrid(tbo, contiguous=True, memmap_path=memmap_path)
+    assert grid.is_contiguous()
+    buffer = grid._buffer
+    assert buffer.size == 3 * 4 * 6 * 3
+    assert grid.layout()[(1, 0)] == (72, (4, 6, 3))
+
+    # Tiles and edges are views into the shared buffer.
+    assert np.shares_memory(grid.tile_view(1, 0), buffer)
+    assert np.shares_memory(grid.edge(1, 0, Edge.LEFT), buffer)
+    assert not np.shares_memory(grid.tile(1, 0), buffer)
+
+    grid.multiply(1, 0, 10.0)
+    grid.set_tile(0, 1, np.full((4, 6, 3), 7.0))
+    assert np.shares_memory(grid.tile_view(1, 0), buffer)
+    assert np.shares_memory(grid.tile_view(0, 1), buffer)
+    assert np.all(grid.tile_view(1, 0) == 20.0)
+    assert np.all(grid.tile_view(0, 1) == 7.0)
+    # The caller's tiles are untouched.
+    assert np.all(tbo[(4, 0)] == 2.0)
+
+
+@pytest.mark.parametrize("use_memmap", [False, True])
+def test_tile_buffer_grows(use_memmap, tmp_path):
+    memmap_path = tmp_path / "tiles.dat" if use_memmap else None
+    store = TileBuffer(capacity=10, memmap_path=memmap_path)
+    tiles = {
+        (i, 0): np.full((2, 3, 3), i, dtype=np.uint8) for i in range(5)
+    }
+    for key, tile in tiles.items():
+        store.add(key, tile)
+    assert store.array.dtype == np.float32
+    assert store.array.size >= 5 * 18
+    for key, tile in tiles.items():
+        assert np.array_equal(store.view(key), tile)
+        assert np.shares_memory(store.view(key), store.array)
+
+    with pytest.raises(ValueError):
+        store.add((0, 0), tiles[(0, 0)])
+    for key in tiles:
+        store.release(key)
+    assert store.array is None
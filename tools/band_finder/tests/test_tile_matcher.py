@@ -0,0 +1,121 @@
+import weakref
+
+import numpy as np
+import pytest
+
+from band_finder.tile_matcher import TileMatcher
+
+from helpers import add_tiles
+
+
+@pytest.mark.parametrize("missing", [(), ((2, 1), (0, 2))])
+def test_concurrent_matches_serial(missing):
+    serial = TileMatcher("serial")
+    add_tiles(serial, 4, 7, missing)
+    concurrent = TileMatcher("concurrent", max_workers=4)
+    add_tiles(concurrent, 4, 7, missing)
+
+    expected = serial.composite()
+    actual = concurrent.composite()
+    assert actual.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("max_workers", [None, 3])
+def test_global_mode_recovers_linear_distortion(max_workers):
+    rng = np.random.default_rng(3)
+    rows, cols = 3, 5
+    h, w, overlap = 24, 32, 8
+    scene = rng.uniform(0.0, 100.0, (rows * h, cols * w, 3))
+
+    matcher = TileMatcher("global", max_workers=max_workers, mode="global")
+    expected = None
+    for iy in range(rows):
+        for ix in range(cols):
+            x = ix * (w - overlap)
+            y = iy * (h - overlap)
+            gain = rng.uniform(0.7, 1.3, 3)
+            offset = rng.uniform(-5.0, 5.0, 3)
+            if (ix, iy) == (0, 0):
+                # The reference tile defines the output's appearance.
+                expected = scene * gain + offset
+            matcher.add(scene[y:y + h, x:x + w] * gain + offset, (x, y))
+
+    actual = matcher.composite()
+    height, width = actual.shape[:2]
+    assert np.allclose(actual, expected[:height, :width], atol=0.05)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        TileMatcher(mode="bogus")
+
+
+@pytest.mark.parametrize("max_workers", [None, 4])
+def test_contiguous_matches_default(max_workers):
+    default = TileMatcher("default")
+    add_tiles(default, 3, 5, ((3, 1),))
+    contiguous = TileMatcher(
+        "contiguous", max_workers=max_workers, contiguous=True
+    )
+    add_tiles(contiguous, 3, 5, ((3, 1),))
+
+    expected = default.composite()
+    actual = contiguous.composite()
+    assert actual.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_contiguous_integer_tiles(dtype):
+    # Adjustments must not be truncated to the tiles' integer type.
+    default = TileMatcher("default")
+    add_tiles(default, 2, 3, dtype=dtype)
+    contiguous = TileMatcher("contiguous", contiguous=True)
+    add_tiles(contiguous, 2, 3, dtype=dtype)
+
+    expected = default.composite()
+    actual = contiguous.composite()
+    assert actual.tobytes() == expected.tobytes()
+    assert not np.array_equal(actual, np.round(actual))
+
+
+@pytest.mark.parametrize("contiguous", [False, True])
+def test_memmap_canvas_and_release(tmp_path, contiguous):
+    default = TileMatcher("default")
+    add_tiles(default, 3, 4, ((1, 1),))
+    expected = default.composite()
+
+    matcher = TileMatcher("memmap", contiguous=contiguous)
+    add_tiles(matcher, 3, 4, ((1, 1),))
+    canvas_path = tmp_path / "canvas.npy"
+    actual = matcher.composite(canvas_path=canvas_path, release_tiles=True)
+
+    assert isinstance(actual, np.memmap)
+    assert actual.tobytes() == expected.tobytes()
+    assert matcher._tiles_by_origin == {}
+    assert np.array_equal(np.load(canvas_path, mmap_mode="r"), expected)
+
+
+def test_release_frees_tiles():
+    matcher = TileMatcher("release", mode="global")
+    add_tiles(matcher, 2, 3)
+    refs = [weakref.ref(tile) for tile in matcher._tiles_by_origin.values()]
+
+    matcher.composite(release_tiles=True)
+    assert all(ref() is None for ref in refs)
+
+
+def test_contiguous_keeps_no_originals():
+    matcher = TileMatcher("contiguous", contiguous=True)
+    tiles = {}
+    for i, origin in enumerate([(0, 0), (24, 0), (0, 16)]):
+        tiles[origin] = np.full((24, 32, 3), 10.0 * i, dtype=np.float32)
+        matcher.add(tiles[origin], origin)
+    refs = [weakref.ref(tile) for tile in tiles.values()]
+    del tiles
+    assert all(ref() is None for ref in refs)
+
+    # float32 tiles are not promoted.
+    assert matcher._tile_buffer.array.dtype == np.float32
+    first = matcher.composite()
+    # Compositing without releasing leaves the stored tiles unadjusted.
+    assert matcher.composite().tobytes() == first.tobytes()